@@ -2,6 +2,10 @@
 # therefore the data that gets send over can can be interpreted with this file
 import re
 import time
+try:
+    import numpy as np
+except ImportError:
+    np = None   # encode_batch then returns a list of payloads
 
 # select a dbcfile and a datalogging file
 frames = {}
@@ -51,10 +55,15 @@ def read_dbc(file = "CANoe_C23.dbc"):
             formatString = re.sub(" ",",", formatString)
             signal_data = formatString.split(",")
 
+            #"SG_ name M :" / "SG_ name m2 :" for multiplexed signals
+            name_parts = dbc_line.split(":")[0].split()
             signal = {
                 "start_bit" : signal_data[0],
                 "length" : signal_data[1],
-                "endinanes" : signal_data[2],
+                #"1" intel, "0" motorola, a "-" behind it marks a signed signal
+                "endinanes" : signal_data[2].rstrip("-"),
+                "signed" : signal_data[2].endswith("-"),
+                "multiplex" : name_parts[2] if len(name_parts) > 2 else "",
                 "scale" : signal_data[3],
                 "offset" : signal_data[4],
                 "minima" : signal_data[5],
@@ -82,54 +91,83 @@ def read_dbc(file = "CANoe_C23.dbc"):
 
 
 
-def map_data_to_signal(signal, data):
-        # print("signal {}".format(signal))
-        start_bit=int(signal.get("start_bit"))
-        length=int(signal.get("length"))
-        scale=float(signal.get("scale"))
-        offset=float(signal.get("offset"))
-        unit=str(signal.get("unit"))
-        endinanes = str(signal.get("endinanes"))
-        #print("Signal parameter {},{},{},{}".format(start_bit,length,scale,offset,unit,endinanes))
-
-        if endinanes == "1":
-            #@1-> little endinanes/intel
-            real_bit_start = start_bit
+def compile_signal(signal):
+    # shift, mask and scaling of a signal, computed once and kept in the signal dict
+    # the payload is used as integer with byte 0 as lowest byte (like the hex string
+    # of can_msg_to_dicct, byte 0 written last). intel signals are read from that
+    # integer, motorola signals from the byte swapped one (byte 0 highest)
+    codec = signal.get("codec")
+    if codec is not None:
+        return codec
+    start_bit = int(signal.get("start_bit"))
+    length = int(signal.get("length"))
+    if str(signal.get("endinanes")) == "1":
+        #@1-> little endinanes/intel, start bit is the lsb
+        motorola = False
+        shift = start_bit
+    else:
+        #@0 -> big endinanes/motorla, start bit is the msb, counted inside the byte from the lsb
+        motorola = True
+        msb = (start_bit // 8) * 8 + 7 - start_bit % 8
+        shift = 63 - (msb + length - 1)
+    if shift < 0 or shift + length > 64:
+        raise ValueError("signal outside of the 8 byte payload: start bit {}, length {}".format(start_bit, length))
+    signed = bool(signal.get("signed"))
+    minimum = float(signal.get("minima"))
+    maximum = float(signal.get("maxima"))
+    codec = {
+        "motorola" : motorola,
+        "shift" : shift,
+        "mask" : (1 << length) - 1,
+        "signed" : signed,
+        "sign_bit" : 1 << (length - 1),
+        "raw_min" : -(1 << (length - 1)) if signed else 0,
+        "raw_max" : (1 << (length - 1)) - 1 if signed else (1 << length) - 1,
+        "scale" : float(signal.get("scale")),
+        "offset" : float(signal.get("offset")),
+        #[0|0] in a dbc means no range
+        "minimum" : minimum,
+        "maximum" : maximum,
+        "checked" : minimum != 0 or maximum != 0,
+    }
+    signal["codec"] = codec
+    return codec
+
+
+def signal_codecs(dbc_frames=None):
+    # signal name -> (can id, codec) of every signal of the dbc, the signal table of
+    # modules/can_logger/frame_expr (filter / trigger expressions)
+    codecs = {}
+    for frame_id, frame in (frames if dbc_frames is None else dbc_frames).items():
+        can_id = int(frame_id or "0", 16) & 0x1FFFFFFF
+        for name, signal in frame.get("signals").items():
+            try:
+                codecs[name] = (can_id, compile_signal(signal))
+            except ValueError:
+                #signal outside of the payload, can't be used in expressions
+                continue
+    return codecs
+
+
+def swap_payload(data):
+    # payload integer with byte 0 lowest <-> byte 0 highest
+    return int.from_bytes(data.to_bytes(8, "little"), "big")
+
+
+def map_data_to_signal(signal, data, swapped=None):
+        # data: payload as integer, byte 0 lowest. swapped: swap_payload(data) if already known
+        codec = signal.get("codec") or compile_signal(signal)
+        if codec["motorola"]:
+            if swapped is None:
+                swapped = swap_payload(data)
+            raw = (swapped >> codec["shift"]) & codec["mask"]
         else:
-            #@0 -> big endinanes/motorla
-            real_bit_start = start_bit-length
-
-       # print("stat:{}, length :{}, scale:{}, offset:{}, unit:{}, data:{}".format(start_bit,length,scale,offset,unit,data))
-        #get the concrete values of each signal
-                   
-        #create a bitmask while shifting with 1 and orring with
-        bitmask=0
-        #print("real bit start {}".format(real_bit_start))
-        for i in range(length):
-            bitmask=(bitmask<<1)|1
-
-        for i in range(real_bit_start):
-            bitmask=bitmask<<1
-        #print("Maks",bin(data))
-        #print("MASK",bin(bitmask))
-
-        masked_value=data&bitmask
-        backshifted_value =masked_value>>start_bit
-        #print("maskedvalue", bin(masked_value))
-        #print("maskedvalue", bin(backshifted_value))
-        #scale value and offset
+            raw = (data >> codec["shift"]) & codec["mask"]
+        if codec["signed"] and raw & codec["sign_bit"]:
+            raw -= codec["mask"] + 1
 
-        value=backshifted_value*scale+offset
-
-        #print(signal)
-        signal_container = {
-                "value":value,
-                "unit":unit}
-        #print(signal_container)
-        #signal_containers.update({
-        #    signal_name:signal_container
-        #    })
-        #print(value)
+        #scale value and offset
+        value = raw * codec["scale"] + codec["offset"]
         return value
 
 
@@ -141,12 +179,13 @@ def map_data_to_frame(DBCFrame, data):
     data = data.replace(" ","") 
     #print("hex ", data)
     data = int(str(data),16)
+    swapped = swap_payload(data)
     #print("dec ", data)
     #iterate through all signals in this frame
     for signal in DBCFrame.get("signals"):
 
         #print("signal {}".format(signal))
-        mapped_data = map_data_to_signal(DBCFrame.get("signals").get(signal), data)
+        mapped_data = map_data_to_signal(DBCFrame.get("signals").get(signal), data, swapped)
         #print(signal,mapped_data
         decoded_signal = {
                 "data" : mapped_data,
@@ -170,6 +209,143 @@ def convert_can_frame_to_signals(can_frame):
     return signals
 
 
+# ---------------- encoder ----------------
+# inverse of map_data_to_frame: physical values -> payload bytes, for tx
+# (TransmitData / TransmitBatch, the cyclic scheduler). the values are checked
+# against the dbc minima / maxima and the bit length of the signal.
+
+class FrameEncoder:
+    def __init__(self, frame_id, DBCFrame):
+        raw_id = int(frame_id, 16) if frame_id else 0
+        self.name = DBCFrame.get("block_name").rstrip(":")
+        self.eff = 1 if raw_id & 0x80000000 else 0
+        self.can_id = raw_id & 0x1FFFFFFF
+        self.dlc = min(8, int(DBCFrame.get("amount_Signals")))
+        self.signals = dict((name, compile_signal(signal)) for name, signal in DBCFrame.get("signals").items())
+        self.multiplex = dict((name, signal.get("multiplex", "")) for name, signal in DBCFrame.get("signals").items())
+        self.multiplexor = next((name for name, mux in self.multiplex.items() if mux == "M"), None)
+
+    def raw_value(self, name, value, clamp=False):
+        codec = self.signals[name]
+        if codec["checked"] and not codec["minimum"] <= value <= codec["maximum"]:
+            if not clamp:
+                raise ValueError("{}.{} = {} outside of [{}, {}]".format(
+                    self.name, name, value, codec["minimum"], codec["maximum"]))
+            value = min(max(value, codec["minimum"]), codec["maximum"])
+        raw = int(round((value - codec["offset"]) / codec["scale"]))
+        if not codec["raw_min"] <= raw <= codec["raw_max"]:
+            if not clamp:
+                raise ValueError("{}.{} = {} does not fit into the signal".format(self.name, name, value))
+            raw = min(max(raw, codec["raw_min"]), codec["raw_max"])
+        return raw
+
+    def _check_multiplex(self, names, mux_value):
+        for name in names:
+            mux = self.multiplex.get(name)
+            if mux is None:
+                raise KeyError("{} has no signal {}".format(self.name, name))
+            if mux.startswith("m") and mux_value is not None and int(mux[1:]) != mux_value:
+                raise ValueError("{}.{} is not sent with multiplexor {}".format(self.name, name, mux_value))
+
+    def encode(self, values, clamp=False):
+        # values: signal name -> physical value, missing signals are sent as raw 0
+        mux_value = None
+        if self.multiplexor is not None and self.multiplexor in values:
+            mux_value = self.raw_value(self.multiplexor, values[self.multiplexor], clamp)
+        self._check_multiplex(values, mux_value)
+        intel = 0
+        motorola = 0
+        for name, value in values.items():
+            codec = self.signals[name]
+            raw = (self.raw_value(name, value, clamp) & codec["mask"]) << codec["shift"]
+            if codec["motorola"]:
+                motorola |= raw
+            else:
+                intel |= raw
+        data = intel | swap_payload(motorola)
+        return data.to_bytes(8, "little")[:self.dlc]
+
+    def encode_batch(self, columns, clamp=False):
+        # columns: signal name -> sequence of physical values, all of the same length
+        # returns a (n, dlc) uint8 array with numpy, else a list of payloads
+        if np is None:
+            names = list(columns)
+            return [self.encode(dict(zip(names, row)), clamp) for row in zip(*columns.values())]
+        mux_values = None
+        if self.multiplexor is not None and self.multiplexor in columns:
+            mux_values = self._raw_column(self.multiplexor, columns[self.multiplexor], clamp)
+        self._check_multiplex(columns, None)
+        count = len(next(iter(columns.values()))) if columns else 0
+        intel = np.zeros(count, dtype="<u8")
+        motorola = np.zeros(count, dtype="<u8")
+        for name, column in columns.items():
+            codec = self.signals[name]
+            mux = self.multiplex[name]
+            raw = self._raw_column(name, column, clamp)
+            if mux.startswith("m") and mux_values is not None and (mux_values != int(mux[1:])).any():
+                raise ValueError("{}.{} is not sent with multiplexor {}".format(
+                    self.name, name, mux_values[mux_values != int(mux[1:])][0]))
+            raw = (raw.astype("<u8") & np.uint64(codec["mask"])) << np.uint64(codec["shift"])
+            if codec["motorola"]:
+                motorola |= raw
+            else:
+                intel |= raw
+        data = intel | motorola.byteswap()
+        return data.view(np.uint8).reshape(count, 8)[:, :self.dlc]
+
+    def _raw_column(self, name, column, clamp):
+        codec = self.signals[name]
+        values = np.asarray(column, dtype=np.float64)
+        if codec["checked"]:
+            bad = (values < codec["minimum"]) | (values > codec["maximum"])
+            if bad.any():
+                if not clamp:
+                    raise ValueError("{}.{} = {} outside of [{}, {}]".format(
+                        self.name, name, values[bad][0], codec["minimum"], codec["maximum"]))
+                values = np.clip(values, codec["minimum"], codec["maximum"])
+        raw = np.rint((values - codec["offset"]) / codec["scale"]).astype(np.int64)
+        bad = (raw < codec["raw_min"]) | (raw > codec["raw_max"])
+        if bad.any():
+            if not clamp:
+                raise ValueError("{}.{} = {} does not fit into the signal".format(self.name, name, values[bad][0]))
+            raw = np.clip(raw, codec["raw_min"], codec["raw_max"])
+        return raw
+
+
+encoders = {}
+encoder_frames = None
+def get_encoder(message):
+    # message: frame name, can id (int) or the hex id string used as key in frames
+    global encoders, encoder_frames
+    if encoder_frames is not frames:
+        #new dbc read in
+        encoders = {}
+        encoder_frames = frames
+    encoder = encoders.get(message)
+    if encoder is None:
+        if isinstance(message, int):
+            frame_id = next((key for key in frames if key and int(key, 16) & 0x1FFFFFFF == message), None)
+        elif message in frames:
+            frame_id = message
+        else:
+            frame_id = next((key for key, frame in frames.items() if frame.get("block_name").rstrip(":") == message), None)
+        if frame_id is None:
+            raise KeyError("no frame {} in the dbc".format(message))
+        encoder = FrameEncoder(frame_id, frames[frame_id])
+        encoders[message] = encoder
+    return encoder
+
+
+def encode_frame(message, values, clamp=False):
+    # payload bytes of message (name or id) with the physical signal values
+    return get_encoder(message).encode(values, clamp)
+
+
+def encode_batch(message, columns, clamp=False):
+    # payloads of many frames from columns of physical values
+    return get_encoder(message).encode_batch(columns, clamp)
+
+
 def map_log_file(file_name,dbc):
     
     
@@ -0,0 +1,208 @@
+# micro benchmarks of the DBCReader hot paths (read_dbc, map_data_to_signal,
+# map_data_to_frame) on a synthetic dbc: N messages with M signals each,
+# intel and motorola, unsigned and signed, every 4th message multiplexed.
+# payloads are random. timing with timeit (best of --repeat runs).
+# results:
+#   read_dbc_mb_per_s / read_dbc_s_per_mb   dbc load time
+#   <kind>_signals_per_s                    map_data_to_signal per signal kind
+#   frame_signals_per_s                     map_data_to_frame, signals decoded per second
+# --save-baseline stores the result as the baseline, --check compares against
+# it and exits with 1 if a throughput dropped more than --threshold.
+# the baseline (benchmarks/baseline_dbc.json, default settings) is kept in the
+# repo, refresh it with --save-baseline when the machine or a speedup changes it.
+# run the check before merging decoder changes:
+#
+#   python benchmarks/bench_dbc.py --check
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BASE_DIR))
+
+import DBCReader
+
+BASELINE = os.path.join(BASE_DIR, "baseline_dbc.json")
+KINDS = ("intel", "motorola", "intel_signed", "motorola_signed")
+#metrics where higher is better, checked against the baseline
+THROUGHPUT_KEYS = ("read_dbc_mb_per_s", "frame_signals_per_s") + tuple(kind + "_signals_per_s" for kind in KINDS)
+
+
+def motorola_start_bit(position):
+    # position: bit of the msb counted from the msb of byte 0, dbc counts inside the byte from the lsb
+    return (position // 8) * 8 + 7 - position % 8
+
+
+def signal_line(name, position, length, kind, multiplex=""):
+    signed = "-" if kind.endswith("signed") else "+"
+    if kind.startswith("motorola"):
+        start_bit = motorola_start_bit(position)
+        byte_order = "0"
+    else:
+        start_bit = position
+        byte_order = "1"
+    maximum = (1 << length) - 1
+    return ' SG_ {}{} : {}|{}@{}{} (0.5,-10) [0|{}] "unit" Vector__XXX'.format(
+        name, multiplex, start_bit, length, byte_order, signed, maximum)
+
+
+def generate_dbc(messages, signals, seed=1):
+    # returns the dbc text and the frames as (id, [(signal name, kind)])
+    rng = random.Random(seed)
+    lines = ['VERSION ""', "", "", "BS_:", "", "BU_:", ""]
+    layout = []
+    for m in range(messages):
+        can_id = 0x100 + m
+        lines.append("BO_ {} MSG_{}: 8 Vector__XXX".format(can_id, m))
+        multiplexed = m % 4 == 3
+        position = 0
+        length = max(1, (64 - (4 if multiplexed else 0)) // signals)
+        frame_signals = []
+        if multiplexed:
+            lines.append(signal_line("MUX_{}".format(m), 0, 4, "intel", " M"))
+            frame_signals.append(("MUX_{}".format(m), "intel"))
+            position = 4
+        for s in range(signals):
+            kind = rng.choice(KINDS)
+            name = "SIG_{}_{}".format(m, s)
+            mux = " m{}".format(s % 2) if multiplexed else ""
+            lines.append(signal_line(name, position, length, kind, mux))
+            frame_signals.append((name, kind))
+            position += length
+        lines.append("")
+        layout.append((can_id, frame_signals))
+    lines.append("")
+    return "\n".join(lines), layout
+
+
+def random_payloads(count, seed=2):
+    # hex strings like can_msg_to_dicct writes them
+    rng = random.Random(seed)
+    return [" ".join("{:02x}".format(rng.randrange(256)) for i in range(8)) for n in range(count)]
+
+
+def best_time(stmt, number, repeat):
+    return min(timeit.Timer(stmt).repeat(repeat=repeat, number=number)) / number
+
+
+def bench_read_dbc(file_name, repeat):
+    size_mb = os.path.getsize(file_name) / 1e6
+    #read_dbc prints a summary line
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = best_time(lambda: DBCReader.read_dbc(file_name), 1, repeat)
+    return {"read_dbc_s_per_mb": seconds / size_mb, "read_dbc_mb_per_s": size_mb / seconds, "dbc_mb": size_mb}
+
+
+def bench_signals(frames, layout, payloads, number, repeat):
+    # map_data_to_signal, grouped by the kind of signal
+    data = [int(payload.replace(" ", ""), 16) for payload in payloads]
+    by_kind = dict((kind, []) for kind in KINDS)
+    for can_id, frame_signals in layout:
+        signals = frames[hex(can_id)[2:]]["signals"]
+        for name, kind in frame_signals:
+            by_kind[kind].append(signals[name])
+    result = {}
+    for kind, signals in by_kind.items():
+        if not signals:
+            continue
+
+        def decode(signals=signals):
+            for signal in signals:
+                for value in data:
+                    DBCReader.map_data_to_signal(signal, value)
+        result[kind + "_signals_per_s"] = len(signals) * len(data) / best_time(decode, number, repeat)
+    return result
+
+
+def bench_frames(frames, layout, payloads, number, repeat):
+    dbc_frames = [frames[hex(can_id)[2:]] for can_id, frame_signals in layout]
+    signal_count = sum(len(frame["signals"]) for frame in dbc_frames)
+
+    def decode():
+        for frame in dbc_frames:
+            for payload in payloads:
+                DBCReader.map_data_to_frame(frame, payload)
+    return {"frame_signals_per_s": signal_count * len(payloads) / best_time(decode, number, repeat)}
+
+
+def run(args):
+    text, layout = generate_dbc(args.messages, args.signals, seed=args.seed)
+    payloads = random_payloads(args.payloads, seed=args.seed + 1)
+    fd, file_name = tempfile.mkstemp(suffix=".dbc")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        result = bench_read_dbc(file_name, args.repeat)
+    finally:
+        os.remove(file_name)
+    frames = DBCReader.frames
+    result.update(bench_signals(frames, layout, payloads, args.number, args.repeat))
+    result.update(bench_frames(frames, layout, payloads, args.number, args.repeat))
+    return {
+        "settings": {"messages": args.messages, "signals": args.signals, "payloads": args.payloads,
+                     "seed": args.seed},
+        "metrics": result,
+    }
+
+
+def check(result, baseline, threshold):
+    # list of the throughputs that dropped more than threshold (0.2 = 20%)
+    failed = []
+    if baseline.get("settings") != result["settings"]:
+        print("warning: baseline was measured with {}".format(baseline.get("settings")))
+    for key in THROUGHPUT_KEYS:
+        old = baseline.get("metrics", {}).get(key)
+        new = result["metrics"].get(key)
+        if not old or new is None:
+            continue
+        change = new / old - 1
+        status = "FAIL" if change < -threshold else "ok"
+        print("{:30} {:>14.1f} {:>14.1f} {:+7.1f}% {}".format(key, old, new, change * 100, status))
+        if status == "FAIL":
+            failed.append(key)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="micro benchmarks of the dbc decoder")
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--signals", type=int, default=8, help="signals per message")
+    parser.add_argument("--payloads", type=int, default=50, help="random payloads per message")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--number", type=int, default=3, help="timeit loops per run")
+    parser.add_argument("--repeat", type=int, default=5, help="runs, the best one counts")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="fail on a regression against the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed throughput drop (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    result = run(args)
+    for key, value in sorted(result["metrics"].items()):
+        print("{:30} {:>14.4g}".format(key, value))
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(result, f, indent=2)
+        print("baseline saved to {}".format(args.baseline))
+    elif args.check:
+        if not os.path.isfile(args.baseline):
+            print("no baseline {}, run with --save-baseline first".format(args.baseline))
+            sys.exit(2)
+        with open(args.baseline) as f:
+            failed = check(result, json.load(f), args.threshold)
+        if failed:
+            print("regression in {}".format(", ".join(failed)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
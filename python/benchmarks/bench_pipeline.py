@@ -0,0 +1,293 @@
+# throughput / latency benchmark of the logging pipeline
+# the frames come from the virtual tiny can (modules/TinyCan/virtualTinyCan)
+# in non realtime mode, so it runs without an adapter and as fast as the
+# code allows. every stage is measured on its own with the same batches:
+#   receive    CanReceive from the driver fifo
+#   to_dicct   can_msg_to_dicct
+#   save_txt   save_cached_msgs (text data file)
+#   decode     DBC decode of the frames known to the dbc
+#   write_bin  binary segment writer
+# and all together as "pipeline" (receive -> router -> raw log + decoder).
+# per stage: frames/s, p50/p99 latency of a batch and the bytes allocated
+# per frame (tracemalloc, separate pass so it doesn't slow the timing), at
+# the end the peak rss of the process.
+# results go into a json file, --compare prints the change against an older one
+#
+#   python benchmarks/bench_pipeline.py --frames 50000 --compare benchmarks/results/old.json
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    #windows
+    resource = None
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import modules
+import DBCReader
+from modules.TinyCan import virtualTinyCan
+from modules.can_logger import top_level_can_logger
+from modules.can_logger import can_filter
+from modules.can_logger import can_router
+from modules.file_manager import binary_log
+from modules.file_manager import general_file_functions
+
+RESULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        #bytes on mac, kB on linux
+        rss //= 1024
+    return rss
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=BASE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class FrameSource:
+    # virtual tiny can with the dbc ids at the given bus load, filled on demand
+    def __init__(self, ids, load=1.0, bitrate=1000, seed=1):
+        traffic = virtualTinyCan.bus_load_traffic(ids, load=load, bitrate=bitrate)
+        self.frames_per_s = sum(1.0 / message["cycle"] for message in traffic)
+        self.lib = virtualTinyCan.VirtualTinyCanLibrary(traffic=traffic, realtime=False, seed=seed)
+        self.driver = modules.TinyCan.mhsTinyCanDriver.MhsTinyCanDriver(dll=self.lib)
+        err = self.driver.OpenComplete(canSpeed=bitrate)
+        if err:
+            raise RuntimeError("virtual tiny can: {}".format(err))
+        self.index = self.driver.IndexValue()
+
+    def fill(self, count):
+        # puts about count frames into the fifo
+        self.lib.generate(count / self.frames_per_s)
+
+    def receive(self, count):
+        #same call as the rx callback
+        return self.driver.CanReceiveFast(self.index, count)
+
+    def close(self):
+        self.driver.CanDownDriver()
+        self.lib.close()
+
+
+def stage_result(frames, latencies):
+    seconds = sum(latencies)
+    return {
+        "frames": frames,
+        "batches": len(latencies),
+        "seconds": seconds,
+        "frames_per_s": frames / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def alloc_per_frame(func, batches, frames):
+    # bytes allocated per frame while the stage runs (freed or not)
+    tracemalloc.start()
+    allocated = 0
+    for batch in batches:
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func(batch)
+        allocated += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return allocated / frames if frames else 0.0
+
+
+def time_stage(func, batches):
+    latencies = []
+    timer = time.perf_counter
+    gc.collect()
+    for batch in batches:
+        t0 = timer()
+        func(batch)
+        latencies.append(timer() - t0)
+    return latencies
+
+
+def bench_receive(source, frames, batch_size):
+    # the only stage that can't run twice on the same data, the batches are kept for the others
+    batches = []
+    latencies = []
+    timer = time.perf_counter
+    received = 0
+    while received < frames:
+        source.fill(batch_size)
+        t0 = timer()
+        num_msg, raw_msgs = source.receive(batch_size)
+        latencies.append(timer() - t0)
+        if num_msg > 0:
+            batches.append(raw_msgs)
+            received += num_msg
+    return batches, stage_result(received, latencies)
+
+
+def bench_pipeline(source, frames, batch_size, dbc_ids):
+    # receive -> router -> raw text log + decoder, latency from CanReceive to the last subscriber
+    router = can_router.FrameRouter()
+    router.subscribe(top_level_can_logger.log_raw_frames, name="raw_log")
+    router.subscribe(decode_batch, ids=dbc_ids, name="decoder")
+    latencies = []
+    timer = time.perf_counter
+    received = 0
+    gc.collect()
+    while received < frames:
+        source.fill(batch_size)
+        t0 = timer()
+        num_msg, raw_msgs = source.receive(batch_size)
+        if num_msg > 0:
+            router.dispatch(raw_msgs)
+            received += num_msg
+        latencies.append(timer() - t0)
+    return stage_result(received, latencies)
+
+
+def to_dicct_batch(raw_msgs):
+    return [top_level_can_logger.can_msg_to_dicct(raw_msg) for raw_msg in raw_msgs]
+
+
+def save_txt_batch(dicts):
+    for nr, can_frame_data in enumerate(dicts):
+        top_level_can_logger.save_cached_msgs(nr, can_frame_data)
+
+
+def decode_batch(raw_msgs):
+    frames = DBCReader.frames
+    for raw_msg in raw_msgs:
+        dat = top_level_can_logger.can_msg_to_dicct(raw_msg)
+        if dat["Id"] in frames:
+            DBCReader.convert_can_frame_to_signals(dat)
+
+
+def run(args):
+    DBCReader.read_dbc(os.path.abspath(args.dbc))
+    dbc_ids = [can_id for can_id, eff in can_filter.frame_ids_from_dbc(DBCReader.frames)]
+
+    #the writers write relative to the working directory
+    work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    os.mkdir("LOGS")
+    top_level_can_logger.data_file_name = "bench_data.txt"
+    stages = {}
+    try:
+        source = FrameSource(dbc_ids, load=args.load, seed=args.seed)
+        batches, stages["receive"] = bench_receive(source, args.frames, args.batch)
+        print("{:10} {:>10.0f} frames/s".format("receive", stages["receive"]["frames_per_s"]))
+        frames = stages["receive"]["frames"]
+        dict_batches = [to_dicct_batch(batch) for batch in batches]
+
+        writer = binary_log.SegmentWriter("bench_data")
+        stage_funcs = [
+            ("to_dicct", to_dicct_batch, batches),
+            ("save_txt", save_txt_batch, dict_batches),
+            ("decode", decode_batch, batches),
+            ("write_bin", writer.write_frames, batches),
+        ]
+        for name, func, inputs in stage_funcs:
+            stages[name] = stage_result(frames, time_stage(func, inputs))
+            if args.alloc:
+                #a few batches are enough for the allocation pattern
+                stages[name]["alloc_bytes_per_frame"] = alloc_per_frame(
+                    func, inputs[:args.alloc_batches], sum(len(b) for b in inputs[:args.alloc_batches]))
+            print("{:10} {:>10.0f} frames/s".format(name, stages[name]["frames_per_s"]))
+        writer.close()
+
+        stages["pipeline"] = bench_pipeline(source, args.frames, args.batch, dbc_ids)
+        print("{:10} {:>10.0f} frames/s".format("pipeline", stages["pipeline"]["frames_per_s"]))
+        source.close()
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print("data files kept in {}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "version": git_version(),
+        "timestamp": general_file_functions.timestamp("file"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"frames": args.frames, "batch": args.batch, "load": args.load,
+                     "dbc": os.path.basename(args.dbc), "seed": args.seed},
+        "stages": stages,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def compare(result, old, keys=("frames_per_s", "p50_ms", "p99_ms", "alloc_bytes_per_frame")):
+    # change in percent per stage, positive frames/s and negative ms / bytes are better
+    print("compared to {} ({})".format(old.get("version"), old.get("timestamp")))
+    print("{:10} {:>22} {:>22} {:>22} {:>22}".format("stage", *keys))
+    for name, stage in result["stages"].items():
+        old_stage = old.get("stages", {}).get(name)
+        if not old_stage:
+            continue
+        cells = []
+        for key in keys:
+            if key in stage and old_stage.get(key):
+                cells.append("{:.4g} ({:+.1f}%)".format(stage[key], (stage[key] / old_stage[key] - 1) * 100))
+            else:
+                cells.append("-")
+        print("{:10} {:>22} {:>22} {:>22} {:>22}".format(name, *cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="throughput and latency of the logging pipeline")
+    parser.add_argument("--frames", type=int, default=50000, help="frames per stage")
+    parser.add_argument("--batch", type=int, default=500, help="frames per CanReceive call")
+    parser.add_argument("--load", type=float, default=1.0, help="bus load of the virtual bus (1000 kbit/s)")
+    parser.add_argument("--dbc", default=os.path.join(BASE_DIR, "CANoe_C23.dbc"))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-alloc", dest="alloc", action="store_false", help="skip the tracemalloc pass")
+    parser.add_argument("--alloc-batches", type=int, default=10)
+    parser.add_argument("--output", help="result file, default benchmarks/results/pipeline_<timestamp>.json")
+    parser.add_argument("--compare", help="older result file to compare with")
+    parser.add_argument("--keep", action="store_true", help="keep the written data files")
+    args = parser.parse_args()
+
+    result = run(args)
+    output = args.output
+    if not output:
+        os.makedirs(RESULT_DIR, exist_ok=True)
+        output = os.path.join(RESULT_DIR, "pipeline_{}.json".format(result["timestamp"]))
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print("peak rss {} kB, results in {}".format(result["peak_rss_kb"], output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,3 +4,4 @@ from . import baseOptionParser
 from . import mhsTinyCanDriver as tiny_can
 
 from . import utils
+from . import virtualTinyCan
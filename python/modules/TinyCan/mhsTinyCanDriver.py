@@ -62,10 +62,14 @@ MhsTinyCanDriver V1.00, 04.12.2015 (LGPL)
 P.Menschel (menschel.p@posteo.de)
 K.Demlehner (klaus@mhs-elektronik.de)
 """
-from ctypes import Structure,c_char,c_int,c_uint8,c_int32,c_uint32,c_char_p,c_uint16,c_void_p,pointer,Union,POINTER,string_at,cast,byref
+from ctypes import Structure,c_char,c_int,c_uint8,c_int32,c_uint32,c_char_p,c_uint16,c_void_p,pointer,Union,POINTER,string_at,cast,byref,Array
 import os
 import sys
 import time
+try:
+    import numpy as np
+except ImportError:
+    np = None   # TransmitBatch then takes TCanMsg arrays only
 from .import uselogging
 from .utils import OptionDict2CsvString,UpdateOptionDict,CsvString2OptionDict
 
@@ -228,6 +232,17 @@ EVENT_DISABLE_RX_FILTER_MESSAGES    = 0x0400 # Disable CAN Receive Event for Fil
 EVENT_DISABLE_RX_MESSAGES           = 0x0800 # Disable CAN Receive Event
 EVENT_DISABLE_ALL                   = 0xFF00 # Disable all Events
 
+# Index Bits, see TIndexBits
+INDEX_FIFO_PUFFER_MASK  = 0x0000FFFF # Sub Index, 0 = FIFO, >0 = Filter / Buffer
+INDEX_CAN_KANAL_MASK    = 0x000F0000 # CAN Channel
+INDEX_CAN_DEVICE_MASK   = 0x00F00000 # CAN Device
+INDEX_RXD_TXT_FLAG      = 0x01000000 # 0 = RX, 1 = TX
+INDEX_SOFT_FLAG         = 0x02000000 # Software FIFO / Filter
+
+# EX-API Events
+MHS_EVENT_RX            = 0x00000001 # Event Bit used for RX FIFOs
+MHS_TERMINATE           = 0x80000000 # CanExWaitForEvent returns on Driver Shutdown
+
 # Global Options Dictionary for TCAN API
 
 TCAN_Options = {'CanRxDFifoSize':None,
@@ -364,6 +379,38 @@ class TCanMsg(Structure):
         self.Sec=0
         self.USec=0
 
+# TCanMsg as numpy structured array, same memory layout (24 bytes)
+if np is not None:
+    TCANMSG_DTYPE = np.dtype([('Id', '<u4'), ('Flags', '<u4'), ('Data', 'u1', (8,)), ('Sec', '<u4'), ('USec', '<u4')])
+else:
+    TCANMSG_DTYPE = None
+
+# flag bits that make sense for a transmitted message: DLC, RTR, EFF
+TX_FLAGS_MASK = 0xCF
+
+def CheckTxFrames(msgs, count=None):
+    """
+    Check DLC and Id range of a TCanMsg array, vectorized if numpy is there
+    @param msgs: TCanMsg array
+    @param count: number of messages to check, default all
+    @return: index of the first invalid message or None
+    """
+    if count is None:
+        count = len(msgs)
+    if np is not None:
+        frames = np.frombuffer(msgs, dtype=TCANMSG_DTYPE, count=count)
+        flags = frames['Flags']
+        ids = frames['Id']
+        bad = ((flags & 0x0F) > 8) | np.where(flags & 0x80, ids > 0x1FFFFFFF, ids > 0x7FF)
+        if bad.any():
+            return int(np.argmax(bad))
+        return None
+    words = memoryview(msgs).cast('B').cast('I')
+    for i, (msgId, flags) in enumerate(zip(words[0:count * 6:6], words[1:count * 6:6])):
+        if (flags & 0x0F) > 8 or msgId > (0x1FFFFFFF if flags & 0x80 else 0x7FF):
+            return i
+    return None
+
 class TMsgFilterFlagsBits(Structure):
     _fields_ = [('DLC',c_uint8,4),#4bit
                 ('Reserved1',c_uint8,2),#2bit
@@ -413,6 +460,67 @@ class TMsgFilter(Structure):
         self.Code=0
         self.Flags.Uint32=0
 
+# --------------------------------------------------------------------
+# ------------------ API Prototypes ----------------------------------
+# --------------------------------------------------------------------
+# bound once when the library is loaded, name: (restype, argtypes)
+# message / struct pointers are c_void_p so arrays, pointer() and byref() all work
+# argtypes None -> not checked (callbacks and the CanExGetAs/SetAs functions with varying types)
+API_PROTOTYPES = {
+    'CanInitDriver':             (c_int32, [c_char_p]),
+    'CanDownDriver':             (None, []),
+    'CanSetOptions':             (c_int32, [c_char_p]),
+    'CanDeviceOpen':             (c_int32, [c_uint32, c_char_p]),
+    'CanDeviceClose':            (c_int32, [c_uint32]),
+    'CanSetMode':                (c_int32, [c_uint32, c_uint8, c_uint16]),
+    'CanTransmit':               (c_int32, [c_uint32, c_void_p, c_int32]),
+    'CanTransmitClear':          (None, [c_uint32]),
+    'CanTransmitGetCount':       (c_uint32, [c_uint32]),
+    'CanTransmitSet':            (c_int32, [c_uint32, c_uint16, c_uint32]),
+    'CanReceive':                (c_int32, [c_uint32, c_void_p, c_int32]),
+    'CanReceiveClear':           (None, [c_uint32]),
+    'CanReceiveGetCount':        (c_uint32, [c_uint32]),
+    'CanSetSpeed':               (c_int32, [c_uint32, c_uint16]),
+    'CanSetSpeedUser':           (c_int32, [c_uint32, c_uint32]),
+    'CanDrvInfo':                (c_char_p, []),
+    'CanDrvHwInfo':              (c_char_p, [c_uint32]),
+    'CanSetFilter':              (c_int32, [c_uint32, c_void_p]),
+    'CanGetDeviceStatus':        (c_int32, [c_uint32, c_void_p]),
+    'CanSetEvents':              (c_int32, [c_uint16]),
+    'CanEventStatus':            (c_uint32, []),
+    'CanSetPnPEventCallback':    (c_int32, None),
+    'CanSetStatusEventCallback': (c_int32, None),
+    'CanSetRxEventCallback':     (c_int32, None),
+    'CanExGetDeviceCount':       (c_int32, [c_int32]),
+    'CanExCreateDevice':         (c_int32, [POINTER(c_uint32), c_char_p]),
+    'CanExDestroyDevice':        (c_int32, [POINTER(c_uint32)]),
+    'CanExCreateFifo':           (c_int32, [c_uint32, c_uint32, c_void_p, c_uint32, c_uint32]),
+    'CanExBindFifo':             (c_int32, [c_uint32, c_uint32, c_uint32]),
+    'CanExCreateEvent':          (c_void_p, []),
+    'CanExSetObjEvent':          (c_int32, [c_uint32, c_uint32, c_void_p, c_uint32]),
+    'CanExSetEvent':             (None, [c_void_p, c_uint32]),
+    'CanExSetEventAll':          (None, [c_uint32]),
+    'CanExResetEvent':           (None, [c_void_p, c_uint32]),
+    'CanExWaitForEvent':         (c_uint32, [c_void_p, c_uint32]),
+    'CanExInitDriver':           (c_int32, [c_char_p]),
+    'CanExSetOptions':           (c_int32, [c_uint32, c_char_p]),
+    'CanExSetAsByte':            (c_int32, None),
+    'CanExSetAsWord':            (c_int32, None),
+    'CanExSetAsLong':            (c_int32, None),
+    'CanExSetAsUByte':           (c_int32, None),
+    'CanExSetAsUWord':           (c_int32, None),
+    'CanExSetAsULong':           (c_int32, None),
+    'CanExSetAsString':          (c_int32, None),
+    'CanExGetAsByte':            (c_int32, None),
+    'CanExGetAsWord':            (c_int32, None),
+    'CanExGetAsLong':            (c_int32, None),
+    'CanExGetAsUByte':           (c_int32, None),
+    'CanExGetAsUWord':           (c_int32, None),
+    'CanExGetAsULong':           (c_int32, None),
+    'CanExGetAsString':          (c_int32, None),
+    'CanExDataFree':             (None, None),
+}
+
 # --------------------------------------------------------------------
 # ------------------ Driver Class ------------------------------------
 # --------------------------------------------------------------------
@@ -429,24 +537,28 @@ class MhsTinyCanDriver:
                CAN_1M_BIT
                ]
 
-    def __init__(self, dll=None, options=None, ex_mode=1):
+    def __init__(self, dll=None, options=None, ex_mode=1, rx_fifo_size=16384):
         """
         Class Constructor
-        @param dll: path to dll / shared library
+        @param dll: path to dll / shared library or a library object (e.g. virtualTinyCan.VirtualTinyCanLibrary)
         @param options: dictionary of options to be set
+        @param rx_fifo_size: size of the receive fifo (frames) of the default device
         @return: nothing
         """
         self.logger = uselogging.getLogger()
         self.DefaultIndex = TIndex() #default FIFO Index 0        
         self.Options = TCAN_Options
         self.ExMode = ex_mode
+        self.RxFifoSize = rx_fifo_size
         self.TCDriverProperties = {}
         self.TCDeviceProperties = {}#no multidevice support yet
         if options:
             self.Options.update(options)
         self.so = None
         if dll:
-            if sys.platform == "win32":
+            if type(dll) != str:
+                self.so = dll   # library already loaded or a stand-in like virtualTinyCan
+            elif sys.platform == "win32":
                 self.so = WinDLL(dll)
             else:
                 self.so = CDLL(dll)                            
@@ -469,13 +581,13 @@ class MhsTinyCanDriver:
                     pass
         if not self.so:
             raise RuntimeError('library not found: ' + sharedLibrary)                      
+        self.BindApi()
         err = self.initDriver(self.Options)
         if ex_mode == 1 and err == 0:
-             res = self.CanExCreateDevice(options = 'CanRxDFifoSize=16384')
-             if res:
-                 self.DefaultIndex = res[0]
-             err = res;    
-        if err[0] < 0:
+             err, idx = self.CanExCreateDevice(options = 'CanRxDFifoSize={0}'.format(rx_fifo_size))
+             if err >= 0:
+                 self.DefaultIndex = idx
+        if err < 0:
             raise NotImplementedError('Device Init Failed')      
 
     # ----------------------------------------------------------------
@@ -737,6 +849,41 @@ class MhsTinyCanDriver:
             self.logger.error('TransmitData Error-Code: {0}'.format(err))              
         return err   
                   
+    def TransmitBatch(self, frames, index=None, count=None):
+        """
+        High Level Function to transmit many CAN Messages with one CanTransmit call
+        @param frames: TCanMsg array or numpy structured array with TCANMSG_DTYPE
+        @param index: Struct commonly used by the Tiny Can API, None for the default index
+        @param count: number of messages to send, default all
+        @return: number of messages written to the tx fifo or Error Code, number of messages waiting in the tx fifo
+        """
+        idx = self.IndexValue(index)
+        if np is not None and isinstance(frames, np.ndarray):
+            if frames.dtype != TCANMSG_DTYPE:
+                self.logger.error('TransmitBatch: dtype {0} expected but got {1}'.format(TCANMSG_DTYPE, frames.dtype))
+                raise ValueError('dtype {0} expected but got {1}'.format(TCANMSG_DTYPE, frames.dtype))
+            frames = np.require(frames, requirements=['C', 'W'])
+            msgs = (TCanMsg * len(frames)).from_buffer(frames)
+        elif isinstance(frames, Array) and frames._type_ is TCanMsg:
+            msgs = frames
+        else:
+            self.logger.error('TransmitBatch: TCanMsg array expected but got {0}'.format(type(frames)))
+            raise ValueError('TCanMsg array expected but got {0} instead'.format(type(frames)))
+        if count is None or count > len(msgs):
+            count = len(msgs)
+        if count == 0:
+            return 0, self._CanTransmitGetCount(idx)
+        bad = CheckTxFrames(msgs, count)
+        if bad is not None:
+            self.logger.error('TransmitBatch: invalid message {0} (Id {1:#x}, Flags {2:#x})'.format(
+                bad, msgs[bad].Id, msgs[bad].Flags.Uint32))
+            raise ValueError('invalid message {0}: Id {1:#x} / DLC {2}'.format(
+                bad, msgs[bad].Id, msgs[bad].Flags.FlagBits.DLC))
+        res = self._CanTransmit(idx, msgs, count)
+        if res < 0:
+            self.logger.error('TransmitBatch Error-Code: {0}'.format(res))
+        return res, self._CanTransmitGetCount(idx)
+
     def SetIntervalMessage(self, index, msgId=None, msgData=None, msgLen=None, rtr=0, eff=0, interval=-1):
         """
         High Level Function to transmit a CAN Message in given Interval
@@ -772,12 +919,12 @@ class MhsTinyCanDriver:
         if index == None:
             raise ValueError('index is required')                   
         filterFlags = TMsgFilterFlags()
-        if msgIdMask:
+        if msgIdMask != None:
             filterFlags.FlagBits.IdMode = 0   # Mask (msgIdMask) & Code (msgId)
             code = msgId
             mask = msgIdMask
         else:
-            if msgIdStart:                
+            if msgIdStart != None:                
                 filterFlags.FlagBits.IdMode = 1   # Start (msgIdStart) & Stop (msgIdStp)
                 code = msgIdStart 
                 mask = msgIdStop 
@@ -808,6 +955,98 @@ class MhsTinyCanDriver:
         return err
 
 
+    def BindApi(self):
+        """
+        Set restype / argtypes of all library functions once (see API_PROTOTYPES)
+        @return: list of the functions missing in the library
+        """
+        self.Api = {}
+        missing = []
+        for name, (restype, argtypes) in API_PROTOTYPES.items():
+            func = getattr(self.so, name, None)
+            if func is None:
+                missing.append(name)
+                continue
+            func.restype = restype
+            if argtypes is not None:
+                func.argtypes = argtypes
+            self.Api[name] = func
+        if missing:
+            self.logger.info('library without {0}'.format(', '.join(missing)))
+        self._CanReceive = self.Api.get('CanReceive')
+        self._CanReceiveGetCount = self.Api.get('CanReceiveGetCount')
+        self._CanTransmit = self.Api.get('CanTransmit')
+        self._CanTransmitGetCount = self.Api.get('CanTransmitGetCount')
+        return missing
+
+    def IndexValue(self, index=None):
+        """
+        Index as plain integer for the fast path functions
+        @param index: TIndex, int or None for the default index
+        @return: index as int
+        """
+        if index is None:
+            index = self.DefaultIndex
+        if type(index) == TIndex:
+            return index.Uint32
+        return index
+
+    # ----------------------------------------------------------------
+    # ---- Fast Path ---------------------------------------------------
+    # ----------------------------------------------------------------
+    # for the rx callback / rx threads: idx has to be an int (IndexValue),
+    # no type checks and no logging, errors are only returned
+
+    def CanReceiveFast(self, idx, count):
+        """
+        Fast path of CanReceive
+        @param idx: index as int
+        @param count: maximal number of messages to read
+        @return: number of messages or Error Code, TCanMsg array (None if nothing was read)
+        """
+        num = self._CanReceiveGetCount(idx)
+        if num == 0:
+            return 0, None
+        if num < count:
+            count = num
+        msgs = (TCanMsg * count)()
+        res = self._CanReceive(idx, msgs, count)
+        if res < 0:
+            return res, None
+        return res, msgs
+
+    def CanReceiveInto(self, idx, msgs, count=None):
+        """
+        Read into a preallocated TCanMsg array, the next call overwrites the messages.
+        Copy them (e.g. (TCanMsg * n).from_buffer_copy(msgs)) before handing them to the
+        router or the merger, both keep references to the frames
+        @param idx: index as int
+        @param msgs: TCanMsg array
+        @param count: number of messages to read, default len(msgs)
+        @return: number of messages or Error Code
+        """
+        if count is None:
+            count = len(msgs)
+        return self._CanReceive(idx, msgs, count)
+
+    def CanReceiveGetCountFast(self, idx):
+        """
+        Fast path of CanReceiveGetCount
+        @param idx: index as int
+        @return: number of messages in the fifo
+        """
+        return self._CanReceiveGetCount(idx)
+
+    def CanTransmitFast(self, idx, msgs, count):
+        """
+        Transmit a TCanMsg array with one call
+        @param idx: index as int
+        @param msgs: TCanMsg array (or a single TCanMsg with count 1)
+        @param count: number of messages
+        @return: number of messages written to the tx fifo or Error Code
+        """
+        return self._CanTransmit(idx, msgs, count)
+
     # ----------------------------------------------------------------
     # ---- API CALLS --------------------------- ---------------------
     # ----------------------------------------------------------------
@@ -818,7 +1057,6 @@ class MhsTinyCanDriver:
         @param options: Option String - ByteString in Python3
         @return: Error Code (0 = No Error)
         """
-        self.so.CanInitDriver.restype = c_int32
         err = self.so.CanInitDriver(c_char_p(options))
         if err < 0:
             self.logger.error('CanInitDriver Error-Code: {0}'.format(err))
@@ -838,7 +1076,6 @@ class MhsTinyCanDriver:
         @param options: Option String - ByteString in Python3
         @return: Error Code (0 = No Error)
         """
-        self.so.CanSetOptions.restype = c_int32
         err = self.so.CanSetOptions(c_char_p(options))
         if err < 0:
             self.logger.error('CanSetOptions Error-Code: {0}'.format(err))
@@ -855,7 +1092,6 @@ class MhsTinyCanDriver:
             idx = index.Uint32
         else:
             idx = index
-        self.so.CanDeviceOpen.restype = c_int32    
         err = self.so.CanDeviceOpen(c_uint32(idx), c_char_p(options))
         if err < 0:
             self.logger.error('CanDeviceOpen Error-Code: {0}'.format(err))
@@ -873,7 +1109,6 @@ class MhsTinyCanDriver:
             idx = index.Uint32
         else:
             idx = index
-        self.so.CanDeviceClose.restype = c_int32    
         err = self.so.CanDeviceClose(c_uint32(idx))
         if err < 0:
             self.logger.error('CanDeviceClose Error-Code: {0}'.format(err))
@@ -893,7 +1128,6 @@ class MhsTinyCanDriver:
             idx = index.Uint32
         else:
             idx = index
-        self.so.CanSetMode.restype = c_int32    
         err = self.so.CanSetMode(c_uint32(idx), c_uint8(mode), c_uint16(flags)) 
         if err < 0:
             self.logger.error('CanSetMode Error-Code: {0}'.format(err))
@@ -917,7 +1151,6 @@ class MhsTinyCanDriver:
         canMSG.Id = c_uint32(msgId)
         for i,b in enumerate(msgData):
             canMSG.Data[i] = b
-        self.so.CanTransmit.restype = c_int32    
         err = self.so.CanTransmit(c_uint32(idx), pointer(canMSG), c_int(1)) # transmit once
         if err < 0:
             self.logger.error('CanTransmit Error-Code: {0}'.format(err))
@@ -950,7 +1183,6 @@ class MhsTinyCanDriver:
             idx = index.Uint32
         else:
             idx = index
-        self.so.CanTransmitGetCount.restype = c_uint32    
         num = self.so.CanTransmitGetCount(c_uint32(idx))        
         return num
         
@@ -968,7 +1200,6 @@ class MhsTinyCanDriver:
         else:
             idx = index
         usecs = int(interval * 1000)
-        self.so.CanTransmitSet.restype = c_int32
         err = self.so.CanTransmitSet(c_uint32(idx), c_uint16(flags), c_uint32(usecs))
         if err < 0:
             self.logger.error('CanTransmitSet Error-Code: {0}'.format(err))
@@ -988,7 +1219,6 @@ class MhsTinyCanDriver:
         else:
             idx = index
         res = 0    
-        self.so.CanReceiveGetCount.restype = c_uint32    
         num = self.so.CanReceiveGetCount(c_uint32(idx))
         if num == 0:    
             TCanMsgArray = None
@@ -997,7 +1227,6 @@ class MhsTinyCanDriver:
                 count = num;           
             TCanMsgArrayType = TCanMsg * count # Struct of multiple TCANMsg Instances without using Python List object
             TCanMsgArray = TCanMsgArrayType()
-            self.so.CanReceive.restype = c_int32
             res = self.so.CanReceive(c_uint32(idx), pointer(TCanMsgArray), count)
         if res < 0:
             self.logger.info('CanReceive, Error-Code: {0}'.format(num))
@@ -1031,7 +1260,6 @@ class MhsTinyCanDriver:
             idx = index.Uint32
         else:
             idx = index
-        self.so.CanReceiveGetCount.restype = c_uint32
         num = self.so.CanReceiveGetCount(c_uint32(idx))        
         return num
         
@@ -1046,7 +1274,6 @@ class MhsTinyCanDriver:
             idx = index.Uint32
         else:
             idx = index
-        self.so.CanSetSpeed.restype = c_int32     
         err = self.so.CanSetSpeed(c_uint32(idx), c_uint16(speed))
         if err < 0:
             self.logger.error('CanSetSpeed Error-Code: {0}'.format(err))        
@@ -1063,7 +1290,6 @@ class MhsTinyCanDriver:
             idx = index.Uint32
         else:
             idx = index
-        self.so.CanSetSpeedUser.restype = c_int32    
         err = self.so.CanSetSpeedUser(c_uint32(idx), c_uint32(value))
         if err < 0:
             self.logger.error('CanSetSpeedUser Error-Code: {0}'.format(err))        
@@ -1074,7 +1300,6 @@ class MhsTinyCanDriver:
         API CALL - Get Driver Information from DLL / Shared Library
         @return: Version String of DLL / Shared Library
         """        
-        self.so.CanDrvInfo.restype = c_char_p
         return self.so.CanDrvInfo()
         
     def CanDrvHwInfo(self, index=None):
@@ -1088,7 +1313,6 @@ class MhsTinyCanDriver:
             idx = index.Uint32
         else:
             idx = index
-        self.so.CanDrvHwInfo.restype = c_char_p
         return self.so.CanDrvHwInfo(c_uint32(idx))    
     
     def CanSetFilter(self, index, mask, code, flags):
@@ -1115,7 +1339,6 @@ class MhsTinyCanDriver:
         canMSGFilter.Mask = mask
         canMSGFilter.Code = code
         canMSGFilter.Flags.Uint32 = flags
-        self.so.CanSetFilter.restype = c_int32
         err = self.so.CanSetFilter(c_uint32(idx), pointer(canMSGFilter))
         if err  < 0:
             self.logger.error('CanSetFilter Error-Code: {0}'.format(err))
@@ -1133,7 +1356,6 @@ class MhsTinyCanDriver:
         else:
             idx = index
         devSTAT = TDeviceStatus()
-        self.so.CanGetDeviceStatus.restype = c_int32
         err = self.so.CanGetDeviceStatus(c_uint32(idx), pointer(devSTAT))
         if err < 0:
             self.logger.error('CanGetDeviceStatus Error-Code: {0}'.format(err))
@@ -1160,7 +1382,6 @@ class MhsTinyCanDriver:
         @param events: event mask to be set
         @return: Error Code (0 = No Error)        
         """
-        self.so.CanEventStatus.restype = c_uint32
         err = self.so.CanEventStatus()      
         return err
 
@@ -1246,7 +1467,6 @@ class MhsTinyCanDriver:
     # ----------------------------------------------------------------
     
     def CanExGetDeviceCount(self, flags):
-        self.so.CanExGetDeviceCount.restype = c_int32
         err = self.so.CanExGetDeviceCount(c_int32(flags))
         if err < 0:
             self.logger.error('CanExGetDeviceCount Error-Code: {0}'.format(err))
@@ -1258,40 +1478,38 @@ class MhsTinyCanDriver:
 
     def CanExCreateDevice(self, options = None):
         idx = c_uint32(0)
-        self.so.CanExCreateDevice.restype = c_int32
         err = self.so.CanExCreateDevice(byref(idx), c_char_p(options.encode()))
         if err < 0:
             self.logger.error('CanExCreateDevice Error-Code: {0}'.format(err))          
         return err, idx.value        
         
     def CanExDestroyDevice(self, index):
-        idx = c_uint32(indx)  
-        self.so.CanExDestroyDevice.restype = c_int32        
+        if type(index) == TIndex:
+            idx = c_uint32(index.Uint32)
+        else:
+            idx = c_uint32(index)
         err = self.so.CanExDestroyDevice(byref(idx))
         if err < 0:
             self.logger.error('CanExDestroyDevice Error-Code: {0}'.format(err))
         return err        
     
-    def CanExCreateFifo(self, size, event_obj, event, channels):
+    def CanExCreateFifo(self, index, size, event_obj=None, event=0, channels=0xFFFFFFFF):
         if type(index) == TIndex:
             idx = index.Uint32
         else:
             idx = index  
-        self.so.CanExCreateFifo.restype = c_int32  
         err = self.so.CanExCreateFifo(c_uint32(idx), c_uint32(size), c_void_p(event_obj), c_uint32(event), c_uint32(channels))
         if err < 0:
             self.logger.error('CanExCreateFifo Error-Code: {0}'.format(err))
         return err
 
     def CanExBindFifo(self, fifo_index, device_index, bind):
-        self.so.CanExBindFifo.restype = c_int32
         err = self.so.CanExBindFifo(c_uint32(fifo_index), c_uint32(device_index), c_uint32(bind))
         if err < 0:
             self.logger.error('CanExBindFifo Error-Code: {0}'.format(err))
         return err        
 
     def CanExCreateEvent(self):
-        self.so.CanExCreateEvent.restype = c_void_p    
         event_obj = self.so.CanExCreateEvent()
         return event_obj;
 
@@ -1300,8 +1518,7 @@ class MhsTinyCanDriver:
             idx = index.Uint32
         else:
             idx = index
-        self.so.CanExSetObjEvent.restype = c_int32 
-        self.so.CanExSetObjEvent(c_uint32(idx), c_uint32(source), c_void_p(event_obj), c_uint32(event))
+        err = self.so.CanExSetObjEvent(c_uint32(idx), c_uint32(source), c_void_p(event_obj), c_uint32(event))
         if err < 0:
             self.logger.error('CanExSetObjEvent Error-Code: {0}'.format(err))
         return err
@@ -1319,12 +1536,10 @@ class MhsTinyCanDriver:
         return
     
     def CanExWaitForEvent(self, event_obj, timeout):   
-        self.so.CanExWaitForEvent.restype = c_uint32
-        events = CanExWaitForEvent(c_void_p(event_obj), c_uint32(timeout))
+        events = self.so.CanExWaitForEvent(c_void_p(event_obj), c_uint32(timeout))
         return events
 
     def CanExInitDriver(self, options = None):
-        self.so.CanExInitDriver.restype = c_int32
         err = self.so.CanExInitDriver(c_char_p(options))
         if err < 0:
             self.logger.error('CanExInitDriver Error-Code: {0}'.format(err))
@@ -1337,7 +1552,6 @@ class MhsTinyCanDriver:
             idx = index
         if name == None:
             raise ValueError('name is required')    
-        self.so.CanExSetOptions.restype = c_int32
         err = self.so.CanExSetOptions(c_uint32(idx), c_char_p(options))
         if err < 0:
             self.logger.error('CanExSetOptions Error-Code: {0}'.format(err))
@@ -1350,7 +1564,6 @@ class MhsTinyCanDriver:
             idx = index    
         if name == None:
             raise ValueError('name is required')    
-        self.so.CanExSetAsByte.restype = c_int32
         err = self.so.CanExSetAsByte(c_uint32(idx), c_char_p(name), c_char(value))
         if err < 0:
             self.logger.error('CanExSetAsByte Error-Code: {0}'.format(err))
@@ -1363,7 +1576,6 @@ class MhsTinyCanDriver:
             idx = index    
         if name == None:
             raise ValueError('name is required')            
-        self.so.CanExSetAsWord.restype = c_int32
         err = self.so.CanExSetAsWord(c_uint32(idx), c_char_p(name), c_uint8(value))
         if err < 0:
             self.logger.error('CanExSetAsWord Error-Code: {0}'.format(err))
@@ -1376,7 +1588,6 @@ class MhsTinyCanDriver:
             idx = index    
         if name == None:
             raise ValueError('name is required')            
-        self.so.CanExSetAsLong.restype = c_int32
         err = self.so.CanExSetAsLong(c_uint32(idx), c_char_p(name), c_int32(value))
         if err < 0:
             self.logger.error('CanExSetAsLong Error-Code: {0}'.format(err))
@@ -1389,7 +1600,6 @@ class MhsTinyCanDriver:
             idx = index    
         if name == None:
             raise ValueError('name is required')            
-        self.so.CanExSetAsUByte.restype = c_int32
         err = self.so.CanExSetAsUByte(c_uint32(idx), c_char_p(name), c_uint8(value))
         if err < 0:
             self.logger.error('CanExSetAsUByte Error-Code: {0}'.format(err))
@@ -1402,7 +1612,6 @@ class MhsTinyCanDriver:
             idx = index    
         if name == None:
             raise ValueError('name is required')            
-        self.so.CanExSetAsUWord.restype = c_int32        
         err = self.so.CanExSetAsUWord(c_uint32(idx), c_char_p(name), c_uint16(value))
         if err < 0:
             self.logger.error('CanExSetAsUWord Error-Code: {0}'.format(err))
@@ -1415,7 +1624,6 @@ class MhsTinyCanDriver:
             idx = index    
         if name == None:
             raise ValueError('name is required')            
-        self.so.CanExSetAsULong.restype = c_int32        
         err = self.so.CanExSetAsULong(c_uint32(idx), c_char_p(name), c_uint32(value))
         if err < 0:
             self.logger.error('CanExSetAsULong Error-Code: {0}'.format(err))
@@ -1428,7 +1636,6 @@ class MhsTinyCanDriver:
             idx = index    
         if name == None:
             raise ValueError('name is required')            
-        self.so.CanExSetAsString.restype = c_int32        
         err = self.so.CanExSetAsString(c_uint32(idx), c_char_p(name), c_char_p(value))
         if err < 0:
             self.logger.error('CanExSetAsString Error-Code: {0}'.format(err))
@@ -1442,7 +1649,6 @@ class MhsTinyCanDriver:
         if name == None:
             raise ValueError('name is required')        
         value = c_char(0)        
-        self.so.CanExGetAsByte.restype = c_int32                
         err = self.so.CanExGetAsByte(c_uint32(idx), c_char_p(name), byref(value))
         if err < 0:
             self.logger.error('CanExGetAsByte Error-Code: {0}'.format(err))
@@ -1456,7 +1662,6 @@ class MhsTinyCanDriver:
         if name == None:
             raise ValueError('name is required')        
         value = c_int16(0)        
-        self.so.CanExGetAsWord.restype = c_int32                
         err = self.so.CanExGetAsWord(c_uint32(idx), c_char_p(name), byref(value))
         if err < 0:
             self.logger.error('CanExGetAsWord Error-Code: {0}'.format(err))
@@ -1470,7 +1675,6 @@ class MhsTinyCanDriver:
         if name == None:
             raise ValueError('name is required')
         value = c_int32(0)                
-        self.so.CanExGetAsLong.restype = c_int32                
         err = self.so.CanExGetAsLong(c_uint32(idx), c_char_p(name), byref(value))
         if err < 0:
             self.logger.error('CanExGetAsLong Error-Code: {0}'.format(err))
@@ -1484,7 +1688,6 @@ class MhsTinyCanDriver:
         if name == None:
             raise ValueError('name is required')
         value = c_uint8(0)                
-        self.so.CanExGetAsUByte.restype = c_int32        
         err = self.so.CanExGetAsUByte(c_uint32(idx), c_char_p(name), byref(value))
         if err < 0:
             self.logger.error('CanExGetAsUByte Error-Code: {0}'.format(err))
@@ -1498,7 +1701,6 @@ class MhsTinyCanDriver:
         if name == None:
             raise ValueError('name is required')
         value = c_uint16(0)                
-        self.so.CanExGetAsUWord.restype = c_int32        
         err = self.so.CanExGetAsUWord(c_uint32(idx), c_char_p(name), byref(value))
         if err < 0:
             self.logger.error('CanExGetAsUWord Error-Code: {0}'.format(err))
@@ -1512,7 +1714,6 @@ class MhsTinyCanDriver:
         if name == None:
             raise ValueError('name is required')            
         value = c_uint32(0)    
-        self.so.CanExGetAsULong.restype = c_int32        
         err = self.so.CanExGetAsULong(c_uint32(idx), c_char_p(name), byref(value))
         if err < 0:
             self.logger.error('CanExGetAsULong Error-Code: {0}'.format(err))
@@ -1526,7 +1727,6 @@ class MhsTinyCanDriver:
         if name == None:
             raise ValueError('name is required')            
         str = pointer(c_uint8(0))    
-        self.so.CanExGetAsString.restype = c_int32        
         err = self.so.CanExGetAsString(c_uint32(idx), c_char_p(name) , byref(str))
         if err < 0:
             self.logger.error('CanExGetAsString Error-Code: {0}'.format(err))
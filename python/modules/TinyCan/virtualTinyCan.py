@@ -0,0 +1,616 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Description
+#   Pure Python stand-in for the Tiny-CAN shared library (libmhstcan.so).
+#   VirtualTinyCanLibrary has the same functions as the library, so it can
+#   be handed to MhsTinyCanDriver instead of a library path:
+#
+#   >>> lib = VirtualTinyCanLibrary(traffic=bus_load_traffic([0x100, 0x200], load=0.5))
+#   >>> driver = MhsTinyCanDriver(dll=lib)
+#
+#   Every device simulates a bus with synthetic traffic: a list of cyclic
+#   messages (id, cycle time, dlc) or a bus load for a set of ids. In realtime
+#   mode a thread generates the frames as they would appear on the bus and
+#   fires the rx event callback, otherwise generate() fills the fifos with a
+#   given amount of bus time at once (benchmarks).
+#   Errors can be injected randomly (error_rate) or by hand (inject_error,
+#   inject_bus_off); a full rx fifo sets FIFO_STATUS_OVERRUN and counts the
+#   lost frames like the hardware would.
+#   Filters (CanSetFilter on a sub index) behave like the driver's message
+#   filters: a matching frame is copied into the buffer of the sub index,
+#   with Mode 0 it is taken out of the fifo, with Mode 1 it stays in it too.
+#   Frames that match no filter always go into the fifo, nothing is rejected.
+#
+# ----------------------------------------------------------------------
+
+import heapq
+import random
+import struct
+import threading
+import time
+from collections import deque
+from ctypes import Array, addressof, memmove, sizeof
+
+from .mhsTinyCanDriver import TCanMsg, TDeviceStatus, TMsgFilter, \
+    DRV_STATUS_INIT, DRV_STATUS_CAN_OPEN, DRV_STATUS_CAN_RUN, \
+    FIFO_STATUS_OK, FIFO_STATUS_OVERRUN, \
+    CAN_STATUS_OK, CAN_STATUS_WARNING, CAN_STATUS_ERROR, CAN_STATUS_BUS_OFF, \
+    OP_CAN_START, OP_CAN_STOP, OP_CAN_RESET, OP_CAN_LOM, OP_CAN_START_NO_RETRANS, \
+    CAN_CMD_RXD_OVERRUN_CLEAR, CAN_CMD_RXD_FIFOS_CLEAR, CAN_CMD_TXD_FIFOS_CLEAR, \
+    CAN_CMD_HW_FILTER_CLEAR, CAN_CMD_SW_FILTER_CLEAR, CAN_CMD_TXD_BUFFER_CLEAR, \
+    EVENT_ENABLE_RX_MESSAGES, EVENT_ENABLE_STATUS_CHANGE, \
+    INDEX_FIFO_PUFFER_MASK, INDEX_CAN_DEVICE_MASK, INDEX_RXD_TXT_FLAG, INDEX_SOFT_FLAG, \
+    MHS_EVENT_RX, MHS_TERMINATE, API_PROTOTYPES
+
+MSG = struct.Struct("<II8sII")      # TCanMsg: Id, Flags, Data, Sec, USec
+ERR_PARAM = -2
+ERR_INDEX = -3
+ERR_VAR_NOT_FOUND = -10
+
+
+def frame_bits(dlc, eff=0):
+    # bits of a data frame on the bus incl. about 10% stuff bits
+    return int(((67 if eff else 47) + 8 * dlc) * 1.1)
+
+
+def cyclic_traffic(messages):
+    # messages: list of (id, cycle_ms) or (id, cycle_ms, dlc) or (id, cycle_ms, dlc, eff)
+    traffic = []
+    for message in messages:
+        message = tuple(message) + (8, 0)[len(message) - 2:]
+        can_id, cycle_ms, dlc, eff = message[:4]
+        traffic.append({"id": can_id, "cycle": cycle_ms / 1000.0, "dlc": dlc, "eff": eff})
+    return traffic
+
+
+def bus_load_traffic(ids, load=1.0, bitrate=1000, dlc=8):
+    # spreads the given bus load (0..1 at bitrate kbit/s) evenly over the ids
+    traffic = []
+    frames_per_s = 0.0
+    for can_id in ids:
+        frames_per_s += 1.0 / frame_bits(dlc, can_id > 0x7FF)
+    frames_per_s *= load * bitrate * 1000 / len(ids)
+    cycle = len(ids) / frames_per_s
+    for can_id in ids:
+        traffic.append({"id": can_id, "cycle": cycle, "dlc": dlc, "eff": 1 if can_id > 0x7FF else 0})
+    return traffic
+
+
+class _ApiCall:
+    # library functions get restype/argtypes set by the driver, bound methods can't take attributes
+    def __init__(self, func):
+        self.func = func
+        self.restype = None
+        self.argtypes = None
+
+    def __call__(self, *args):
+        return self.func(*args)
+
+
+def _value(arg):
+    # c_uint32(...) and friends -> python value
+    return arg.value if hasattr(arg, "value") else arg
+
+
+def _target(arg):
+    # pointer(x) / byref(x) / x -> x
+    if hasattr(arg, "contents"):
+        return arg.contents
+    if hasattr(arg, "_obj"):
+        return arg._obj
+    return arg
+
+
+class VirtualDevice:
+    def __init__(self, lib, index):
+        self.lib = lib
+        self.index = index
+        self.fifo = deque()
+        self.fifo_size = lib.fifo_size
+        self.bound_fifos = []
+        self.filters = {}
+        #sub index -> buffer with the last frame that matched its filter
+        self.filter_buffers = {}
+        self.interval_msgs = {}
+        self.tx_fifo = deque()
+        self.open = 0
+        self.running = 0
+        self.listen_only = 0
+        self.can_status = CAN_STATUS_OK
+        self.fifo_status = FIFO_STATUS_OK
+        self.lost_frames = 0
+        self.rx_frames = 0
+        self.tx_frames = 0
+        self.error_frames = 0
+        self.bus_time = 0.0
+        self.schedule = []
+        for n, message in enumerate(lib.traffic):
+            heapq.heappush(self.schedule, (lib.rng.random() * message["cycle"], n))
+
+    def _device_time(self, bus_time):
+        # device clock with drift, Sec / USec of the frames
+        t_us = int(bus_time * (1.0 + self.lib.drift_ppm / 1e6) * 1e6) + self.lib.clock_offset_us
+        return t_us // 1000000, t_us % 1000000
+
+    def _payload(self, message, count):
+        if "data" in message:
+            return bytes(message["data"]).ljust(8, b"\0")
+        if self.lib.payload == "counter":
+            return (count & 0xFFFFFFFFFFFFFFFF).to_bytes(8, "little")
+        return self.lib.rng.getrandbits(64).to_bytes(8, "little")
+
+    def _matches(self, f, can_id, eff):
+        fl = f.Flags.FlagBits
+        if not fl.Enable or fl.EFF != eff:
+            return False
+        if fl.IdMode == 0:
+            return (can_id & f.Mask) == (f.Code & f.Mask)
+        if fl.IdMode == 1:
+            return f.Code <= can_id <= f.Mask
+        return fl.IdMode == 2 and can_id == f.Code
+
+    def _filter(self, record):
+        # copies the frame into the buffers of the matching filters, False if
+        # one of them takes it out of the fifo (Mode 0)
+        can_id = record[0]
+        eff = 1 if record[1] & 0x80 else 0
+        to_fifo = True
+        for sub_index, f in self.filters.items():
+            if self._matches(f, can_id, eff):
+                self.filter_buffers[sub_index] = deque([record], maxlen=1)
+                if f.Flags.FlagBits.Mode == 0:
+                    to_fifo = False
+        return to_fifo
+
+    def push(self, record):
+        self.rx_frames += 1
+        if self.filters and not self._filter(record):
+            return
+        for fifo in [self.fifo] + self.bound_fifos:
+            if len(fifo) >= self.fifo_size:
+                self.lost_frames += 1
+                if self.fifo_status != FIFO_STATUS_OVERRUN:
+                    self.fifo_status = FIFO_STATUS_OVERRUN
+                    self.lib._status_event(self)
+            else:
+                fifo.append(record)
+
+    def generate_until(self, bus_time):
+        # all frames of the traffic schedule up to bus_time (s), returns the number of frames
+        lib = self.lib
+        traffic = lib.traffic
+        produced = 0
+        while self.schedule and self.schedule[0][0] <= bus_time:
+            due, n = heapq.heappop(self.schedule)
+            message = traffic[n]
+            heapq.heappush(self.schedule, (due + message["cycle"], n))
+            if not self.running or self.can_status == CAN_STATUS_BUS_OFF:
+                continue
+            if lib.error_rate and lib.rng.random() < lib.error_rate:
+                self.error_frames += 1
+                lib._error_frame(self)
+                continue
+            dlc = message["dlc"]
+            flags = dlc | (0x80 if message["eff"] else 0)
+            sec, usec = self._device_time(due)
+            self.push((message["id"], flags, self._payload(message, self.rx_frames), sec, usec))
+            produced += 1
+        #interval messages of the hardware tx buffers
+        for sub_index, interval in list(self.interval_msgs.items()):
+            msg, period, next_due = interval
+            if period and self.running:
+                while next_due <= bus_time:
+                    self.tx_frames += 1
+                    next_due += period
+                self.interval_msgs[sub_index] = (msg, period, next_due)
+        self.tx_fifo.clear()
+        self.bus_time = bus_time
+        return produced
+
+
+class VirtualTinyCanLibrary:
+    def __init__(self, traffic=None, realtime=True, tick=0.001, fifo_size=16384, error_rate=0.0,
+                 payload="random", drift_ppm=0.0, clock_offset_us=0, seed=1):
+        # traffic: see cyclic_traffic / bus_load_traffic
+        self.traffic = traffic if traffic is not None else []
+        self.realtime = realtime
+        self.tick = tick
+        self.fifo_size = fifo_size
+        self.error_rate = error_rate
+        self.payload = payload
+        self.drift_ppm = drift_ppm
+        self.clock_offset_us = clock_offset_us
+        self.rng = random.Random(seed)
+        self.devices = {}
+        self.soft_fifos = {}
+        self.events = {}
+        self.event_mask = 0
+        self.rx_callback = None
+        self.status_callback = None
+        self.pnp_callback = None
+        self.options = {}
+        self.lock = threading.RLock()
+        self._thread = None
+        self._running = False
+        self._start_time = None
+        #same functions the driver binds from the real library
+        for name in API_PROTOTYPES:
+            setattr(self, name, _ApiCall(getattr(self, name)))
+
+    # ---------------- simulation control ----------------
+
+    def device(self, index=0):
+        index = _value(index) & INDEX_CAN_DEVICE_MASK
+        if index not in self.devices:
+            self.devices[index] = VirtualDevice(self, index)
+        return self.devices[index]
+
+    def generate(self, seconds):
+        # fills the fifos with the next seconds of bus traffic at once (non realtime mode)
+        produced = 0
+        with self.lock:
+            for device in self.devices.values():
+                produced += device.generate_until(device.bus_time + seconds)
+        if produced:
+            self._rx_event(produced)
+        return produced
+
+    def inject_error(self, can_status=CAN_STATUS_ERROR, index=0):
+        device = self.device(index)
+        device.can_status = can_status
+        self._status_event(device)
+
+    def inject_bus_off(self, index=0):
+        self.inject_error(CAN_STATUS_BUS_OFF, index)
+
+    def inject_overrun(self, index=0):
+        device = self.device(index)
+        device.fifo_status = FIFO_STATUS_OVERRUN
+        self._status_event(device)
+
+    def _error_frame(self, device):
+        #error counters are not simulated, a few errors in a row make the bus warning/error passive
+        if device.error_frames % 128 == 0:
+            device.can_status = CAN_STATUS_ERROR
+        elif device.error_frames % 16 == 0:
+            device.can_status = CAN_STATUS_WARNING
+        else:
+            return
+        self._status_event(device)
+
+    def _rx_event(self, count):
+        if self.rx_callback and self.event_mask & EVENT_ENABLE_RX_MESSAGES:
+            self.rx_callback(0, None, count)
+        for event_obj, fifos in list(self.events.items()):
+            if any(self.soft_fifos.get(f) for f in fifos["fifos"]):
+                self._set_event(event_obj, MHS_EVENT_RX)
+
+    def _status_event(self, device):
+        if self.status_callback and self.event_mask & EVENT_ENABLE_STATUS_CHANGE:
+            status = TDeviceStatus()
+            self._fill_status(device, status)
+            self.status_callback(device.index, status)
+
+    def _fill_status(self, device, status):
+        if device.running:
+            status.DrvStatus = DRV_STATUS_CAN_RUN
+        elif device.open:
+            status.DrvStatus = DRV_STATUS_CAN_OPEN
+        else:
+            status.DrvStatus = DRV_STATUS_INIT
+        status.CanStatus = device.can_status
+        status.FifoStatus = device.fifo_status
+
+    def _run(self):
+        next_tick = time.perf_counter()
+        while self._running:
+            next_tick += self.tick
+            bus_time = time.perf_counter() - self._start_time
+            produced = 0
+            with self.lock:
+                for device in list(self.devices.values()):
+                    produced += device.generate_until(bus_time)
+            if produced:
+                self._rx_event(produced)
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.perf_counter()
+
+    def _start(self):
+        if self.realtime and not self._running:
+            self._running = True
+            self._start_time = time.perf_counter()
+            self._thread = threading.Thread(target=self._run, name="virtual_tiny_can", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._running = False
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(1.0)
+        for event_obj in list(self.events):
+            self._set_event(event_obj, MHS_TERMINATE)
+
+    # ---------------- driver api ----------------
+
+    def CanInitDriver(self, options=None):
+        return 0
+
+    def CanExInitDriver(self, options=None):
+        return self.CanInitDriver(options)
+
+    def CanDownDriver(self):
+        self.close()
+
+    def CanSetOptions(self, options=None):
+        return 0
+
+    def CanDeviceOpen(self, index, options=None):
+        device = self.device(index)
+        device.open = 1
+        return 0
+
+    def CanDeviceClose(self, index):
+        device = self.device(index)
+        device.open = 0
+        device.running = 0
+        return 0
+
+    def CanSetMode(self, index, mode, flags):
+        device = self.device(index)
+        mode = _value(mode)
+        flags = _value(flags)
+        with self.lock:
+            if flags & CAN_CMD_RXD_OVERRUN_CLEAR:
+                device.fifo_status = FIFO_STATUS_OK
+            if flags & CAN_CMD_RXD_FIFOS_CLEAR:
+                device.fifo.clear()
+            if flags & CAN_CMD_TXD_FIFOS_CLEAR:
+                device.tx_fifo.clear()
+            if flags & (CAN_CMD_HW_FILTER_CLEAR | CAN_CMD_SW_FILTER_CLEAR):
+                device.filters.clear()
+                device.filter_buffers.clear()
+            if flags & CAN_CMD_TXD_BUFFER_CLEAR:
+                device.interval_msgs.clear()
+            if mode in (OP_CAN_START, OP_CAN_LOM, OP_CAN_START_NO_RETRANS):
+                device.running = 1
+                device.listen_only = 1 if mode == OP_CAN_LOM else 0
+                if device.can_status == CAN_STATUS_BUS_OFF:
+                    device.can_status = CAN_STATUS_OK
+            elif mode in (OP_CAN_STOP, OP_CAN_RESET):
+                device.running = 0
+        if device.running:
+            self._start()
+        return 0
+
+    def CanTransmit(self, index, msgs, count):
+        idx = _value(index)
+        device = self.device(idx)
+        count = _value(count)
+        msgs = _target(msgs)
+        if device.listen_only or not device.running:
+            return -5
+        raw = (TCanMsg * count).from_address(addressof(msgs))
+        sub_index = idx & INDEX_FIFO_PUFFER_MASK
+        with self.lock:
+            if idx & INDEX_RXD_TXT_FLAG and sub_index:
+                #interval buffer: keep the message, CanTransmitSet starts it
+                old = device.interval_msgs.get(sub_index, (None, 0, 0))
+                device.interval_msgs[sub_index] = (bytes(raw[0]), old[1], old[2])
+                return 0
+            for msg in raw:
+                device.tx_fifo.append(bytes(msg))
+            device.tx_frames += count
+        return count
+
+    def CanTransmitClear(self, index):
+        self.device(index).tx_fifo.clear()
+
+    def CanTransmitGetCount(self, index):
+        return len(self.device(index).tx_fifo)
+
+    def CanTransmitSet(self, index, flags, interval):
+        idx = _value(index)
+        device = self.device(idx)
+        flags = _value(flags)
+        sub_index = idx & INDEX_FIFO_PUFFER_MASK
+        with self.lock:
+            msg, period, next_due = device.interval_msgs.get(sub_index, (None, 0, 0))
+            if flags & 0x8000:
+                period = _value(interval) / 1e6
+            if flags & 0x0001 and period:
+                device.interval_msgs[sub_index] = (msg, period, device.bus_time + period)
+            else:
+                device.interval_msgs[sub_index] = (msg, 0, 0)
+        return 0
+
+    def _fifo(self, idx):
+        if idx & INDEX_SOFT_FLAG:
+            return self.soft_fifos.get(idx)
+        sub_index = idx & INDEX_FIFO_PUFFER_MASK
+        if sub_index:
+            #filter buffer, empty until a frame matched
+            return self.device(idx).filter_buffers.setdefault(sub_index, deque(maxlen=1))
+        return self.device(idx).fifo
+
+    def CanReceive(self, index, msgs, count):
+        idx = _value(index)
+        count = _value(count)
+        fifo = self._fifo(idx)
+        if fifo is None:
+            return ERR_INDEX
+        target = _target(msgs)
+        if isinstance(target, Array):
+            count = min(count, len(target))
+        buffer = (TCanMsg * count).from_address(addressof(target))
+        n = 0
+        with self.lock:
+            while n < count and fifo:
+                MSG.pack_into(buffer, n * sizeof(TCanMsg), *fifo.popleft())
+                n += 1
+        return n
+
+    def CanReceiveClear(self, index):
+        fifo = self._fifo(_value(index))
+        if fifo is not None:
+            fifo.clear()
+
+    def CanReceiveGetCount(self, index):
+        fifo = self._fifo(_value(index))
+        return len(fifo) if fifo is not None else 0
+
+    def CanSetSpeed(self, index, speed):
+        self.device(index)
+        return 0
+
+    def CanSetSpeedUser(self, index, value):
+        return 0
+
+    def CanDrvInfo(self):
+        return b"Description=Virtual Tiny-CAN;Hardware=Virtual;Version=1.0"
+
+    def CanDrvHwInfo(self, index=0):
+        return b"Hardware=Virtual;Snr=VIRTUAL"
+
+    def CanSetFilter(self, index, msg_filter):
+        idx = _value(index)
+        sub_index = idx & INDEX_FIFO_PUFFER_MASK
+        if sub_index == 0:
+            return ERR_INDEX
+        f = TMsgFilter()
+        memmove(addressof(f), addressof(_target(msg_filter)), sizeof(TMsgFilter))
+        with self.lock:
+            self.device(idx).filters[sub_index] = f
+        return 0
+
+    def CanGetDeviceStatus(self, index, status):
+        self._fill_status(self.device(index), _target(status))
+        return 0
+
+    def CanSetEvents(self, events):
+        events = _value(events)
+        self.event_mask |= events & 0x00FF
+        self.event_mask &= ~((events >> 8) & 0x00FF)
+        return 0
+
+    def CanEventStatus(self):
+        return 0
+
+    def CanSetPnPEventCallback(self, callback):
+        self.pnp_callback = callback
+        return 0
+
+    def CanSetStatusEventCallback(self, callback):
+        self.status_callback = callback
+        return 0
+
+    def CanSetRxEventCallback(self, callback):
+        self.rx_callback = callback
+        return 0
+
+    def CanExGetDeviceCount(self, flags):
+        return len(self.devices)
+
+    def CanExCreateDevice(self, index, options=None):
+        with self.lock:
+            n = 0
+            while (n << 20) in self.devices:
+                n += 1
+            if n > 15:
+                return -24
+            device = self.device(n << 20)
+            options = _value(options)
+            if options:
+                if type(options) == bytes:
+                    options = options.decode()
+                for option in options.split(";"):
+                    key, _, value = option.partition("=")
+                    if key.strip() == "CanRxDFifoSize" and value.strip():
+                        device.fifo_size = int(value)
+        target = _target(index)
+        target.value = n << 20
+        return 0
+
+    def CanExDestroyDevice(self, index):
+        idx = _value(_target(index)) & INDEX_CAN_DEVICE_MASK
+        self.devices.pop(idx, None)
+        return 0
+
+    def CanExCreateFifo(self, index, size, event_obj, event, channels):
+        idx = _value(index)
+        self.soft_fifos[idx] = deque()
+        event_obj = _value(event_obj)
+        if event_obj in self.events:
+            self.events[event_obj]["fifos"].append(idx)
+        return 0
+
+    def CanExBindFifo(self, fifo_index, device_index, bind):
+        fifo = self.soft_fifos.get(_value(fifo_index))
+        if fifo is None:
+            return ERR_INDEX
+        device = self.device(device_index)
+        with self.lock:
+            if _value(bind):
+                if fifo not in device.bound_fifos:
+                    device.bound_fifos.append(fifo)
+            elif fifo in device.bound_fifos:
+                device.bound_fifos.remove(fifo)
+        return 0
+
+    def CanExCreateEvent(self):
+        event_obj = len(self.events) + 1
+        self.events[event_obj] = {"condition": threading.Condition(), "pending": 0, "fifos": []}
+        return event_obj
+
+    def CanExSetObjEvent(self, index, source, event_obj, event):
+        event_obj = _value(event_obj)
+        if event_obj in self.events:
+            self.events[event_obj]["fifos"].append(_value(index))
+        return 0
+
+    def _set_event(self, event_obj, event):
+        entry = self.events.get(event_obj)
+        if entry:
+            with entry["condition"]:
+                entry["pending"] |= event
+                entry["condition"].notify_all()
+
+    def CanExSetEvent(self, event_obj, event):
+        self._set_event(_value(event_obj), _value(event))
+
+    def CanExSetEventAll(self, event):
+        for event_obj in list(self.events):
+            self._set_event(event_obj, _value(event))
+
+    def CanExResetEvent(self, event_obj, event):
+        entry = self.events.get(_value(event_obj))
+        if entry:
+            with entry["condition"]:
+                entry["pending"] &= ~_value(event)
+
+    def CanExWaitForEvent(self, event_obj, timeout):
+        entry = self.events.get(_value(event_obj))
+        if not entry:
+            return 0
+        with entry["condition"]:
+            if not entry["pending"]:
+                entry["condition"].wait(_value(timeout) / 1000.0)
+            events = entry["pending"]
+            entry["pending"] = 0
+        return events
+
+    def CanExSetOptions(self, index, options):
+        return 0
+
+    def _no_variable(self, *args):
+        return ERR_VAR_NOT_FOUND
+
+    CanExSetAsByte = CanExSetAsWord = CanExSetAsLong = CanExSetAsUByte = _no_variable
+    CanExSetAsUWord = CanExSetAsULong = CanExSetAsString = _no_variable
+    CanExGetAsByte = CanExGetAsWord = CanExGetAsLong = CanExGetAsUByte = _no_variable
+    CanExGetAsUWord = CanExGetAsULong = CanExGetAsString = _no_variable
+
+    def CanExDataFree(self, data):
+        return
@@ -1 +1,15 @@
 from . import top_level_can_logger
+from . import can_filter
+from . import frame_expr
+from . import can_router
+from . import multi_channel
+from . import clock_sync
+from . import metrics
+from . import profiling
+from . import cyclic_tx
+from . import on_change
+from . import signal_compression
+from . import trigger_capture
+from . import frame_bus
+from . import frame_stream
+from . import socketcan
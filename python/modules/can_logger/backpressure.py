@@ -0,0 +1,199 @@
+# rx fifo monitoring and back-pressure
+# the rx callback reports how full the driver fifo is after every read
+# (fill level 0..1), other sources (e.g. the decoder queue) can add their own
+# fill level. the receive batch grows while the fifo doesn't get empty and
+# shrinks back once it does.
+# while the fill level stays above high_water the policies are switched on
+# one after the other, below low_water they are switched off again:
+#   "pause_decode"        decoder subscriptions get nothing (raw log is complete)
+#   "raw_only"            every subscription except the raw log is suspended
+#   "drop_low_priority"   the low priority ids are dropped, also in the raw log
+# a fifo overrun (status callback or CanGetDeviceStatus poll) switches the
+# next policy on at once, clears the overrun in the driver and is written to
+# the event log with the time window in which frames were lost.
+
+import time
+
+from .. import TinyCan as tiny_can
+from .. import file_manager as fman
+from . import metrics
+
+drv = tiny_can.mhsTinyCanDriver
+
+POLICY_PAUSE_DECODE = "pause_decode"
+POLICY_RAW_ONLY = "raw_only"
+POLICY_DROP_LOW_PRIORITY = "drop_low_priority"
+DEFAULT_POLICIES = (POLICY_PAUSE_DECODE, POLICY_RAW_ONLY, POLICY_DROP_LOW_PRIORITY)
+
+
+class BackPressure:
+    def __init__(self, router, can_driver=None, fifo_size=16384, policies=DEFAULT_POLICIES,
+                 low_priority_ids=None, raw_names=("raw_log",), decode_names=("decoder",),
+                 high_water=0.5, low_water=0.1, hold=2.0, batch_size=500, max_batch=4000,
+                 poll_interval=0.5):
+        # hold: seconds the fill level has to stay above / below the marks before the next step
+        for policy in policies:
+            if policy not in DEFAULT_POLICIES:
+                raise ValueError("unknown back-pressure policy {}".format(policy))
+        self.router = router
+        self.can_driver = can_driver
+        self.fifo_size = fifo_size
+        self.policies = tuple(policies)
+        self.low_priority_ids = set(low_priority_ids) if low_priority_ids else set()
+        self.raw_names = tuple(raw_names)
+        self.decode_names = tuple(decode_names)
+        self.high_water = high_water
+        self.low_water = low_water
+        self.hold = hold
+        self.base_batch = batch_size
+        self.batch_size = batch_size
+        self.max_batch = max_batch
+        self.poll_interval = poll_interval
+        self.pressure_sources = []
+        self.level = 0
+        self.fill = 0.0
+        self.overruns = 0
+        self.lost_windows = []
+        self.on_lost = None
+        self._suspended = set()
+        self._above_since = None
+        self._below_since = None
+        self._next_poll = 0.0
+        self._last_frame = {}
+        self._pending_overrun = {}
+        self._level_gauge = metrics.registry.gauge("can_backpressure_level", "number of active back-pressure policies")
+        self._batch_gauge = metrics.registry.gauge("can_rx_batch_limit", "current CanReceive batch size")
+        self._fill_gauge = metrics.registry.gauge("can_rx_fifo_fill", "rx fifo fill level after the last read (0..1)")
+        self._overrun_counter = metrics.registry.counter("can_rx_overrun_events_total", "rx fifo overruns")
+        self._batch_gauge.set(batch_size)
+        metrics.registry.add_collector(self._collect)
+
+    def close(self):
+        # the registry outlives the logger, drop the collector with it
+        metrics.registry.remove_collector(self._collect)
+
+    def add_pressure_source(self, source):
+        # source() returns a fill level 0..1, e.g. the decoder queue
+        self.pressure_sources.append(source)
+
+    # ---------------- rx path ----------------
+
+    def after_receive(self, num_msg, raw_msgs=None, fifo_index=None, device_index=None, tag=0):
+        # called by the rx callback after every CanReceive, returns the batch size for the next call
+        # fifo_index: fifo that was read, device_index: device for the status (None -> default device)
+        if num_msg > 0:
+            last = raw_msgs[num_msg - 1]
+            t_us = last.Sec * 1000000 + last.USec
+            if tag in self._pending_overrun:
+                first = raw_msgs[0]
+                self._close_lost_window(tag, first.Sec * 1000000 + first.USec)
+            self._last_frame[tag] = t_us
+        backlog = 0
+        if num_msg >= self.batch_size and self.can_driver:
+            #a full batch, look how much is still waiting
+            backlog = self.can_driver.CanReceiveGetCount(fifo_index)
+        self._adapt_batch(backlog)
+        now = time.monotonic()
+        self.update((num_msg + backlog) / float(self.fifo_size), now)
+        if self.can_driver and now >= self._next_poll:
+            self._next_poll = now + self.poll_interval
+            self.poll_status(device_index, tag)
+        return self.batch_size
+
+    def _adapt_batch(self, backlog):
+        if backlog > self.batch_size:
+            self.batch_size = min(self.max_batch, self.batch_size * 2)
+            self._batch_gauge.set(self.batch_size)
+        elif backlog == 0 and self.batch_size > self.base_batch:
+            self.batch_size = max(self.base_batch, self.batch_size // 2)
+            self._batch_gauge.set(self.batch_size)
+
+    def update(self, fill, now=None):
+        # escalates / relaxes the policies with hysteresis
+        if now is None:
+            now = time.monotonic()
+        for source in self.pressure_sources:
+            fill = max(fill, source())
+        self.fill = fill
+        self._fill_gauge.set(fill)
+        if fill >= self.high_water:
+            self._below_since = None
+            if self._above_since is None:
+                self._above_since = now
+            elif now - self._above_since >= self.hold and self.level < len(self.policies):
+                self.set_level(self.level + 1, "fifo fill {:.0%}".format(fill))
+                self._above_since = now
+        elif fill <= self.low_water:
+            self._above_since = None
+            if self._below_since is None:
+                self._below_since = now
+            elif now - self._below_since >= self.hold and self.level > 0:
+                self.set_level(self.level - 1, "fifo fill {:.0%}".format(fill))
+                self._below_since = now
+        else:
+            self._above_since = None
+            self._below_since = None
+
+    # ---------------- policies ----------------
+
+    def set_level(self, level, reason=""):
+        level = max(0, min(level, len(self.policies)))
+        if level == self.level:
+            return
+        active = self.policies[:level]
+        suspended = set()
+        if POLICY_PAUSE_DECODE in active:
+            suspended.update(self.decode_names)
+        if POLICY_RAW_ONLY in active:
+            suspended.update(s.name for s in self.router.subscriptions if s.name not in self.raw_names)
+        for name in self._suspended - suspended:
+            self.router.suspended.discard(name)
+        self.router.suspended.update(suspended)
+        self._suspended = suspended
+        if POLICY_DROP_LOW_PRIORITY in active:
+            self.router.set_drop_ids(self.low_priority_ids)
+        else:
+            self.router.set_drop_ids(None)
+        self.level = level
+        self._level_gauge.set(level)
+        fman.logFileManager.logEvent("back-pressure level {} ({}): {}".format(
+            level, reason, ", ".join(active) if active else "all policies off"))
+
+    # ---------------- overruns ----------------
+
+    def poll_status(self, index=None, tag=0):
+        err, drv_status, can_status, fifo_status = self.can_driver.CanGetDeviceStatus(index)
+        if err >= 0 and fifo_status == drv.FIFO_STATUS_OVERRUN:
+            self.overrun(index, tag)
+
+    def status_event(self, index, fifo_status, tag=0):
+        # from the status callback
+        if fifo_status == drv.FIFO_STATUS_OVERRUN:
+            self.overrun(index, tag)
+
+    def overrun(self, index=None, tag=0):
+        # frames were lost: account, escalate, clear the overrun flag
+        if tag in self._pending_overrun:
+            #same overrun seen twice (status callback and poll)
+            return
+        self.overruns += 1
+        self._overrun_counter.inc()
+        self._pending_overrun[tag] = self._last_frame.get(tag)
+        if self.can_driver:
+            self.can_driver.CanSetMode(index, drv.OP_CAN_NO_CHANGE, drv.CAN_CMD_RXD_OVERRUN_CLEAR)
+        self.set_level(self.level + 1, "rx fifo overrun on channel {}".format(tag))
+        self._above_since = time.monotonic()
+
+    def _close_lost_window(self, tag, first_after_us):
+        last_before_us = self._pending_overrun.pop(tag)
+        window = {"channel": tag, "last_before_us": last_before_us, "first_after_us": first_after_us,
+                  "gap_ms": (first_after_us - last_before_us) / 1000.0 if last_before_us is not None else None}
+        self.lost_windows.append(window)
+        fman.logFileManager.logEvent("rx fifo overrun on channel {}: frames lost between device time {} us and {} us".format(
+            tag, last_before_us, first_after_us))
+        if self.on_lost:
+            self.on_lost(window)
+
+    def _collect(self):
+        metrics.registry.counter("can_frames_dropped_total", "frames dropped by the back-pressure policy").value = \
+            self.router.frames_dropped
@@ -0,0 +1,82 @@
+# acceptance filters for the tiny can
+# the tiny can filters are message buffers on the sub indexes: a frame that
+# matches a filter is copied into its buffer, with Mode 0 (SetFilter remove=1)
+# it is taken out of the rx fifo as well. frames that match no filter always
+# reach the fifo, the device can't be told to let only some ids through.
+# so the hardware slots are spent on the largest id ranges nobody wants (one
+# range filter each, remove mode): those frames stay out of the fifo and the
+# rx callback. the software filter on the host removes the rest, it is keyed
+# on (id, eff), a 11 bit and a 29 bit frame with the same number are different.
+
+from .. import TinyCan as tiny_can
+
+STD_ID_MAX = 0x7FF
+EXT_ID_MAX = 0x1FFFFFFF
+EFF_FLAG = 0x80000000           # dbc marks extended ids with bit 31
+
+
+def frame_ids_from_dbc(dbc_frames):
+    # DBCReader stores the frame ids as hex strings without leading zeros
+    ids = []
+    for frame_id in dbc_frames:
+        raw_id = int(frame_id, 16) if frame_id else 0
+        eff = 1 if raw_id & EFF_FLAG else 0
+        can_id = raw_id & ~EFF_FLAG
+        #skip pseudo messages like VECTOR__INDEPENDENT_SIG_MSG
+        if can_id > EXT_ID_MAX or (not eff and can_id > STD_ID_MAX):
+            continue
+        ids.append((can_id, eff))
+    return ids
+
+
+def normalize_ids(ids):
+    # accepts plain ints, hex strings or (id, eff) tuples
+    normalized = set()
+    for can_id in ids:
+        if type(can_id) == tuple:
+            can_id, eff = can_id
+        else:
+            if type(can_id) == str:
+                can_id = int(can_id, 16)
+            eff = 1 if can_id > STD_ID_MAX else 0
+        normalized.add((can_id, eff))
+    return normalized
+
+
+def reject_ranges(ids, max_ranges=4):
+    # the largest id ranges without a wanted id: [(start, stop, eff)], at most max_ranges
+    gaps = []
+    for eff, id_max in ((0, STD_ID_MAX), (1, EXT_ID_MAX)):
+        start = 0
+        for can_id in sorted(can_id for can_id, f_eff in ids if f_eff == eff) + [id_max + 1]:
+            if can_id > start:
+                gaps.append((can_id - start, start, can_id - 1, eff))
+            start = can_id + 1
+    gaps.sort(key=lambda gap: -gap[0])
+    return sorted((start, stop, eff) for size, start, stop, eff in gaps[:max_ranges])
+
+
+def filter_index(index, slot):
+    # filters live on the sub indexes of the fifo, sub index 0 is the fifo itself
+    if type(index) == tiny_can.mhsTinyCanDriver.TIndex:
+        index = index.Uint32
+    return (index & ~0xFFFF) | (slot + 1)
+
+
+def install_filters(can_driver, ids, hw_slots=4, index=None):
+    # installs remove filters for the largest unwanted id ranges and returns the
+    # software filter (set of (id, eff)) that has to be applied on the host, None without ids
+    if index is None:
+        index = can_driver.DefaultIndex
+    ids = normalize_ids(ids)
+    if not ids:
+        return None
+    software_filter = set(ids)
+    for slot, (start, stop, eff) in enumerate(reject_ranges(ids, hw_slots)):
+        err = can_driver.SetFilter(index=filter_index(index, slot), msgIdStart=start, msgIdStop=stop, eff=eff, remove=1)
+        if err < 0:
+            #out of hardware slots, the host filter does the work alone
+            can_driver.CanSetMode(index, tiny_can.mhsTinyCanDriver.OP_CAN_NO_CHANGE,
+                                  tiny_can.mhsTinyCanDriver.CAN_CMD_HW_FILTER_CLEAR)
+            break
+    return software_filter
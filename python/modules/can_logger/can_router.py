@@ -0,0 +1,161 @@
+# routes received can frames to the parts of the logger that want them
+# (raw log, decoder, lora, statistics ...)
+# every subscription (id list, id range or mask/code) is compiled into a
+# lookup table: a list with one entry per 11 bit id and a dict for 29 bit ids
+# which gets filled the first time an id shows up.
+# frames are collected per subscriber and handed over as one batch.
+# under load subscriptions can be suspended by name and ids can be dropped
+# for everybody (see backpressure), the dropped frames are counted
+# a subscription can also carry a frame_expr expression: it is only evaluated
+# for the ids the expression can match, the handler gets the frames it is true for
+
+from .. import file_manager as fman
+from . import frame_expr
+
+STD_ID_COUNT = 0x800
+EFF_BIT = 0x80              # EFF bit in TCANFlags.Uint32
+EXT_TABLE_LIMIT = 65536     # 29 bit ids are looked up lazily, keep the dict bounded
+
+
+class _Dropped(tuple):
+    # empty target list of a dropped id, told apart from "nobody subscribed" by identity
+    pass
+
+
+DROPPED = _Dropped()
+
+
+class Subscription:
+    def __init__(self, handler, ids=None, id_range=None, mask=None, code=None, eff=None, name=None, expr=None):
+        self.handler = handler
+        self.expr = expr
+        if expr is not None and expr.ids is not None:
+            ids = expr.ids if ids is None else set(i for i in ids if (i[0] if type(i) == tuple else i) in expr.ids)
+        self.ids = set(ids) if ids is not None else None
+        self.id_range = id_range
+        self.mask = mask
+        self.code = code
+        self.eff = eff
+        self.name = name if name else getattr(handler, "__name__", str(handler))
+
+    def matches(self, can_id, eff):
+        if self.eff is not None and bool(self.eff) != bool(eff):
+            return False
+        #ids: plain ids match both frame formats, (id, eff) tuples only theirs
+        if self.ids is not None and can_id not in self.ids and (can_id, 1 if eff else 0) not in self.ids:
+            return False
+        if self.id_range is not None and not (self.id_range[0] <= can_id <= self.id_range[1]):
+            return False
+        if self.mask is not None and (can_id & self.mask) != (self.code & self.mask):
+            return False
+        return True
+
+    def filtered_handler(self):
+        # handler that only gets the frames the expression is true for
+        if self.expr is None:
+            return self.handler
+        handler = self.handler
+        match = self.expr.match_msg
+
+        def filtered(frames):
+            frames = [frame for frame in frames if match(frame)]
+            if frames:
+                handler(frames)
+        filtered.__name__ = self.name
+        return filtered
+
+
+class FrameRouter:
+    def __init__(self):
+        self.subscriptions = []
+        self.suspended = set()
+        self.drop_ids = frozenset()
+        self.frames_dropped = 0
+        # (subscriptions, handlers, std table, ext table), swapped as a whole
+        self._compiled = ((), (), [()] * STD_ID_COUNT, {})
+
+    def subscribe(self, handler, ids=None, id_range=None, mask=None, code=0, eff=None, name=None, expr=None):
+        # handler(frames) gets called once per dispatch with all frames it subscribed to
+        # ids: iterable of can ids or (id, eff) tuples, id_range: (start, stop), mask/code: (id & mask) == (code & mask)
+        # expr: frame_expr.Expression or its text (frame fields only, compile it with the
+        # dbc signal table for signals). without any of them the handler gets every frame
+        if expr is not None:
+            expr = frame_expr.compile_expression(expr)
+        subscription = Subscription(handler, ids=ids, id_range=id_range,
+                                    mask=mask, code=code, eff=eff, name=name, expr=expr)
+        self.subscriptions.append(subscription)
+        self.compile()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+            self.compile()
+
+    def suspend(self, name):
+        # subscriptions with this name get nothing until resume(name)
+        self.suspended.add(name)
+        self.compile()
+
+    def resume(self, name):
+        self.suspended.discard(name)
+        self.compile()
+
+    def set_drop_ids(self, ids):
+        # frames with these ids go to nobody and are counted in frames_dropped
+        self.drop_ids = frozenset(ids) if ids else frozenset()
+        self.compile()
+
+    def compile(self):
+        # the tables are built aside and swapped in, dispatch may run in the driver thread
+        subscriptions = [s for s in self.subscriptions if s.name not in self.suspended]
+        drop_ids = self.drop_ids
+        std_table = []
+        for can_id in range(STD_ID_COUNT):
+            if can_id in drop_ids:
+                std_table.append(DROPPED)
+                continue
+            std_table.append(tuple(i for i, s in enumerate(subscriptions) if s.matches(can_id, 0)))
+        handlers = tuple(s.filtered_handler() for s in subscriptions)
+        self._compiled = (tuple(subscriptions), handlers, std_table, {})
+
+    def _lookup_ext(self, compiled, can_id):
+        subscriptions, handlers, std_table, ext_table = compiled
+        if can_id in self.drop_ids:
+            targets = DROPPED
+        else:
+            targets = tuple(i for i, s in enumerate(subscriptions) if s.matches(can_id, 1))
+        if len(ext_table) >= EXT_TABLE_LIMIT:
+            ext_table.clear()
+        ext_table[can_id] = targets
+        return targets
+
+    def dispatch(self, frames):
+        # frames: iterable of TCanMsg, returns the number of frames nobody wanted
+        compiled = self._compiled
+        subscriptions, handlers, std_table, ext_table = compiled
+        batches = [[] for _ in handlers]
+        dropped = 0
+        for frame in frames:
+            can_id = frame.Id
+            if frame.Flags.Uint32 & EFF_BIT:
+                targets = ext_table.get(can_id)
+                if targets is None:
+                    targets = self._lookup_ext(compiled, can_id)
+            else:
+                targets = std_table[can_id & 0x7FF]
+            if not targets:
+                dropped += 1
+                if targets is DROPPED:
+                    self.frames_dropped += 1
+            for i in targets:
+                batches[i].append(frame)
+
+        for handler, batch in zip(handlers, batches):
+            if batch:
+                try:
+                    handler(batch)
+                except Exception as e:
+                    #one broken sink must not stop the others
+                    fman.logFileManager.logEvent("router handler {} failed: {}".format(handler, e))
+        return dropped
@@ -0,0 +1,88 @@
+# maps the timestamps of the tiny can (Sec/USec of the frames) to the
+# monotonic clock and utc time of the host.
+# the device clock runs with its own offset and drifts against the host,
+# so we keep fitting host = offset + rate * device over the last samples.
+# the delay between the frame on the bus and the rx callback is always
+# positive, so the offset is taken from the lower envelope of the samples.
+# the resulting mapping is written once into every segment header, the
+# frames themselves keep the raw device time
+
+import time
+from collections import deque
+
+MAX_DRIFT = 500e-6      # more than 500ppm is no crystal drift but a bad fit
+
+
+class ClockSync:
+    def __init__(self, window=64, min_interval=0.1):
+        self.samples = deque(maxlen=window)
+        self.min_interval = min_interval
+        self.rate = 1.0
+        self.offset = None
+        self.utc_offset = time.time() - time.monotonic()
+        self._last_sample = None
+
+    def add_sample(self, device_us, host_mono=None):
+        # device_us: device time of a frame, host_mono: time.monotonic() when we got it
+        if host_mono is None:
+            host_mono = time.monotonic()
+        if self._last_sample is not None and host_mono - self._last_sample < self.min_interval:
+            return
+        self._last_sample = host_mono
+        self.samples.append((device_us / 1e6, host_mono))
+        #follow ntp corrections of the wall clock
+        self.utc_offset = time.time() - time.monotonic()
+        self._fit()
+
+    def add_frame(self, raw_msg, host_mono=None):
+        self.add_sample(raw_msg.Sec * 1000000 + raw_msg.USec, host_mono)
+
+    def _fit(self):
+        n = len(self.samples)
+        if n >= 2:
+            mean_d = sum(d for d, h in self.samples) / n
+            mean_h = sum(h for d, h in self.samples) / n
+            var = sum((d - mean_d) ** 2 for d, h in self.samples)
+            if var > 0:
+                rate = sum((d - mean_d) * (h - mean_h) for d, h in self.samples) / var
+                self.rate = min(max(rate, 1.0 - MAX_DRIFT), 1.0 + MAX_DRIFT)
+        self.offset = min(h - self.rate * d for d, h in self.samples)
+
+    def synced(self):
+        return self.offset is not None
+
+    def to_monotonic(self, device_us):
+        if self.offset is None:
+            return None
+        return self.offset + self.rate * device_us / 1e6
+
+    def to_utc(self, device_us):
+        mono = self.to_monotonic(device_us)
+        if mono is None:
+            return None
+        return mono + self.utc_offset
+
+    def mapping(self):
+        # everything a reader needs to turn device time into host time
+        if self.offset is None:
+            return None
+        device_t0_us = int(self.samples[-1][0] * 1e6)
+        mono_t0 = self.to_monotonic(device_t0_us)
+        return {
+            "device_t0_us": device_t0_us,
+            "mono_t0": mono_t0,
+            "utc_t0": mono_t0 + self.utc_offset,
+            "drift_ppm": (self.rate - 1.0) * 1e6,
+            "samples": len(self.samples),
+        }
+
+
+def device_to_utc(mapping, device_us):
+    # same as ClockSync.to_utc but only with the mapping stored in a segment header
+    rate = 1.0 + mapping["drift_ppm"] / 1e6
+    return mapping["utc_t0"] + rate * (device_us - mapping["device_t0_us"]) / 1e6
+
+
+def device_to_monotonic(mapping, device_us):
+    rate = 1.0 + mapping["drift_ppm"] / 1e6
+    return mapping["mono_t0"] + rate * (device_us - mapping["device_t0_us"]) / 1e6
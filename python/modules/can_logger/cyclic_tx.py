@@ -0,0 +1,296 @@
+# cyclic transmission of many periodic messages (keep-alives, simulated ecus)
+# messages go into the hardware interval buffers of the tiny can as long as
+# there are free slots (CanTransmitSet does the timing in the device), the
+# rest is sent by one host thread with a timing wheel:
+#   the wheel has one bucket per tick (1 ms), a message sits in the bucket of
+#   its next due time. every due time is computed from the start time
+#   (t0 + offset + k * period), so late wakeups don't add up to drift, and a
+#   message that missed whole cycles skips them instead of sending a burst.
+#   everything due in the same tick goes out with one CanTransmit call.
+# payloads are swapped as a whole (new 24 byte frame, one reference), so the
+# sender never sees half of an update. with an encoder set_signals() updates
+# single signal values of a message:
+#   CyclicScheduler(can_driver, encoder=DBCReader.encode_frame)
+
+import struct
+import threading
+import time
+
+from .. import TinyCan as tiny_can
+from .. import file_manager as fman
+from . import metrics
+
+drv = tiny_can.mhsTinyCanDriver
+TCanMsg = drv.TCanMsg
+MSG = struct.Struct("<II8sII")      # TCanMsg: Id, Flags, Data, Sec, USec
+
+
+def interval_index(device_index, slot):
+    # hardware interval buffer slot (1..n) of a device
+    return (device_index & ~drv.INDEX_FIFO_PUFFER_MASK) | drv.INDEX_RXD_TXT_FLAG | slot
+
+
+class CyclicMessage:
+    def __init__(self, can_id, period, data=b"", dlc=None, eff=0, rtr=0, offset=0.0):
+        # period / offset in seconds
+        if period <= 0:
+            raise ValueError("period has to be > 0")
+        if can_id > (0x1FFFFFFF if eff else 0x7FF):
+            raise ValueError("can id {:#x} out of range".format(can_id))
+        self.can_id = can_id
+        self.period = period
+        self.offset = offset
+        self.eff = 1 if eff else 0
+        self.rtr = 1 if rtr else 0
+        self.dlc = dlc
+        self.values = {}
+        self.slot = None
+        self.raw = None
+        self.cycle = 0
+        self.sent = 0
+        self.skipped = 0
+        self.set_data(data)
+
+    def set_data(self, data):
+        # new payload, swapped in as one frame
+        data = bytes(data)
+        dlc = self.dlc if self.dlc is not None else len(data)
+        if dlc > 8 or len(data) > 8:
+            raise ValueError("more than 8 data bytes")
+        flags = dlc | (0x40 if self.rtr else 0) | (0x80 if self.eff else 0)
+        self.raw = MSG.pack(self.can_id, flags, data.ljust(8, b"\0"), 0, 0)
+
+    def data(self):
+        return MSG.unpack(self.raw)[2]
+
+
+class CyclicScheduler:
+    def __init__(self, can_driver, index=None, hw_slots=0, tick=0.001, wheel_size=1024,
+                 encoder=None, spin=0.0005):
+        # hw_slots: interval buffers of the device that may be used (0 -> host only)
+        # encoder(can_id, values) -> payload bytes, used by set_signals
+        self.can_driver = can_driver
+        self.index = can_driver.IndexValue(index)
+        self.hw_slots = hw_slots
+        self.tick = tick
+        self.wheel = [[] for _ in range(wheel_size)]
+        self.encoder = encoder
+        self.spin = spin
+        self.messages = []
+        self.free_slots = list(range(1, hw_slots + 1))
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.t0 = None
+        self.errors = 0
+        self.batches = 0
+        self.late = 0
+        self.max_late = 0.0
+        self._running = False
+        self._thread = None
+
+    # ---------------- messages ----------------
+
+    def add(self, can_id, period_ms, data=b"", dlc=None, eff=0, rtr=0, offset_ms=0.0, values=None, hardware=None):
+        # hardware: True -> interval buffer (error if none is free), False -> host, None -> buffer if free
+        message = CyclicMessage(can_id, period_ms / 1000.0, data, dlc=dlc, eff=eff, rtr=rtr, offset=offset_ms / 1000.0)
+        if values:
+            message.values.update(values)
+            message.set_data(self._encode(message))
+        if hardware is None:
+            hardware = bool(self.free_slots)
+        if hardware:
+            if not self.free_slots:
+                raise ValueError("no free hardware interval slot")
+            self._start_hardware(message, self.free_slots.pop(0))
+        with self.lock:
+            self.messages.append(message)
+            if message.slot is None and self.t0 is not None:
+                self._schedule_first(message, time.perf_counter())
+        self.wakeup.set()
+        return message
+
+    def remove(self, message):
+        with self.lock:
+            if message in self.messages:
+                self.messages.remove(message)
+            for position, bucket in enumerate(self.wheel):
+                if bucket:
+                    self.wheel[position] = [entry for entry in bucket if entry[1] is not message]
+        if message.slot is not None:
+            slot_index = interval_index(self.index, message.slot)
+            self.can_driver.CanTransmitSet(slot_index, 0x8000, 0)
+            self.free_slots.append(message.slot)
+            message.slot = None
+
+    def set_data(self, message, data):
+        message.set_data(data)
+        if message.slot is not None:
+            self._write_slot(message)
+
+    def set_signals(self, message, **values):
+        # updates some signal values, the others keep their last value
+        values = dict(message.values, **values)
+        message.set_data(self._encode(message, values))
+        message.values = values
+        if message.slot is not None:
+            self._write_slot(message)
+
+    def _encode(self, message, values=None):
+        if self.encoder is None:
+            raise ValueError("no encoder for signal values")
+        return self.encoder(message.can_id, values if values is not None else message.values)
+
+    # ---------------- hardware interval buffers ----------------
+
+    def _write_slot(self, message):
+        msgs = (TCanMsg * 1).from_buffer_copy(message.raw)
+        return self.can_driver.CanTransmitFast(interval_index(self.index, message.slot), msgs, 1)
+
+    def _start_hardware(self, message, slot):
+        # same steps as SetIntervalMessage: stop, write the message, start with the interval
+        message.slot = slot
+        slot_index = interval_index(self.index, slot)
+        err = self.can_driver.CanTransmitSet(slot_index, 0x8000, 0)
+        if err >= 0:
+            err = self._write_slot(message)
+        if err >= 0:
+            err = self.can_driver.CanTransmitSet(slot_index, 0x8001, message.period * 1000.0)
+        if err < 0:
+            message.slot = None
+            self.free_slots.insert(0, slot)
+            fman.logFileManager.logEvent("interval buffer {} for id {:#x} failed: {}, sent by the host".format(
+                slot, message.can_id, err))
+
+    # ---------------- timing wheel ----------------
+
+    def _due(self, message):
+        return self.t0 + message.offset + message.cycle * message.period
+
+    def _insert(self, message, due):
+        #ceil, float noise of k * period must not push a due time into the next tick
+        due_tick = int(-(-(due - self.t0 - 1e-9) // self.tick))
+        self.wheel[due_tick % len(self.wheel)].append((due_tick, message))
+
+    def _schedule_first(self, message, now):
+        message.cycle = max(0, int((now - self.t0 - message.offset) // message.period) + 1)
+        self._insert(message, self._due(message))
+
+    def _run(self):
+        wheel = self.wheel
+        size = len(wheel)
+        timer = time.perf_counter
+        current = 0
+        while self._running:
+            now = timer()
+            now_tick = int((now - self.t0) // self.tick)
+            due = []
+            with self.lock:
+                #every tick since the last round, a late wakeup catches up here
+                while current <= now_tick:
+                    bucket = wheel[current % size]
+                    if bucket:
+                        keep = []
+                        for entry in bucket:
+                            (due if entry[0] <= current else keep).append(entry)
+                        wheel[current % size] = keep
+                    current += 1
+                for due_tick, message in due:
+                    late = now - self._due(message)
+                    if late > self.tick:
+                        self.late += 1
+                    if late > self.max_late:
+                        self.max_late = late
+                    #next cycle from the start time, cycles that are already over are skipped
+                    message.cycle += 1
+                    next_due = self._due(message)
+                    if next_due < now:
+                        missed = int((now - next_due) // message.period) + 1
+                        message.cycle += missed
+                        message.skipped += missed
+                        next_due = self._due(message)
+                    self._insert(message, next_due)
+            if due:
+                self._send([message for due_tick, message in due])
+            self._sleep(current, size)
+
+    def _send(self, messages):
+        count = len(messages)
+        msgs = (TCanMsg * count).from_buffer_copy(b"".join([message.raw for message in messages]))
+        res = self.can_driver.CanTransmitFast(self.index, msgs, count)
+        self.batches += 1
+        if res < 0:
+            self.errors += 1
+            if self.errors == 1:
+                fman.logFileManager.logEvent("cyclic tx: CanTransmit failed with {}".format(res))
+            return
+        for message in messages:
+            message.sent += 1
+
+    def _sleep(self, current, size):
+        # sleeps until the next occupied tick, a new message wakes the thread up
+        next_tick = None
+        with self.lock:
+            for ahead in range(size):
+                bucket = self.wheel[(current + ahead) % size]
+                if bucket:
+                    first = min(entry[0] for entry in bucket)
+                    if first <= current + size:
+                        next_tick = max(first, current + ahead)
+                        break
+                    #only entries of a later round (period > wheel span), the earliest of all buckets counts
+                    if next_tick is None or first < next_tick:
+                        next_tick = first
+        if next_tick is None:
+            self.wakeup.wait(0.1)
+            self.wakeup.clear()
+            return
+        target = self.t0 + next_tick * self.tick
+        remaining = target - time.perf_counter()
+        if remaining > self.spin:
+            if self.wakeup.wait(remaining - self.spin):
+                self.wakeup.clear()
+                return
+        while time.perf_counter() < target:
+            pass
+
+    def start(self):
+        with self.lock:
+            self.t0 = time.perf_counter()
+            for message in self.messages:
+                if message.slot is None:
+                    self._schedule_first(message, self.t0 - self.tick)
+        self._running = True
+        #registered while running, stop() takes it out again
+        metrics.registry.add_collector(self._collect)
+        self._thread = threading.Thread(target=self._run, name="cyclic_tx", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self.wakeup.set()
+        if self._thread:
+            self._thread.join(1.0)
+        for message in list(self.messages):
+            if message.slot is not None:
+                self.can_driver.CanTransmitSet(interval_index(self.index, message.slot), 0x8000, 0)
+        metrics.registry.remove_collector(self._collect)
+
+    def _collect(self):
+        labels = {"index": hex(self.index)}
+        stats = self.stats()
+        metrics.registry.counter("can_cyclic_tx_frames_total", "frames sent by the host scheduler", labels).value = stats["sent"]
+        metrics.registry.counter("can_cyclic_tx_late_total", "host sends later than one tick", labels).value = stats["late"]
+        metrics.registry.gauge("can_cyclic_tx_max_late_ms", "largest host send delay", labels).set(stats["max_late_ms"])
+
+    def stats(self):
+        host = [message for message in self.messages if message.slot is None]
+        return {
+            "messages": len(self.messages),
+            "hardware": len(self.messages) - len(host),
+            "sent": sum(message.sent for message in host),
+            "skipped": sum(message.skipped for message in host),
+            "batches": self.batches,
+            "late": self.late,
+            "max_late_ms": self.max_late * 1000,
+            "errors": self.errors,
+        }
@@ -0,0 +1,256 @@
+# shared memory frame bus: the process that owns the tiny-can publishes the raw
+# frames (TCanMsg records, 24 bytes) into a ring in multiprocessing.shared_memory,
+# any number of local processes (decoder, lora uplink, dashboard) read them
+# without sockets, pickling or copies on the publishing side.
+#   bus = FrameBusWriter("can_frames")
+#   router.subscribe(bus.publish, name="frame_bus")
+#   ...in another process:
+#   reader = FrameBusReader("can_frames")
+#   reader.run(local_router.dispatch)       (or reader.read() -> TCanMsg array)
+# frames are numbered from 0 (sequence). the writer keeps two counters: begin
+# (frames up to it are being written) and end (frames up to it are complete).
+# every reader keeps its own cursor (the next sequence it wants). the writer
+# never waits for a reader: a reader that falls more than the ring size behind
+# loses the oldest frames, it sees that from the sequence numbers and counts them.
+# the cursors are published in the reader table of the header, so the writer
+# can report the lag of every reader.
+#
+# layout: header (HEADER_SIZE bytes), then capacity records
+#   magic, version, record size, capacity, writer pid, begin, end (uint64)
+#   reader table: MAX_READERS x (pid, cursor, lost)
+
+import ctypes
+import multiprocessing
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+
+from .. import TinyCan as tiny_can
+from . import metrics
+
+TCanMsg = tiny_can.mhsTinyCanDriver.TCanMsg
+RECORD_SIZE = 24
+MAGIC = b"CANB"
+VERSION = 1
+HEADER = struct.Struct("<4sIIII")
+BEGIN_OFFSET = 24
+END_OFFSET = 32
+READERS_OFFSET = 64
+READER = struct.Struct("<IIQQ")     # pid, unused, cursor, lost
+MAX_READERS = 16
+HEADER_SIZE = 512
+
+
+class _Header:
+    # the counters of the header as ctypes uint64 (aligned single stores / loads)
+    def __init__(self, buf):
+        self.begin = ctypes.c_uint64.from_buffer(buf, BEGIN_OFFSET)
+        self.end = ctypes.c_uint64.from_buffer(buf, END_OFFSET)
+        self.readers = [(ctypes.c_uint32.from_buffer(buf, READERS_OFFSET + n * READER.size),
+                         ctypes.c_uint64.from_buffer(buf, READERS_OFFSET + n * READER.size + 8),
+                         ctypes.c_uint64.from_buffer(buf, READERS_OFFSET + n * READER.size + 16))
+                        for n in range(MAX_READERS)]
+
+
+class FrameBusWriter:
+    def __init__(self, name="can_frames", capacity=1 << 16):
+        # capacity: frames in the ring, 24 bytes each (1.5 MB at 1 << 16)
+        self.name = name
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * RECORD_SIZE
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            #left over from a writer that was killed
+            old = shared_memory.SharedMemory(name=name)
+            old.close()
+            old.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.buf = self.shm.buf
+        self.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        HEADER.pack_into(self.buf, 0, MAGIC, VERSION, RECORD_SIZE, capacity, os.getpid())
+        self.header = _Header(self.buf)
+        self.sequence = 0
+        self._published = metrics.registry.counter("can_bus_frames_published_total",
+                                                   "frames published on the shared memory bus")
+        metrics.registry.add_collector(self._collect)
+
+    def publish(self, raw_msgs):
+        # router subscriber: list of TCanMsg, TCanMsg array or bytes of records
+        if type(raw_msgs) == list:
+            data = b"".join([bytes(raw_msg) for raw_msg in raw_msgs])
+        else:
+            data = memoryview(raw_msgs).cast("B")
+        count = len(data) // RECORD_SIZE
+        if not count:
+            return
+        capacity = self.capacity
+        start = self.sequence
+        if count > capacity:
+            #only the newest capacity frames fit, the others are lost for every reader
+            data = data[(count - capacity) * RECORD_SIZE:]
+            start += count - capacity
+        stop = self.sequence + count
+        self.header.begin.value = stop
+        slot = start % capacity
+        first = min(stop - start, capacity - slot)
+        position = HEADER_SIZE + slot * RECORD_SIZE
+        self.buf[position:position + first * RECORD_SIZE] = data[:first * RECORD_SIZE]
+        if first < stop - start:
+            rest = len(data) - first * RECORD_SIZE
+            self.buf[HEADER_SIZE:HEADER_SIZE + rest] = data[first * RECORD_SIZE:]
+        self.header.end.value = stop
+        self.sequence = stop
+        self._published.inc(count)
+
+    def readers(self):
+        # [(pid, lag in frames, lost frames)] of the attached readers
+        end = self.header.end.value
+        return [(pid.value, end - cursor.value, lost.value)
+                for pid, cursor, lost in self.header.readers if pid.value]
+
+    def _collect(self):
+        if self.header is None:
+            return
+        for pid, lag, lost in self.readers():
+            labels = {"pid": str(pid)}
+            metrics.registry.gauge("can_bus_reader_lag_frames", "frames a bus reader is behind", labels).set(lag)
+            metrics.registry.counter("can_bus_reader_lost_total", "frames a bus reader lost to overruns",
+                                     labels).value = lost
+
+    def close(self, unlink=True):
+        if self.buf is None:
+            return
+        metrics.registry.remove_collector(self._collect)
+        self.header = None
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class FrameBusReader:
+    def __init__(self, name="can_frames", start="end", poll=0.001):
+        # start: "end" -> only frames published from now on, "oldest" -> everything still in the ring
+        self.name = name
+        self.poll = poll
+        #the writer owns the segment, the resource tracker of this process must not remove it at exit
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            #python < 3.13
+            self.shm = shared_memory.SharedMemory(name=name)
+            #a process started by multiprocessing shares the tracker of its parent
+            if multiprocessing.parent_process() is None:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.buf = self.shm.buf
+        magic, version, record_size, capacity, self.writer_pid = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+            self.shm.close()
+            raise ValueError("{} is not a frame bus (version {})".format(name, VERSION))
+        self.capacity = capacity
+        self.header = _Header(self.buf)
+        end = self.header.end.value
+        self.cursor = end if start == "end" else max(0, end - capacity)
+        self.lost = 0
+        self.frames = 0
+        self.slot = self._attach()
+        self.running = False
+
+    def _attach(self):
+        # a free entry of the reader table, None if all are taken (the reader works without)
+        pid = os.getpid()
+        for n, (slot_pid, cursor, lost) in enumerate(self.header.readers):
+            if slot_pid.value in (0, pid) or not _alive(slot_pid.value):
+                slot_pid.value = pid
+                cursor.value = self.cursor
+                lost.value = 0
+                #two readers starting at the same moment may share an entry, that only mixes up their lag report
+                return n
+        return None
+
+    def available(self):
+        # frames published and not read yet (more than capacity: some are lost)
+        return self.header.end.value - self.cursor
+
+    def read_bytes(self, max_frames=None):
+        # records since the last read as bytes (may be empty)
+        end = self.header.end.value
+        cursor = self.cursor
+        if end == cursor:
+            return b""
+        capacity = self.capacity
+        lost = 0
+        if end - cursor > capacity:
+            lost = end - cursor - capacity
+            cursor = end - capacity
+        if max_frames and end - cursor > max_frames:
+            end = cursor + max_frames
+        slot = cursor % capacity
+        first = min(end - cursor, capacity - slot)
+        position = HEADER_SIZE + slot * RECORD_SIZE
+        data = bytes(self.buf[position:position + first * RECORD_SIZE])
+        if first < end - cursor:
+            data += bytes(self.buf[HEADER_SIZE:HEADER_SIZE + (end - cursor - first) * RECORD_SIZE])
+        #the writer may have overwritten the oldest of them while they were copied
+        oldest = self.header.begin.value - capacity
+        if cursor < oldest:
+            skip = min(oldest, end) - cursor
+            data = data[skip * RECORD_SIZE:]
+            lost += skip
+        self.cursor = end
+        self.lost += lost
+        self.frames += len(data) // RECORD_SIZE
+        if self.slot is not None:
+            pid, slot_cursor, slot_lost = self.header.readers[self.slot]
+            slot_cursor.value = end
+            slot_lost.value = self.lost
+        return data
+
+    def read(self, max_frames=None):
+        # TCanMsg array of the new frames, [] if there are none
+        data = self.read_bytes(max_frames)
+        if not data:
+            return []
+        return (TCanMsg * (len(data) // RECORD_SIZE)).from_buffer_copy(data)
+
+    def wait(self, timeout=None):
+        # True when frames are available, polls every poll seconds
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.header.end.value == self.cursor:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll)
+        return True
+
+    def run(self, handler, max_frames=4096):
+        # handler(TCanMsg array) for every batch until stop() (e.g. router.dispatch)
+        self.running = True
+        while self.running:
+            if not self.wait(0.5):
+                continue
+            handler(self.read(max_frames))
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        if self.buf is None:
+            return
+        if self.slot is not None:
+            self.header.readers[self.slot][0].value = 0
+        self.header = None
+        self.buf = None
+        self.shm.close()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
@@ -0,0 +1,320 @@
+# small expression language over can frames and dbc signals, for triggers,
+# router filters and offline queries:
+#   id == 0x628 and BMS_Voltage > 400 and byte[2] & 0x80
+#   id in (0x100, 0x200) and not rtr
+#   abs(Motor_Speed) > 3000 or channel == 1
+# names: id, eff, rtr, tx, dlc, channel, time (device time, s), byte[0..7]
+# and the dbc signal names (physical value). operators: and or not, the
+# comparisons (chained too), in / not in a tuple of numbers, + - * / // % & | ^
+# << >> ~, abs() min() max(). anything else is refused when the text is compiled.
+# a comparison with a signal is false for frames that don't carry the signal.
+#
+# the text is parsed once (python ast, checked against the allowed nodes) and
+# compiled into a python lambda for single frames and into numpy array code
+# for whole logs. expr.ids holds the ids the expression can match at all
+# (None: any id), the router and the trigger capture only evaluate it for them.
+#   expr = frame_expr.compile_expression(text, DBCReader.signal_codecs())
+#   expr(can_id, flags, data)            -> bool
+#   expr.evaluate(array)                 -> bool mask of a log_reader RECORD_DTYPE array
+
+import ast
+from functools import reduce
+
+try:
+    import numpy as np
+except ImportError:
+    np = None   # evaluate() is not available
+
+FLAG_NAMES = {
+    "eff": "(_flags >> 7 & 1)",
+    "rtr": "(_flags >> 6 & 1)",
+    "tx": "(_flags >> 4 & 1)",
+    "dlc": "(_flags & 15)",
+    "channel": "(_flags >> 8 & 255)",
+}
+FUNCTIONS = ("abs", "min", "max")
+
+_BOOL_OPS = {ast.And: "and", ast.Or: "or"}
+_BIN_OPS = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/", ast.FloorDiv: "//", ast.Mod: "%",
+            ast.BitAnd: "&", ast.BitOr: "|", ast.BitXor: "^", ast.LShift: "<<", ast.RShift: ">>"}
+_UNARY_OPS = {ast.USub: "-", ast.UAdd: "+", ast.Invert: "~"}
+_COMPARE_OPS = {ast.Eq: "==", ast.NotEq: "!=", ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">="}
+
+
+def _constant(node):
+    # number of a Constant node, None for anything else
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float, bool):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = _constant(node.operand)
+        return -value if value is not None else None
+    return None
+
+
+def _numbers(node):
+    # the numbers of the tuple / list behind "in"
+    if not isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        raise ValueError("'in' needs a tuple of numbers")
+    values = [_constant(element) for element in node.elts]
+    if None in values:
+        raise ValueError("'in' needs a tuple of numbers")
+    return tuple(values)
+
+
+class _Compiler:
+    # ast -> source text of a python (numpy=False) or numpy expression
+    def __init__(self, signals, numpy):
+        self.signals = signals
+        self.numpy = numpy
+        self.used = {}          # signal name -> argument name
+
+    def signal(self, name):
+        if name not in self.used:
+            self.used[name] = "_s{}".format(len(self.used))
+        return self.used[name]
+
+    def signals_in(self, node):
+        return set(n.id for n in ast.walk(node) if isinstance(n, ast.Name) and n.id in self.signals)
+
+    def condition(self, node):
+        # operand of and / or / not: false for frames without the signals it uses
+        text = self.emit(node)
+        if isinstance(node, ast.BoolOp) or (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not)):
+            #their operands are guarded
+            return text
+        frame_ids = sorted(set(self.signals[name][0] for name in self.signals_in(node)))
+        if not frame_ids:
+            return text
+        guards = ["(_id == {})".format(can_id) for can_id in frame_ids]
+        if self.numpy:
+            return "_all({}, {})".format(", ".join(guards), text)
+        return "({} and {})".format(" and ".join(guards), text)
+
+    def emit(self, node):
+        if isinstance(node, ast.BoolOp):
+            operands = [self.condition(value) for value in node.values]
+            if self.numpy:
+                return "{}({})".format("_all" if isinstance(node.op, ast.And) else "_any", ", ".join(operands))
+            return "(" + " {} ".format(_BOOL_OPS[type(node.op)]).join(operands) + ")"
+        if isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, ast.Not):
+                operand = self.condition(node.operand)
+                return "_not({})".format(operand) if self.numpy else "(not {})".format(operand)
+            return "({}{})".format(_UNARY_OPS[type(node.op)], self.emit(node.operand))
+        if isinstance(node, ast.BinOp):
+            if type(node.op) not in _BIN_OPS:
+                raise ValueError("operator {} is not allowed".format(type(node.op).__name__))
+            return "({} {} {})".format(self.emit(node.left), _BIN_OPS[type(node.op)], self.emit(node.right))
+        if isinstance(node, ast.Compare):
+            return self.compare(node)
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords \
+                    or not node.args or (node.func.id == "abs" and len(node.args) != 1):
+                raise ValueError("only abs(x), min(..) and max(..) can be called")
+            return "_{}({})".format(node.func.id, ", ".join(self.emit(arg) for arg in node.args))
+        if isinstance(node, ast.Subscript):
+            return self.byte(node)
+        if isinstance(node, ast.Name):
+            return self.name(node.id)
+        value = _constant(node)
+        if value is not None:
+            return repr(int(value) if type(value) == bool else value)
+        raise ValueError("'{}' is not allowed in an expression".format(type(node).__name__))
+
+    def compare(self, node):
+        parts = []
+        left = self.emit(node.left)
+        for op, comparator in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                numbers = _numbers(comparator)
+                if self.numpy:
+                    part = "_isin({}, {!r})".format(left, numbers)
+                    part = "_not({})".format(part) if isinstance(op, ast.NotIn) else part
+                else:
+                    part = "({} {} {!r})".format(left, "in" if isinstance(op, ast.In) else "not in", numbers)
+                parts.append(part)
+                left = None
+                continue
+            if type(op) not in _COMPARE_OPS:
+                raise ValueError("comparison {} is not allowed".format(type(op).__name__))
+            right = self.emit(comparator)
+            if left is None:
+                raise ValueError("'in' has to be the last comparison of a chain")
+            parts.append("({} {} {})".format(left, _COMPARE_OPS[type(op)], right))
+            left = right
+        if len(parts) == 1:
+            return parts[0]
+        return "_all({})".format(", ".join(parts)) if self.numpy else "(" + " and ".join(parts) + ")"
+
+    def byte(self, node):
+        index = node.slice
+        if type(index).__name__ == "Index":
+            #python < 3.9
+            index = index.value
+        if not (isinstance(node.value, ast.Name) and node.value.id == "byte"):
+            raise ValueError("only byte[n] can be indexed")
+        index = _constant(index)
+        if type(index) != int or not 0 <= index < 8:
+            raise ValueError("byte index has to be a number 0..7")
+        return "_data[:, {}]".format(index) if self.numpy else "_data[{}]".format(index)
+
+    def name(self, name):
+        if name == "id":
+            return "_id"
+        if name == "time":
+            return "(_t / 1e6)"
+        if name in FLAG_NAMES:
+            return FLAG_NAMES[name]
+        if name in self.signals:
+            if self.numpy:
+                return self.signal(name)
+            return "{}(_data)".format(self.signal(name))
+        if name == "byte":
+            raise ValueError("byte needs an index: byte[n]")
+        raise ValueError("unknown name '{}' (not a frame field or dbc signal)".format(name))
+
+
+def _id_set(node, compiler):
+    # ids a condition can be true for, None: any
+    if isinstance(node, ast.BoolOp):
+        sets = [_id_set(value, compiler) for value in node.values]
+        if isinstance(node.op, ast.And):
+            sets = [s for s in sets if s is not None]
+            return frozenset.intersection(*sets) if sets else None
+        if None in sets:
+            return None
+        return frozenset().union(*sets)
+    if isinstance(node, ast.Compare) and len(node.ops) == 1:
+        left, op, right = node.left, node.ops[0], node.comparators[0]
+        if isinstance(op, ast.Eq) and isinstance(right, ast.Name) and right.id == "id":
+            left, right = right, left
+        if isinstance(left, ast.Name) and left.id == "id":
+            if isinstance(op, ast.Eq) and type(_constant(right)) == int:
+                return frozenset([_constant(right)])
+            if isinstance(op, ast.In):
+                return frozenset(int(value) for value in _numbers(right))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return None
+    frame_ids = set(compiler.signals[name][0] for name in compiler.signals_in(node))
+    if len(frame_ids) > 1:
+        #signals of different frames in one comparison: never true
+        return frozenset()
+    return frozenset(frame_ids) if frame_ids else None
+
+
+def _signal_decoder(codec):
+    # payload bytes -> physical value of one signal
+    shift, mask, scale, offset = codec["shift"], codec["mask"], codec["scale"], codec["offset"]
+    order = "big" if codec["motorola"] else "little"
+    sign_bit = codec["sign_bit"] if codec["signed"] else 0
+
+    def decode(data):
+        raw = (int.from_bytes(data, order) >> shift) & mask
+        if raw & sign_bit:
+            raw -= mask + 1
+        return raw * scale + offset
+    return decode
+
+
+def _signal_column(codec, payloads):
+    # physical values of one signal for every row of the payload column (n, 8)
+    data = np.ascontiguousarray(payloads).view("<u8")[:, 0]
+    if codec["motorola"]:
+        data = data.byteswap()
+    raw = (data >> np.uint64(codec["shift"])) & np.uint64(codec["mask"])
+    raw = raw.astype(np.int64)
+    if codec["signed"]:
+        raw = np.where(raw & codec["sign_bit"], raw - (codec["mask"] + 1), raw)
+    return raw * codec["scale"] + codec["offset"]
+
+
+def _logical(function):
+    return lambda *values: reduce(function, values)
+
+
+class Expression:
+    def __init__(self, source, signals=None):
+        # signals: name -> (can id, codec), see DBCReader.signal_codecs()
+        self.source = source
+        self.signals = signals if signals else {}
+        try:
+            tree = ast.parse(source.strip(), mode="eval")
+        except SyntaxError as e:
+            raise ValueError("can't parse expression '{}': {}".format(source, e.msg))
+        compiler = _Compiler(self.signals, numpy=False)
+        text = compiler.condition(tree.body)
+        self.ids = _id_set(tree.body, compiler)
+        self.used = dict((name, self.signals[name]) for name in compiler.used)
+        namespace = {"__builtins__": {}, "_abs": abs, "_min": min, "_max": max}
+        for name, argument in compiler.used.items():
+            namespace[argument] = _signal_decoder(self.signals[name][1])
+        self.func = eval(compile("lambda _id, _flags, _data, _t=0: " + text, "<frame_expr>", "eval"), namespace)
+        self._tree = tree
+        self._vector = None
+
+    def __repr__(self):
+        return "Expression({!r})".format(self.source)
+
+    def __call__(self, can_id, flags, data, t_us=0):
+        # data: 8 payload bytes
+        try:
+            return bool(self.func(can_id, flags, data, t_us))
+        except ArithmeticError:
+            return False
+
+    def match_msg(self, msg):
+        # TCanMsg
+        return self(msg.Id, msg.Flags.Uint32, bytes(msg.Data), msg.Sec * 1000000 + msg.USec)
+
+    def match_record(self, record):
+        # (Id, Flags, Data, Sec, USec) as read from a binary segment
+        return self(record[0], record[1], record[2], record[3] * 1000000 + record[4])
+
+    def _compile_vector(self):
+        compiler = _Compiler(self.signals, numpy=True)
+        text = compiler.condition(self._tree.body)
+        arguments = ["_id", "_flags", "_data", "_t"] + list(compiler.used.values())
+        namespace = {"__builtins__": {}, "_abs": np.abs, "_min": _logical(np.minimum), "_max": _logical(np.maximum),
+                     "_all": _logical(np.logical_and), "_any": _logical(np.logical_or),
+                     "_not": np.logical_not, "_isin": np.isin}
+        func = eval(compile("lambda {}: {}".format(", ".join(arguments), text), "<frame_expr>", "eval"), namespace)
+        codecs = [self.signals[name][1] for name in compiler.used]
+        return func, codecs
+
+    def evaluate(self, frames):
+        # bool mask over a numpy array of records (log_reader.RECORD_DTYPE)
+        if np is None:
+            raise RuntimeError("numpy is not installed")
+        if self._vector is None:
+            self._vector = self._compile_vector()
+        func, codecs = self._vector
+        if self.ids is not None:
+            wanted = np.isin(frames["Id"], list(self.ids))
+            if not wanted.any():
+                return wanted
+        payloads = frames["Data"]
+        columns = [_signal_column(codec, payloads) for codec in codecs]
+        with np.errstate(all="ignore"):
+            mask = func(frames["Id"].astype(np.int64), frames["Flags"].astype(np.int64), payloads.astype(np.int64),
+                        frames["Sec"].astype(np.int64) * 1000000 + frames["USec"], *columns)
+        mask = np.broadcast_to(np.asarray(mask, dtype=bool), frames.shape)
+        if self.ids is not None:
+            mask = mask & wanted
+        return mask
+
+
+_cache = {}
+
+
+def compile_expression(source, signals=None):
+    # Expression of the text, compiled once per text and signal table
+    if isinstance(source, Expression):
+        return source
+    key = (source, id(signals))
+    cached = _cache.get(key)
+    if cached is not None and cached[0] is signals:
+        return cached[1]
+    expression = Expression(source, signals)
+    #the signal table is kept with it, so its id is not reused while cached
+    _cache[key] = (signals, expression)
+    return expression
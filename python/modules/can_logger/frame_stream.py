@@ -0,0 +1,353 @@
+# live frames over the network, for watching the bus from a laptop
+# the server is a router subscriber: publish() only puts the batch (bytes of
+# TCanMsg records) into the queue of every client and returns, filtering,
+# packing and sending run in the thread of each client, so the local write
+# path doesn't wait for the network.
+#   server = start_stream_server(9110, signals=DBCReader.signal_codecs())
+#   router.subscribe(server.publish, name="stream")
+#   ...on the laptop:
+#   client = FrameStreamClient("logger.local", 9110, expr="id == 0x628 and BMS_Voltage > 400")
+#   client.run(router.dispatch)             (or client.records() like binary_log.iter_records)
+# tcp protocol: the client sends one json line {"ids": [..], "expr": ".."} (both
+# optional, filters applied on the server, expr see frame_expr), the server
+# answers with one json line ({"version", "record_size"} or {"error"}), then
+# sends messages: MESSAGE header (magic, frame count, sequence of the first
+# frame of the published batch, frames dropped for this client so far) and the
+# records. a client whose queue is full loses whole batches (counted in the
+# header), after max_drops batches in a row it is disconnected.
+# udp multicast (optional) sends the unfiltered stream in datagrams of up to
+# DATAGRAM_RECORDS frames, gaps in the sequence are lost datagrams.
+
+import json
+import queue
+import socket
+import socketserver
+import struct
+import threading
+
+from .. import TinyCan as tiny_can
+from .. import file_manager as fman
+from ..file_manager import binary_log
+from . import frame_expr
+from . import metrics
+
+TCanMsg = tiny_can.mhsTinyCanDriver.TCanMsg
+VERSION = 1
+STREAM_PORT = 9110
+MAGIC = b"CANS"
+MESSAGE = struct.Struct("<4sIQI")   # magic, frame count, sequence, dropped
+RECORD = binary_log.RECORD
+RECORD_SIZE = binary_log.RECORD_SIZE
+DATAGRAM_RECORDS = 58               # 24 * 58 + header < 1500 bytes mtu
+SEND_BATCHES = 64                   # queued batches sent with one sendall
+
+
+class _Client:
+    def __init__(self, address, ids, expr, queue_batches):
+        self.address = address
+        self.ids = ids
+        self.expr = expr
+        self.queue = queue.Queue(maxsize=queue_batches)
+        self.dropped = 0
+        self.drops_in_row = 0
+        self.frames_sent = 0
+        self.closed = False
+
+    def filter(self, data):
+        # records of the batch the client asked for
+        if self.ids is None and self.expr is None:
+            return data
+        ids = self.ids if self.ids is not None else self.expr.ids
+        expr = self.expr
+        unpack = RECORD.unpack_from
+        out = []
+        for index, can_id in enumerate(memoryview(data).cast("I")[0::6]):
+            if ids is not None and can_id not in ids:
+                continue
+            position = index * RECORD_SIZE
+            if expr is not None:
+                can_id, flags, payload, sec, usec = unpack(data, position)
+                if not expr(can_id, flags, payload, sec * 1000000 + usec):
+                    continue
+            out.append(data[position:position + RECORD_SIZE])
+        return b"".join(out)
+
+
+class _StreamHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server.stream
+        try:
+            hello = json.loads(self.rfile.readline(65536) or b"{}")
+            ids = set(hello["ids"]) if hello.get("ids") else None
+            expr = frame_expr.compile_expression(hello["expr"], server.signals) if hello.get("expr") else None
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            self.wfile.write((json.dumps({"error": str(e)}) + "\n").encode())
+            return
+        self.wfile.write((json.dumps({"version": VERSION, "record_size": RECORD_SIZE}) + "\n").encode())
+        #a client that stops reading blocks sendall, the timeout ends it
+        self.request.settimeout(server.send_timeout)
+        client = _Client(self.client_address, ids, expr, server.queue_batches)
+        server.add_client(client)
+        try:
+            self._send_loop(client)
+        except OSError:
+            pass
+        finally:
+            server.remove_client(client)
+
+    def _send_loop(self, client):
+        while not client.closed:
+            try:
+                batches = [client.queue.get(timeout=1.0)]
+            except queue.Empty:
+                continue
+            while len(batches) < SEND_BATCHES:
+                try:
+                    batches.append(client.queue.get_nowait())
+                except queue.Empty:
+                    break
+            out = []
+            for sequence, data in batches:
+                if data is None:
+                    #server shutdown
+                    client.closed = True
+                    break
+                data = client.filter(data)
+                if data:
+                    count = len(data) // RECORD_SIZE
+                    out.append(MESSAGE.pack(MAGIC, count, sequence, client.dropped))
+                    out.append(data)
+                    client.frames_sent += count
+            if out:
+                self.request.sendall(b"".join(out))
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FrameStreamServer:
+    def __init__(self, port=STREAM_PORT, host="0.0.0.0", signals=None, queue_batches=256, max_drops=64,
+                 send_timeout=10.0, multicast=None, multicast_ttl=1):
+        # signals: DBCReader.signal_codecs() for client expressions with signal names
+        # queue_batches: batches queued per client, max_drops: full queue this many batches in a row -> disconnect
+        # multicast: (group, port) for the udp stream, None -> off
+        self.signals = signals
+        self.queue_batches = queue_batches
+        self.max_drops = max_drops
+        self.send_timeout = send_timeout
+        self.clients = ()
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.server = _ThreadingTCPServer((host, port), _StreamHandler)
+        self.server.stream = self
+        self.port = self.server.server_address[1]
+        self.multicast = multicast
+        self.udp = None
+        self._udp_queue = None
+        if multicast:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.udp.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            self._udp_queue = queue.Queue(maxsize=queue_batches)
+            threading.Thread(target=self._udp_loop, name="stream_udp", daemon=True).start()
+        self._published = metrics.registry.counter("can_stream_frames_total", "frames handed to the stream server")
+        self._dropped = metrics.registry.counter("can_stream_frames_dropped_total",
+                                                 "frames not sent to slow stream clients")
+        metrics.registry.add_collector(self._collect)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="stream_server", daemon=True).start()
+        return self
+
+    def add_client(self, client):
+        with self.lock:
+            self.clients = self.clients + (client,)
+        fman.logFileManager.logEvent("stream client {} connected".format(client.address))
+
+    def remove_client(self, client):
+        client.closed = True
+        with self.lock:
+            self.clients = tuple(c for c in self.clients if c is not client)
+        fman.logFileManager.logEvent("stream client {} disconnected, {} frames sent, {} dropped".format(
+            client.address, client.frames_sent, client.dropped))
+
+    def publish(self, raw_msgs):
+        # router subscriber: list of TCanMsg, TCanMsg array or bytes of records
+        clients = self.clients
+        if not clients and self.udp is None:
+            return
+        if type(raw_msgs) == list:
+            data = b"".join([bytes(raw_msg) for raw_msg in raw_msgs])
+        else:
+            data = bytes(memoryview(raw_msgs).cast("B"))
+        count = len(data) // RECORD_SIZE
+        batch = (self.sequence, data)
+        self.sequence += count
+        self._published.inc(count)
+        for client in clients:
+            try:
+                client.queue.put_nowait(batch)
+                client.drops_in_row = 0
+            except queue.Full:
+                client.dropped += count
+                client.drops_in_row += 1
+                self._dropped.inc(count)
+                if client.drops_in_row >= self.max_drops:
+                    #the sender thread ends on the next batch it takes
+                    client.closed = True
+        if self._udp_queue is not None:
+            try:
+                self._udp_queue.put_nowait(batch)
+            except queue.Full:
+                self._dropped.inc(count)
+
+    def _udp_loop(self):
+        target = tuple(self.multicast)
+        step = DATAGRAM_RECORDS * RECORD_SIZE
+        while True:
+            sequence, data = self._udp_queue.get()
+            if data is None:
+                return
+            for position in range(0, len(data), step):
+                chunk = data[position:position + step]
+                header = MESSAGE.pack(MAGIC, len(chunk) // RECORD_SIZE, sequence + position // RECORD_SIZE, 0)
+                try:
+                    self.udp.sendto(header + chunk, target)
+                except OSError:
+                    pass
+
+    def _collect(self):
+        metrics.registry.gauge("can_stream_clients", "connected stream clients").set(len(self.clients))
+
+    def close(self):
+        metrics.registry.remove_collector(self._collect)
+        for client in self.clients:
+            try:
+                client.queue.put_nowait((0, None))
+            except queue.Full:
+                client.closed = True
+        if self._udp_queue is not None:
+            self._udp_queue.put((0, None))
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_stream_server(port=STREAM_PORT, host="0.0.0.0", **kwargs):
+    return FrameStreamServer(port, host, **kwargs).start()
+
+
+# ---------------- clients ----------------
+
+def _records(data):
+    unpack = RECORD.unpack_from
+    for position in range(0, len(data), RECORD_SIZE):
+        yield unpack(data, position)
+
+
+class FrameStreamClient:
+    def __init__(self, host, port=STREAM_PORT, ids=None, expr=None, timeout=5.0):
+        # ids / expr: server side filter, expr is the text of a frame_expr expression
+        self.sock = socket.create_connection((host, port), timeout)
+        hello = {"ids": sorted(ids) if ids else None, "expr": expr}
+        self.sock.sendall((json.dumps(hello) + "\n").encode())
+        self.file = self.sock.makefile("rb")
+        reply = json.loads(self.file.readline() or b"{}")
+        if "error" in reply or reply.get("record_size") != RECORD_SIZE:
+            self.close()
+            raise ValueError("stream server refused: {}".format(reply.get("error", reply)))
+        self.sock.settimeout(None)
+        self.sequence = None        # sequence of the last batch
+        self.dropped = 0            # frames the server dropped for this client
+        self.frames = 0
+        self.running = False
+
+    def read_bytes(self):
+        # records of the next message, None when the server closed the connection
+        header = self.file.read(MESSAGE.size)
+        if len(header) < MESSAGE.size:
+            return None
+        magic, count, self.sequence, self.dropped = MESSAGE.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("stream out of sync")
+        data = self.file.read(count * RECORD_SIZE)
+        if len(data) < count * RECORD_SIZE:
+            return None
+        self.frames += count
+        return data
+
+    def read(self):
+        # TCanMsg array of the next message, None at the end
+        data = self.read_bytes()
+        if data is None:
+            return None
+        return (TCanMsg * (len(data) // RECORD_SIZE)).from_buffer_copy(data)
+
+    def records(self):
+        # (Id, Flags, Data, Sec, USec) like binary_log.iter_records, until the connection ends
+        while True:
+            data = self.read_bytes()
+            if data is None:
+                return
+            yield from _records(data)
+
+    def run(self, handler):
+        # handler(TCanMsg array) for every message (e.g. router.dispatch) until stop() or the end
+        self.running = True
+        while self.running:
+            msgs = self.read()
+            if msgs is None:
+                break
+            handler(msgs)
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        try:
+            self.file.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class MulticastClient:
+    # receiver of the udp stream, lost counts the frames of missing datagrams
+    def __init__(self, group, port, interface="0.0.0.0"):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("", port))
+        membership = socket.inet_aton(group) + socket.inet_aton(interface)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.next_sequence = None
+        self.lost = 0
+        self.frames = 0
+
+    def read_bytes(self, timeout=None):
+        # records of the next datagram, b"" on timeout
+        self.sock.settimeout(timeout)
+        try:
+            datagram = self.sock.recv(65536)
+        except socket.timeout:
+            return b""
+        magic, count, sequence, dropped = MESSAGE.unpack_from(datagram)
+        if magic != MAGIC:
+            return b""
+        if self.next_sequence is not None and sequence > self.next_sequence:
+            self.lost += sequence - self.next_sequence
+        self.next_sequence = sequence + count
+        self.frames += count
+        return datagram[MESSAGE.size:MESSAGE.size + count * RECORD_SIZE]
+
+    def read(self, timeout=None):
+        data = self.read_bytes(timeout)
+        if not data:
+            return []
+        return (TCanMsg * (len(data) // RECORD_SIZE)).from_buffer_copy(data)
+
+    def records(self):
+        while True:
+            yield from _records(self.read_bytes())
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,249 @@
+# counters, gauges and histograms for the hot path
+# the rx callback only does a few additions per batch (never per frame), so
+# the instrumentation stays far below 1% of the callback time. values that
+# are expensive to get (device status, queue depths) are read by collectors
+# only when somebody looks: on a scrape of the http endpoint or when the
+# periodic stats line is written.
+#
+#   metrics.start_http_server(9108)      -> curl localhost:9108/metrics (prometheus text format)
+#   metrics.start_stats_reporter(60)     -> stats line every 60 s in the event log
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .. import file_manager as fman
+
+#seconds, for callback duration and writer latency
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+#frames per CanReceive call
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value) for key, value in labels) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, labels=()):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        #last slot counts the values above the highest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q quantile
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            samples.append((self.name + "_bucket", self.labels + (("le", repr(float(bound))),), cumulative))
+        samples.append((self.name + "_bucket", self.labels + (("le", "+Inf"),), self.count))
+        samples.append((self.name + "_sum", self.labels, self.sum))
+        samples.append((self.name + "_count", self.labels, self.count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        labels = tuple(sorted(labels.items())) if labels else ()
+        key = (name, labels)
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = cls(name, labels=labels, **kwargs)
+                    self.metrics[key] = metric
+                    self.help.setdefault(name, (help_text, cls.kind))
+        return metric
+
+    def counter(self, name, help_text="", labels=None):
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text="", labels=None):
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text="", buckets=LATENCY_BUCKETS, labels=None):
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def add_collector(self, collector):
+        # collector() is called before the values are read, e.g. to poll the device status
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        # e.g. when the object it reads is closed
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def collect(self):
+        for collector in list(self.collectors):
+            try:
+                collector()
+            except Exception as e:
+                fman.logFileManager.logEvent("metrics collector {} failed: {}".format(
+                    getattr(collector, "__name__", collector), e))
+
+    def render(self):
+        # prometheus text format
+        self.collect()
+        lines = []
+        written = set()
+        for (name, labels), metric in sorted(self.metrics.items(), key=lambda item: item[0]):
+            if name not in written:
+                help_text, kind = self.help[name]
+                lines.append("# HELP {} {}".format(name, help_text))
+                lines.append("# TYPE {} {}".format(name, kind))
+                written.add(name)
+            for sample_name, sample_labels, value in metric.samples():
+                lines.append("{}{} {}".format(sample_name, _label_text(sample_labels), value))
+        return "\n".join(lines) + "\n"
+
+    def stats_line(self):
+        # short one line summary for the event log
+        self.collect()
+        parts = []
+        for (name, labels), metric in sorted(self.metrics.items(), key=lambda item: item[0]):
+            label = name + _label_text(labels)
+            if metric.kind == "histogram":
+                if metric.count:
+                    parts.append("{}: n={} avg={:.4g} p99<={:.4g}".format(
+                        label, metric.count, metric.sum / metric.count, metric.quantile(0.99)))
+            else:
+                parts.append("{}={}".format(label, metric.value))
+        return "stats " + ", ".join(parts)
+
+
+registry = Registry()
+
+#hot path metrics, updated once per batch
+frames_received = registry.counter("can_frames_received_total", "frames read from the rx fifo")
+frames_unrouted = registry.counter("can_frames_unrouted_total", "frames no subscriber wanted")
+rx_errors = registry.counter("can_rx_errors_total", "CanReceive calls returning an error")
+rx_batch_size = registry.histogram("can_rx_batch_frames", "frames per CanReceive call", buckets=BATCH_BUCKETS)
+rx_callback_seconds = registry.histogram("can_rx_callback_seconds", "duration of the rx callback / rx thread batch")
+bytes_written = registry.counter("can_bytes_written_total", "bytes written to the data file")
+writer_flush_seconds = registry.histogram("can_writer_flush_seconds", "time to write one batch to the data file")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        #no access log on stderr
+        pass
+
+
+def start_http_server(port=9108, host="127.0.0.1", registry=registry):
+    # local only by default, returns the server (server.shutdown() to stop)
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="metrics_http", daemon=True).start()
+    return server
+
+
+class StatsReporter:
+    # writes registry.stats_line() every interval seconds
+    def __init__(self, interval=60.0, registry=registry, sink=None):
+        self.interval = interval
+        self.registry = registry
+        self.sink = sink if sink else fman.logFileManager.logEvent
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sink(self.registry.stats_line())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics_stats", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(1.0)
+        self.sink(self.registry.stats_line())
+
+
+def start_stats_reporter(interval=60.0, registry=registry, sink=None):
+    reporter = StatsReporter(interval, registry=registry, sink=sink)
+    reporter.start()
+    return reporter
+
+
+def timed(histogram):
+    # decorator observing the duration of every call
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - t0)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
@@ -0,0 +1,206 @@
+# several tiny can devices / can buses at once
+# every channel is its own device (opened by serial number) with its own rx
+# fifo and receive thread, so every bus is read independently.
+# the frames of all channels meet in the FrameMerger which hands them to
+# the writer in timestamp order, the channel number travels in the Source
+# byte of the frame flags. every device has its own clock, so the merger
+# orders by host time (ClockSync of the channel) once the clocks are synced
+
+import heapq
+import threading
+import time
+from collections import deque
+
+from .. import TinyCan as tiny_can
+from ..TinyCan.utils import OptionDict2CsvString
+from .clock_sync import ClockSync
+from . import metrics
+from . import profiling
+
+drv = tiny_can.mhsTinyCanDriver
+
+
+def fifo_index(device_index, sub_index=1):
+    # software rx fifo on the device, sub index 0 is the device fifo itself
+    if type(device_index) == drv.TIndex:
+        device_index = device_index.Uint32
+    return (device_index & ~drv.INDEX_FIFO_PUFFER_MASK) | drv.INDEX_SOFT_FLAG | sub_index
+
+
+class CanChannel:
+    def __init__(self, can_driver, snr, tag, baudrate=1000, fifo_size=16384, batch_size=500, device_index=None,
+                 backpressure=None):
+        self.can_driver = can_driver
+        self.snr = snr
+        self.tag = tag
+        self.baudrate = baudrate
+        self.fifo_size = fifo_size
+        self.batch_size = batch_size
+        self.device_index = device_index
+        #backpressure.BackPressure shared by all channels, None -> fixed batch size
+        self.backpressure = backpressure
+        self.fifo_index = None
+        self.event_obj = None
+        self.frames_received = 0
+        self.clock = ClockSync()
+        self._thread = None
+        self._running = False
+
+    def open(self, attempts=5):
+        driver = self.can_driver
+        if self.device_index is None:
+            err, self.device_index = driver.CanExCreateDevice(options="CanRxDFifoSize={}".format(self.fifo_size))
+            if err < 0:
+                return err
+        options = OptionDict2CsvString({"Snr": self.snr, "CanSpeed1": self.baudrate}, drv.TCAN_Keys_CanDeviceOpen)
+        err = -1
+        for attempt in range(attempts):
+            err = driver.CanDeviceOpen(self.device_index, options)
+            if err >= 0:
+                break
+        if err < 0:
+            return err
+
+        #own fifo + event object, the worker sleeps on the event instead of polling
+        self.event_obj = driver.CanExCreateEvent()
+        self.fifo_index = fifo_index(self.device_index)
+        err = driver.CanExCreateFifo(self.fifo_index, self.fifo_size, self.event_obj, drv.MHS_EVENT_RX, 0xFFFFFFFF)
+        if err >= 0:
+            err = driver.CanExBindFifo(self.fifo_index, self.device_index, 1)
+        if err >= 0:
+            err = driver.startCanBus(index=self.device_index)
+        return err
+
+    def start(self, sink):
+        # sink(frames) gets every received batch, already tagged with the channel
+        self._running = True
+        sink = profiling.profiled("rx_{}".format(self.tag))(sink)
+        self._thread = threading.Thread(target=self._rx_worker, args=(sink,),
+                                        name="can_rx_{}".format(self.tag), daemon=True)
+        self._thread.start()
+
+    def _rx_worker(self, sink):
+        driver = self.can_driver
+        timer = time.perf_counter
+        while self._running:
+            events = driver.CanExWaitForEvent(self.event_obj, 100)
+            if events & drv.MHS_TERMINATE:
+                break
+            t0 = timer()
+            num_msg, raw_msgs = driver.CanReceiveFast(self.fifo_index, self.batch_size)
+            if num_msg > 0:
+                self.clock.add_frame(raw_msgs[num_msg - 1])
+            elif num_msg < 0:
+                metrics.rx_errors.inc()
+            if self.backpressure:
+                self.batch_size = self.backpressure.after_receive(num_msg, raw_msgs, self.fifo_index,
+                                                                  self.device_index, self.tag)
+            while num_msg > 0:
+                for raw_msg in raw_msgs:
+                    raw_msg.Flags.FlagBits.Source = self.tag
+                self.frames_received += num_msg
+                metrics.frames_received.inc(num_msg)
+                metrics.rx_batch_size.observe(num_msg)
+                sink(raw_msgs)
+                metrics.rx_callback_seconds.observe(timer() - t0)
+                t0 = timer()
+                #keep reading while the fifo still holds full batches
+                if num_msg < self.batch_size:
+                    break
+                num_msg, raw_msgs = driver.CanReceiveFast(self.fifo_index, self.batch_size)
+                if self.backpressure:
+                    self.batch_size = self.backpressure.after_receive(num_msg, raw_msgs, self.fifo_index,
+                                                                      self.device_index, self.tag)
+
+    def close(self):
+        self._running = False
+        if self.event_obj:
+            self.can_driver.CanExSetEvent(self.event_obj, drv.MHS_TERMINATE)
+        if self._thread:
+            self._thread.join(1.0)
+        if self.fifo_index is not None:
+            self.can_driver.CanExBindFifo(self.fifo_index, self.device_index, 0)
+        self.can_driver.stopCanBus(index=self.device_index)
+        self.can_driver.CanDeviceClose(self.device_index)
+
+
+class FrameMerger:
+    # collects the batches of all channels and writes them in timestamp order.
+    # a frame is written once every active channel has delivered something
+    # newer, channels that were quiet for max_wait seconds don't hold the others back
+    def __init__(self, sink, max_wait=0.05, clocks=None):
+        self.sink = sink
+        self.max_wait = max_wait
+        self.clocks = clocks if clocks else {}
+        self.queues = {}
+        self.last_rx = {}
+        self.condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def push(self, raw_msgs):
+        # router subscriber, one batch always comes from one channel
+        tag = raw_msgs[0].Flags.FlagBits.Source
+        clock = self.clocks.get(tag)
+        if clock is not None and clock.synced():
+            #host time in us: offset + rate * device time
+            offset = clock.offset * 1e6
+            rate = clock.rate
+            frames = [(offset + rate * (raw_msg.Sec * 1000000 + raw_msg.USec), tag, i, raw_msg)
+                      for i, raw_msg in enumerate(raw_msgs)]
+        else:
+            frames = [(raw_msg.Sec * 1000000 + raw_msg.USec, tag, i, raw_msg) for i, raw_msg in enumerate(raw_msgs)]
+        with self.condition:
+            if tag not in self.queues:
+                self.queues[tag] = deque()
+            self.queues[tag].extend(frames)
+            self.last_rx[tag] = time.monotonic()
+            self.condition.notify()
+
+    def depth(self):
+        # frames waiting for the other channels
+        return sum(len(q) for q in list(self.queues.values()))
+
+    def _pop_ready(self, flush=False):
+        now = time.monotonic()
+        watermark = None
+        for tag, q in self.queues.items():
+            if flush or now - self.last_rx[tag] > self.max_wait:
+                continue
+            newest = q[-1][0] if q else None
+            if newest is None:
+                #an active channel without buffered frames, nothing is safe to write yet
+                return []
+            if watermark is None or newest < watermark:
+                watermark = newest
+
+        ready = []
+        for q in self.queues.values():
+            chunk = []
+            while q and (watermark is None or q[0][0] <= watermark):
+                chunk.append(q.popleft())
+            if chunk:
+                ready.append(chunk)
+        return [frame[3] for frame in heapq.merge(*ready)]
+
+    def _run(self):
+        while self._running:
+            with self.condition:
+                self.condition.wait(self.max_wait)
+                frames = self._pop_ready()
+            if frames:
+                self.sink(frames)
+        with self.condition:
+            frames = self._pop_ready(flush=True)
+        if frames:
+            self.sink(frames)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="can_merge", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join(1.0)
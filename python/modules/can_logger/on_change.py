@@ -0,0 +1,161 @@
+# on-change logging: a frame is only written when its payload differs from
+# the last frame of the same id (and channel), or as a keyframe when nothing
+# was written for that id for heartbeat seconds (device time).
+# the suppressed repetitions are not lost: the next written frame of the id
+# carries their number in the upper 16 bits of Flags (binary_log.record_repeats).
+# expand_records() puts them back, evenly spaced between the two written
+# frames, so the reader gets the full stream again (exact payloads, times
+# interpolated - exact for cyclic frames).
+# an id that goes quiet after repetitions gets its last repetition written
+# (with the count) once the heartbeat has passed, see expired().
+# binary format only, the text layout has no field for the repetitions.
+
+import heapq
+import struct
+import time
+
+from .. import TinyCan as tiny_can
+from ..file_manager import binary_log
+from . import metrics
+
+TCanMsg = tiny_can.mhsTinyCanDriver.TCanMsg
+TIME = struct.Struct("<II")
+REPEATS = struct.Struct("<H")
+MAX_REPEATS = 0xFFFF
+
+
+class OnChangeFilter:
+    def __init__(self, heartbeat=1.0):
+        self.heartbeat = heartbeat
+        self.heartbeat_us = int(heartbeat * 1000000)
+        #(id, source byte) -> [flags byte + payload, time of the last written frame, suppressed frames, last suppressed record]
+        self.last = {}
+        #source byte -> device time of the newest frame of the channel
+        self.latest = {}
+        self._next_check = 0.0
+        self.frames_in = 0
+        self.frames_written = 0
+        self._suppressed = metrics.registry.counter("can_frames_suppressed_total",
+                                                    "repeated frames not written by the on-change logging")
+
+    def filter(self, raw_msgs):
+        # returns the frames to write (TCanMsg array, may be empty)
+        if type(raw_msgs) == list:
+            data = b"".join([bytes(raw_msg) for raw_msg in raw_msgs])
+        else:
+            data = bytes(memoryview(raw_msgs).cast("B"))
+        size = binary_log.RECORD_SIZE
+        heartbeat = self.heartbeat_us
+        last = self.last
+        latest = self.latest
+        unpack_time = TIME.unpack_from
+        out = []
+        for position in range(0, len(data), size):
+            record = data[position:position + size]
+            key = record[0:4] + record[5:6]
+            content = record[4:5] + record[8:16]
+            sec, usec = unpack_time(record, 16)
+            t_us = sec * 1000000 + usec
+            latest[key[4:]] = t_us
+            state = last.get(key)
+            if state is None:
+                last[key] = [content, t_us, 0, None]
+                out.append(record)
+            elif state[0] != content or t_us - state[1] >= heartbeat or state[2] >= MAX_REPEATS:
+                out.append(record[:6] + REPEATS.pack(state[2]) + record[8:])
+                state[0] = content
+                state[1] = t_us
+                state[2] = 0
+                state[3] = None
+            else:
+                state[2] += 1
+                state[3] = record
+        count = len(data) // size
+        self.frames_in += count
+        self.frames_written += len(out)
+        self._suppressed.inc(count - len(out))
+        if not out:
+            return []
+        return (TCanMsg * len(out)).from_buffer_copy(b"".join(out))
+
+    def expired(self):
+        # last suppressed frame of the ids that stayed quiet for a heartbeat (TCanMsg array, may be empty),
+        # looked at once per heartbeat of host time. the frames are older than the last written ones,
+        # SegmentWriter.insert_frames puts them at their time position
+        now = time.monotonic()
+        if now < self._next_check:
+            return []
+        self._next_check = now + self.heartbeat
+        heartbeat = self.heartbeat_us
+        latest = self.latest
+        out = []
+        for key, state in self.last.items():
+            #a frame of the id within the heartbeat would have been written as keyframe
+            if state[3] is not None and latest[key[4:]] - state[1] >= heartbeat:
+                record = state[3]
+                out.append(record[:6] + REPEATS.pack(state[2] - 1) + record[8:])
+                sec, usec = TIME.unpack_from(record, 16)
+                state[1] = sec * 1000000 + usec
+                state[2] = 0
+                state[3] = None
+        self.frames_written += len(out)
+        if not out:
+            return []
+        return (TCanMsg * len(out)).from_buffer_copy(b"".join(out))
+
+    def flush(self):
+        # last suppressed frame of every id as a normal frame, then every id starts
+        # with a keyframe again (called before a segment is closed, so segments stand alone).
+        # the frames are older than the last written ones, SegmentWriter inserts them
+        # at their time position
+        out = []
+        for state in self.last.values():
+            if state[3] is not None:
+                record = state[3]
+                out.append(record[:6] + REPEATS.pack(state[2] - 1) + record[8:])
+        self.last = {}
+        self.frames_written += len(out)
+        if not out:
+            return []
+        return (TCanMsg * len(out)).from_buffer_copy(b"".join(out))
+
+    def ratio(self):
+        # written / received
+        return self.frames_written / float(self.frames_in) if self.frames_in else 1.0
+
+
+def expand_records(records, heartbeat=1.0):
+    # full stream of an on-change recording, in time order.
+    # the repetitions of a frame are only known at the next written frame of the
+    # id, at most about two heartbeats later, so the output lags that far behind
+    horizon = int(2 * heartbeat * 1000000)
+    pending = []
+    last = {}
+    n = 0
+    for can_id, flags, data, sec, usec in records:
+        t_us = sec * 1000000 + usec
+        repeats = binary_log.record_repeats(flags)
+        flags &= ~binary_log.FLAG_REPEATS
+        key = (can_id, binary_log.record_channel(flags))
+        previous = last.get(key)
+        if repeats and previous:
+            p_us, p_flags, p_data = previous
+            step = (t_us - p_us) / float(repeats + 1)
+            for k in range(1, repeats + 1):
+                r_us = int(p_us + step * k)
+                heapq.heappush(pending, (r_us, n, (can_id, p_flags, p_data, r_us // 1000000, r_us % 1000000)))
+                n += 1
+        heapq.heappush(pending, (t_us, n, (can_id, flags, data, sec, usec)))
+        n += 1
+        last[key] = (t_us, flags, data)
+        while pending and pending[0][0] <= t_us - horizon:
+            yield heapq.heappop(pending)[2]
+    while pending:
+        yield heapq.heappop(pending)[2]
+
+
+def is_on_change(file_name):
+    # heartbeat of an on-change binary segment, None for a normal recording
+    info = binary_log.read_header(file_name)["info"]
+    on_change = info.get("on_change")
+    return on_change.get("heartbeat") if on_change else None
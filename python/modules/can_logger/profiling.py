@@ -0,0 +1,294 @@
+# profiling of a running logger without a restart
+# the rx callback, the decoder and the writer are wrapped with profiled(),
+# while profiling is off the wrapper only checks one flag. switched on (by
+# SIGUSR1 or the control socket) it runs for a bounded window and writes
+# the result to LOGS/:
+#   "cprofile"  every wrapped call runs under cProfile (one profile per
+#               thread, since python 3.12 cProfile is process wide: one shared
+#               profile, on while any thread is inside a wrapped call),
+#               result as .pstats + a text summary sorted by cumtime
+#   "sample"    a thread looks at the stacks of the threads inside a wrapped
+#               call every interval, result as collapsed stacks
+#               (flamegraph.pl / speedscope), much less overhead than cProfile
+#
+#   kill -USR1 <pid>                               -> start / stop with the default mode
+#   echo "start sample 20" | nc 127.0.0.1 9109     -> control socket
+
+import cProfile
+import io
+import os
+import pstats
+import signal
+import socketserver
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from .. import file_manager as fman
+
+#cProfile sits on sys.monitoring, only one profile can be enabled in the process
+SHARED_PROFILE = sys.version_info >= (3, 12)
+
+
+class Profiler:
+    def __init__(self, folder="LOGS", interval=0.005):
+        self.folder = folder
+        self.interval = interval
+        self.active = False
+        self.mode = None
+        self.started = None
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self._generation = 0
+        self._profiles = []
+        self._shared = None
+        self._shared_depth = 0
+        self._unprofiled = 0
+        self._sections = {}
+        self._stacks = defaultdict(int)
+        self._samples = 0
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def start(self, mode="cprofile", duration=30.0):
+        # profiles for duration seconds (None -> until stop()), returns 0 if it was already running
+        with self.lock:
+            if self.active:
+                return 0
+            if mode not in ("cprofile", "sample"):
+                raise ValueError("unknown profiling mode {}".format(mode))
+            self.mode = mode
+            self._generation += 1
+            self._profiles = []
+            self._shared = None
+            self._shared_depth = 0
+            self._unprofiled = 0
+            self._sections = {}
+            self._stacks = defaultdict(int)
+            self._samples = 0
+            self._stop_event = threading.Event()
+            self.started = time.time()
+            self.active = True
+        self._threads = []
+        if mode == "sample":
+            self._threads.append(threading.Thread(target=self._sampler, name="profile_sampler", daemon=True))
+        if duration:
+            self._threads.append(threading.Thread(target=self._timer, args=(duration,),
+                                                  name="profile_timer", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        fman.logFileManager.logEvent("profiling started ({}, {} s)".format(mode, duration))
+        return 1
+
+    def stop(self):
+        # ends the window and writes the result, returns the file name
+        with self.lock:
+            if not self.active:
+                return None
+            self.active = False
+            self._stop_event.set()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(1.0)
+        if not os.path.isdir(self.folder):
+            os.mkdir(self.folder)
+        name = os.path.join(self.folder, "profile_{}".format(fman.general_file_functions.timestamp("file")))
+        if self.mode == "cprofile":
+            file_name = self._dump_pstats(name)
+        else:
+            file_name = self._dump_collapsed(name)
+        fman.logFileManager.logEvent("profiling stopped, result in {}".format(file_name))
+        return file_name
+
+    def toggle(self, mode="cprofile", duration=30.0):
+        if self.active:
+            return self.stop()
+        return self.start(mode, duration)
+
+    def status(self):
+        if not self.active:
+            return "off"
+        return "{} for {:.1f} s".format(self.mode, time.time() - self.started)
+
+    def call(self, name, func, args, kwargs):
+        # runs func inside a profiled section
+        local = self._local
+        if getattr(local, "depth", 0):
+            #nested section, the outer one already covers it
+            return func(*args, **kwargs)
+        local.depth = 1
+        try:
+            if self.mode == "cprofile":
+                if SHARED_PROFILE:
+                    return self._call_shared(func, args, kwargs)
+                profile = getattr(local, "profile", None)
+                if profile is None or local.generation != self._generation:
+                    profile = cProfile.Profile()
+                    local.profile = profile
+                    local.generation = self._generation
+                    with self.lock:
+                        self._profiles.append(profile)
+                try:
+                    profile.enable()
+                except ValueError:
+                    #another profiler (debugger, coverage) holds the hook
+                    self._unprofiled += 1
+                    return func(*args, **kwargs)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profile.disable()
+            ident = threading.get_ident()
+            self._sections[ident] = name
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._sections.pop(ident, None)
+        finally:
+            local.depth = 0
+
+    def _call_shared(self, func, args, kwargs):
+        # the first thread entering a wrapped call enables the shared profile, the last one leaving disables it
+        with self.lock:
+            profile = self._shared
+            if profile is None:
+                profile = self._shared = cProfile.Profile()
+                self._profiles.append(profile)
+            if not self._shared_depth:
+                try:
+                    profile.enable()
+                except ValueError:
+                    profile = None
+            if profile is not None:
+                self._shared_depth += 1
+            else:
+                self._unprofiled += 1
+        if profile is None:
+            #another profiler (debugger, coverage) holds the hook
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self.lock:
+                #a new window may have replaced the profile meanwhile
+                if profile is self._shared:
+                    self._shared_depth -= 1
+                    if not self._shared_depth:
+                        profile.disable()
+
+    def _timer(self, duration):
+        if not self._stop_event.wait(duration):
+            self.stop()
+
+    def _sampler(self):
+        stacks = self._stacks
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, name in list(self._sections.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(name)
+                stacks[";".join(reversed(stack))] += 1
+            self._samples += 1
+
+    def _dump_pstats(self, name):
+        with self.lock:
+            profiles = list(self._profiles)
+            self._shared = None
+            self._shared_depth = 0
+        if self._unprofiled:
+            fman.logFileManager.logEvent("{} profiled calls ran without cProfile, "
+                                         "another profiler was active".format(self._unprofiled))
+        #profiles that never collected anything can't be loaded by pstats
+        for profile in profiles:
+            profile.create_stats()
+        profiles = [profile for profile in profiles if profile.stats]
+        file_name = name + ".pstats"
+        if not profiles:
+            open(file_name, "w").close()
+            return file_name
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(file_name)
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats("cumulative").print_stats(40)
+        with open(name + ".txt", "w") as f:
+            f.write(summary.getvalue())
+        return file_name
+
+    def _dump_collapsed(self, name):
+        file_name = name + ".collapsed"
+        with open(file_name, "w") as f:
+            for stack, count in sorted(self._stacks.items()):
+                f.write("{} {}\n".format(stack, count))
+        return file_name
+
+
+profiler = Profiler()
+
+
+def profiled(name, profiler=profiler):
+    # decorator, marks func as a profiled section
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if not profiler.active:
+                return func(*args, **kwargs)
+            return profiler.call(name, func, args, kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorator
+
+
+def install_signal_handler(signum=None, mode="cprofile", duration=30.0, profiler=profiler):
+    # kill -USR1 starts a window, a second one ends it early. main thread only
+    if signum is None:
+        signum = getattr(signal, "SIGUSR1", None)
+        if signum is None:
+            #windows
+            return None
+
+    def handler(signum, frame):
+        #file writing happens outside of the signal handler
+        threading.Thread(target=profiler.toggle, args=(mode, duration), name="profile_toggle", daemon=True).start()
+    return signal.signal(signum, handler)
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    # one command per line: "start [cprofile|sample] [seconds]", "stop", "status"
+    def handle(self):
+        profiler = self.server.profiler
+        for line in self.rfile:
+            words = line.decode(errors="ignore").split()
+            if not words:
+                continue
+            try:
+                if words[0] == "start":
+                    mode = words[1] if len(words) > 1 else "cprofile"
+                    duration = float(words[2]) if len(words) > 2 else 30.0
+                    reply = "started" if profiler.start(mode, duration) else "already running"
+                elif words[0] == "stop":
+                    reply = "written {}".format(profiler.stop())
+                elif words[0] == "status":
+                    reply = profiler.status()
+                else:
+                    reply = "unknown command {}".format(words[0])
+            except ValueError as e:
+                reply = "error {}".format(e)
+            self.wfile.write((reply + "\n").encode())
+
+
+def start_control_server(port=9109, host="127.0.0.1", profiler=profiler):
+    server = socketserver.ThreadingTCPServer((host, port), _ControlHandler)
+    server.daemon_threads = True
+    server.profiler = profiler
+    threading.Thread(target=server.serve_forever, name="profile_control", daemon=True).start()
+    return server
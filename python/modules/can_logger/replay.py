@@ -0,0 +1,160 @@
+# plays recorded data files back, either onto the bus or straight into the
+# router as if the frames just came out of CanReceive.
+# speed 1.0 keeps the original timing, 2.0 / 10.0 play faster and None plays
+# as fast as possible (for throughput measurements of decoder and writer).
+# the send times are computed from the start of the replay, so a late wakeup
+# is caught up with the next batch instead of shifting everything after it.
+# we sleep until shortly before a batch is due and spin the rest of the way
+
+import threading
+import time
+
+from .. import TinyCan as tiny_can
+from ..file_manager import binary_log
+from ..file_manager import text_log
+from . import on_change
+
+TCanMsg = tiny_can.mhsTinyCanDriver.TCanMsg
+
+
+def iter_recording(file_name):
+    # records of a binary segment or a text data file
+    with open(file_name, "rb") as f:
+        magic = f.read(len(binary_log.MAGIC))
+    if magic == binary_log.MAGIC:
+        heartbeat = on_change.is_on_change(file_name)
+        if heartbeat:
+            #repetitions left out by the on-change logging are put back
+            return on_change.expand_records(binary_log.iter_records(file_name), heartbeat)
+        return binary_log.iter_records(file_name)
+    return text_log.iter_records(file_name)
+
+
+def records_to_msgs(records, flags_mask=None):
+    # records have the TCanMsg layout, so packing them gives the ctypes array directly
+    # flags_mask: clears flag bits, e.g. TX_FLAGS_MASK for frames that go on the bus
+    pack = binary_log.RECORD.pack
+    if flags_mask is None:
+        buffer = b"".join([pack(*record) for record in records])
+    else:
+        buffer = b"".join([pack(can_id, flags & flags_mask, data, sec, usec)
+                           for can_id, flags, data, sec, usec in records])
+    return (TCanMsg * len(records)).from_buffer_copy(buffer)
+
+
+class PipelineSink:
+    # hands the frames to a router (or anything with dispatch(frames))
+    def __init__(self, router):
+        self.router = router
+
+    def __call__(self, records):
+        self.router.dispatch(records_to_msgs(records))
+
+
+class DriverSink:
+    # puts the frames on the bus, one CanTransmit call per batch
+    def __init__(self, can_driver, index=None):
+        self.can_driver = can_driver
+        self.index = index if index is not None else can_driver.DefaultIndex
+        self.errors = 0
+        #frames the tx fifo had no room for
+        self.dropped = 0
+        self.tx_pending = 0
+
+    def __call__(self, records):
+        msgs = records_to_msgs(records, flags_mask=tiny_can.mhsTinyCanDriver.TX_FLAGS_MASK)
+        written, self.tx_pending = self.can_driver.TransmitBatch(msgs, self.index)
+        if written < 0:
+            self.errors += 1
+            self.dropped += len(msgs)
+        elif written < len(msgs):
+            self.dropped += len(msgs) - written
+
+
+class ReplayEngine:
+    def __init__(self, records, sink, speed=1.0, batch_window=0.0005, max_batch=500, spin=0.002):
+        # records: iterable of (Id, Flags, Data, Sec, USec), sink(records) gets the batches
+        # batch_window: frames due within this time (s) are sent together
+        self.records = records
+        self.sink = sink
+        self.speed = speed
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.spin = spin
+        self.frames = 0
+        self.batches = 0
+        self.late_batches = 0
+        self.max_late = 0.0
+        self.duration = 0.0
+        self._running = False
+        self._thread = None
+
+    def _wait_until(self, target):
+        remaining = target - time.perf_counter()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while time.perf_counter() < target:
+            pass
+
+    def _send(self, batch, due):
+        if due is not None:
+            now = time.perf_counter()
+            if now < due:
+                self._wait_until(due)
+            else:
+                late = now - due
+                if late > self.batch_window:
+                    self.late_batches += 1
+                if late > self.max_late:
+                    self.max_late = late
+        self.sink(batch)
+        self.frames += len(batch)
+        self.batches += 1
+
+    def run(self):
+        self._running = True
+        start = time.perf_counter()
+        t0 = None
+        batch = []
+        batch_due = None
+        for record in self.records:
+            if not self._running:
+                break
+            if self.speed:
+                t_us = record[3] * 1000000 + record[4]
+                if t0 is None:
+                    t0 = t_us
+                due = start + (t_us - t0) / 1e6 / self.speed
+                if batch and (due - batch_due > self.batch_window or len(batch) >= self.max_batch):
+                    self._send(batch, batch_due)
+                    batch = []
+                if not batch:
+                    batch_due = due
+            elif len(batch) >= self.max_batch:
+                self._send(batch, None)
+                batch = []
+            batch.append(record)
+        if batch and self._running:
+            self._send(batch, batch_due)
+        self.duration = time.perf_counter() - start
+        self._running = False
+        return self.stats()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="can_replay", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join(1.0)
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "batches": self.batches,
+            "duration_s": self.duration,
+            "frames_per_s": self.frames / self.duration if self.duration else 0.0,
+            "late_batches": self.late_batches,
+            "max_late_ms": self.max_late * 1000,
+        }
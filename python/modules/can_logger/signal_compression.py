@@ -0,0 +1,234 @@
+# lossy but bounded compression of decoded signals
+# a sample is only stored when the signal can't be reconstructed from the
+# stored ones within its tolerance:
+#   "swinging_door"  linear interpolation between the stored samples stays
+#                    within +-tolerance of every sample left out (a stored
+#                    value may be moved by up to tolerance to achieve that)
+#   "deadband"       the value moved more than tolerance from the last stored one
+# the tolerance is set per dbc signal, the default is the scale factor of the
+# signal times default_factor (one raw step). max_gap forces a sample after
+# that many seconds, so a dashboard always has recent points.
+# slow temperatures and voltages shrink to a few samples per minute.
+#
+# the decoder (startCanLogger.decode_frames) hands every decoded frame to a
+# SignalLogWriter, the stored samples go to LOGS/<name>_SIGNALS_<n>.txt:
+#   #signals;{"mode": .., "signals": {name: {"unit": .., "tolerance": ..}}}
+#   tTime;signal;value
+
+import json
+import os
+
+from .. import file_manager as fman
+from . import metrics
+
+MODES = ("swinging_door", "deadband")
+
+
+class SwingingDoor:
+    # one signal, times in us
+    def __init__(self, tolerance, max_gap_us=None):
+        self.tolerance = tolerance
+        self.max_gap_us = max_gap_us
+        self.stored = None      # last stored (t, v)
+        self.previous = None    # last sample that came in, not stored yet
+        self.upper = float("inf")
+        self.lower = float("-inf")
+
+    def _store(self, t, v):
+        self.stored = (t, v)
+        self.previous = None
+        self.upper = float("inf")
+        self.lower = float("-inf")
+        return (t, v)
+
+    def _doors(self, t, v):
+        # slopes from the stored sample that keep every sample since then within the tolerance
+        t0, v0 = self.stored
+        dt = float(t - t0)
+        return min(self.upper, (v + self.tolerance - v0) / dt), max(self.lower, (v - self.tolerance - v0) / dt)
+
+    def _fitted(self):
+        # the not yet stored sample, moved onto the doors if its own value doesn't fit
+        # (at most tolerance), so the line to it stays within the tolerance of every sample
+        t0, v0 = self.stored
+        t, v = self.previous
+        slope = min(max((v - v0) / float(t - t0), self.lower), self.upper)
+        return (t, v0 + slope * (t - t0))
+
+    def _take(self, t, v):
+        # sample becomes the one that is held back, the doors are narrowed with it
+        if t <= self.stored[0]:
+            if abs(v - self.stored[1]) <= self.tolerance:
+                return []
+            return [self._store(t, v)]
+        self.upper, self.lower = self._doors(t, v)
+        self.previous = (t, v)
+        return []
+
+    def add(self, t, v):
+        # returns the samples to store (0, 1 or 2)
+        if self.stored is None:
+            return [self._store(t, v)]
+        if self.max_gap_us and t - self.stored[0] >= self.max_gap_us:
+            out = [self._store(*self._fitted())] if self.previous else []
+            return out + [self._store(t, v)]
+        if t > self.stored[0]:
+            upper, lower = self._doors(t, v)
+            if lower <= upper:
+                self.upper, self.lower = upper, lower
+                self.previous = (t, v)
+                return []
+        #the doors closed: the held back sample is stored and starts new doors
+        if self.previous:
+            out = [self._store(*self._fitted())]
+            return out + self._take(t, v)
+        return [self._store(t, v)]
+
+    def flush(self):
+        if self.previous:
+            return [self._store(*self._fitted())]
+        return []
+
+
+class Deadband(SwingingDoor):
+    def add(self, t, v):
+        if self.stored is None or abs(v - self.stored[1]) > self.tolerance or \
+                (self.max_gap_us and t - self.stored[0] >= self.max_gap_us):
+            return [self._store(t, v)]
+        self.previous = (t, v)
+        return []
+
+    def flush(self):
+        #the last value is kept so a reader knows where the signal ended
+        if self.previous and self.previous[1] != self.stored[1]:
+            return [self._store(*self.previous)]
+        return []
+
+
+def default_tolerances(dbc_frames, factor=1.0):
+    # scale factor of every signal times factor
+    tolerances = {}
+    for frame in dbc_frames.values():
+        for name, signal in frame.get("signals").items():
+            tolerances[name] = abs(float(signal.get("scale"))) * factor
+    return tolerances
+
+
+class SignalCompressor:
+    def __init__(self, dbc_frames, tolerances=None, default_factor=1.0, mode="swinging_door", max_gap=None):
+        # tolerances: signal name -> tolerance (physical unit), the others get the default
+        if mode not in MODES:
+            raise ValueError("unknown compression mode {}".format(mode))
+        self.mode = mode
+        self.tolerances = default_tolerances(dbc_frames, default_factor)
+        if tolerances:
+            self.tolerances.update(tolerances)
+        self.max_gap_us = int(max_gap * 1000000) if max_gap else None
+        self.signals = {}
+        self.samples_in = 0
+        self.samples_out = 0
+
+    def _signal(self, name):
+        compressor = self.signals.get(name)
+        if compressor is None:
+            cls = SwingingDoor if self.mode == "swinging_door" else Deadband
+            compressor = cls(self.tolerances.get(name, 0.0), self.max_gap_us)
+            self.signals[name] = compressor
+        return compressor
+
+    def add_frame(self, t_us, decoded):
+        # decoded: result of DBCReader.convert_can_frame_to_signals, returns [(t, signal, value)]
+        out = []
+        signals = self.signals
+        for name, signal in decoded.items():
+            compressor = signals.get(name) or self._signal(name)
+            for t, v in compressor.add(t_us, signal["data"]):
+                out.append((t, name, v))
+        self.samples_in += len(decoded)
+        self.samples_out += len(out)
+        return out
+
+    def flush(self):
+        out = []
+        for name, compressor in self.signals.items():
+            for t, v in compressor.flush():
+                out.append((t, name, v))
+        self.samples_out += len(out)
+        return out
+
+    def ratio(self):
+        # stored / decoded samples
+        return self.samples_out / float(self.samples_in) if self.samples_in else 1.0
+
+
+class SignalLogWriter:
+    # compressed decoded signals -> text file, a new file after max_lines samples
+    def __init__(self, name, dbc_frames, compressor=None, max_lines=1000000, folder="LOGS"):
+        self.name = name
+        self.folder = folder
+        self.compressor = compressor if compressor else SignalCompressor(dbc_frames)
+        self.units = {}
+        for frame in dbc_frames.values():
+            for signal_name, signal in frame.get("signals").items():
+                self.units[signal_name] = str(signal.get("unit")).strip('"')
+        self.max_lines = max_lines
+        self.file = None
+        self.file_name = None
+        self.file_nr = 0
+        self.lines = 0
+        self._samples = metrics.registry.counter("can_signal_samples_total", "decoded signal samples")
+        self._stored = metrics.registry.counter("can_signal_samples_stored_total", "signal samples kept by the compression")
+
+    def _open(self):
+        if not os.path.isdir(self.folder):
+            os.mkdir(self.folder)
+        while True:
+            file_name = os.path.join(self.folder, "{}_SIGNALS_{}.txt".format(self.name, self.file_nr))
+            if not os.path.exists(file_name):
+                break
+            self.file_nr += 1
+        self.file_name = file_name
+        self.file = open(file_name, "w")
+        header = dict((name, {"unit": self.units.get(name, ""), "tolerance": tolerance})
+                      for name, tolerance in self.compressor.tolerances.items())
+        self.file.write("#signals;" + json.dumps({"mode": self.compressor.mode, "signals": header}) + "\n")
+        self.lines = 0
+
+    def write(self, samples):
+        if not samples:
+            return
+        if not self.file:
+            self._open()
+        self.file.write("".join(["{};{};{!r}\n".format(t, name, value) for t, name, value in samples]))
+        self.lines += len(samples)
+        self._stored.inc(len(samples))
+        if self.lines >= self.max_lines:
+            self.file.close()
+            self.file = None
+            self.file_nr += 1
+
+    def add_frame(self, t_us, decoded):
+        self._samples.inc(len(decoded))
+        self.write(self.compressor.add_frame(t_us, decoded))
+
+    def close(self):
+        self.write(self.compressor.flush())
+        if self.file:
+            self.file.close()
+            self.file = None
+        fman.logFileManager.logEvent("signal log: {} of {} samples stored ({:.1%})".format(
+            self.compressor.samples_out, self.compressor.samples_in, self.compressor.ratio()))
+
+
+def read_signal_log(file_name):
+    # {signal: ([t_us], [value])} of a signal log file
+    signals = {}
+    with open(file_name) as f:
+        for line in f:
+            if line[0] == "#":
+                continue
+            t, name, value = line.rstrip("\n").split(";")
+            times, values = signals.setdefault(name, ([], []))
+            times.append(int(t))
+            values.append(float(value))
+    return signals
@@ -0,0 +1,387 @@
+# socketcan backend (linux): frames from a can / vcan interface instead of the
+# tiny-can, and a mirror of the received frames out to a (v)can interface, so
+# candump / can-utils and the benchmark harness can use the same pipeline,
+# and the logger can be tested at full rate on any linux box:
+#   sudo ip link add dev vcan0 type vcan && sudo ip link set up vcan0
+#   channel = SocketCanChannel("vcan0"); channel.open(); channel.start(router.dispatch)
+#   mirror = SocketCanSink("vcan0"); router.subscribe(mirror.send, name="socketcan_mirror")
+# the frames are read in batches: one recvmmsg() call (libc through ctypes)
+# returns up to batch_size frames with their kernel timestamps, they become
+# one TCanMsg array like CanReceiveFast returns. without recvmmsg the socket
+# is drained with recvmsg() until it is empty. sending uses sendmmsg() the same way.
+# struct can_frame: can_id (flags in the top 3 bits), len, 3 bytes padding, data[8]
+
+import ctypes
+import ctypes.util
+import errno
+import select
+import socket
+import struct
+import threading
+import time
+
+from .. import TinyCan as tiny_can
+from .. import file_manager as fman
+from ..file_manager import binary_log
+from . import can_filter
+from . import clock_sync
+from . import metrics
+from . import profiling
+
+TCanMsg = tiny_can.mhsTinyCanDriver.TCanMsg
+CAN_FRAME = struct.Struct("=IB3x8s")
+CAN_FRAME_SIZE = CAN_FRAME.size
+CAN_EFF_FLAG = 0x80000000
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+CAN_EFF_MASK = 0x1FFFFFFF
+CAN_SFF_MASK = 0x7FF
+SO_TIMESTAMP = getattr(socket, "SO_TIMESTAMP", 29)
+MSG_DONTWAIT = 0x40
+TIMEVAL = struct.Struct("@ll")
+CAN_RAW_FILTER_MAX = 512
+RECORD = binary_log.RECORD
+FLAG_RTR = binary_log.FLAG_RTR
+FLAG_EFF = binary_log.FLAG_EFF
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def _cmsg_align(size):
+    align = ctypes.sizeof(ctypes.c_size_t)
+    return (size + align - 1) & ~(align - 1)
+
+
+# cmsghdr: size_t len, int level, int type, then the data (aligned)
+CMSG_DATA_OFFSET = _cmsg_align(ctypes.sizeof(ctypes.c_size_t) + 8)
+CONTROL_SIZE = CMSG_DATA_OFFSET + _cmsg_align(TIMEVAL.size)
+CMSG_HEADER = struct.Struct("@Nii")
+
+
+def _libc_function(name):
+    # recvmmsg / sendmmsg of the libc, None if there is none
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        function = getattr(libc, name)
+    except (OSError, AttributeError, TypeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    function.restype = ctypes.c_int
+    return function
+
+
+_recvmmsg = _libc_function("recvmmsg")
+_sendmmsg = _libc_function("sendmmsg")
+
+
+def frames_to_records(data, times, tag=0):
+    # can_frame bytes + [t_us] -> bytes of TCanMsg records, error frames are left out
+    pack = RECORD.pack
+    unpack = CAN_FRAME.unpack_from
+    out = []
+    for n, t_us in enumerate(times):
+        can_id, dlc, payload = unpack(data, n * CAN_FRAME_SIZE)
+        if can_id & CAN_ERR_FLAG:
+            continue
+        flags = min(dlc, 8) | tag << 8
+        if can_id & CAN_RTR_FLAG:
+            flags |= FLAG_RTR
+        if can_id & CAN_EFF_FLAG:
+            flags |= FLAG_EFF
+            can_id &= CAN_EFF_MASK
+        else:
+            can_id &= CAN_SFF_MASK
+        out.append(pack(can_id, flags, payload, t_us // 1000000, t_us % 1000000))
+    return b"".join(out)
+
+
+def records_to_frames(data):
+    # bytes of TCanMsg records -> can_frame bytes
+    pack = CAN_FRAME.pack
+    out = []
+    for can_id, flags, payload, sec, usec in RECORD.iter_unpack(data):
+        if flags & FLAG_EFF:
+            can_id = (can_id & CAN_EFF_MASK) | CAN_EFF_FLAG
+        if flags & FLAG_RTR:
+            can_id |= CAN_RTR_FLAG
+        out.append(pack(can_id, flags & 0x0F, payload))
+    return b"".join(out)
+
+
+class BatchReceiver:
+    # up to batch_size frames per call from a datagram socket, with the kernel timestamps
+    def __init__(self, sock, batch_size=500):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.frames = ctypes.create_string_buffer(batch_size * CAN_FRAME_SIZE)
+        self.control = ctypes.create_string_buffer(batch_size * CONTROL_SIZE)
+        self.iovecs = (_iovec * batch_size)()
+        self.headers = (_mmsghdr * batch_size)()
+        frames = ctypes.addressof(self.frames)
+        control = ctypes.addressof(self.control)
+        for n in range(batch_size):
+            self.iovecs[n].iov_base = frames + n * CAN_FRAME_SIZE
+            self.iovecs[n].iov_len = CAN_FRAME_SIZE
+            header = self.headers[n].msg_hdr
+            header.msg_iov = ctypes.pointer(self.iovecs[n])
+            header.msg_iovlen = 1
+            header.msg_control = control + n * CONTROL_SIZE
+            header.msg_controllen = CONTROL_SIZE
+        self.used = batch_size     # headers the last call filled in (their controllen was changed)
+
+    def _timestamp(self, n):
+        header = self.headers[n].msg_hdr
+        if header.msg_controllen >= CMSG_DATA_OFFSET + TIMEVAL.size:
+            length, level, kind = CMSG_HEADER.unpack_from(self.control, n * CONTROL_SIZE)
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMP:
+                sec, usec = TIMEVAL.unpack_from(self.control, n * CONTROL_SIZE + CMSG_DATA_OFFSET)
+                return sec * 1000000 + usec
+        return None
+
+    def receive(self):
+        # (can_frame bytes, [t_us]) of the frames waiting in the socket, nothing waits
+        if _recvmmsg is None:
+            return self._receive_single()
+        for n in range(self.used):
+            self.headers[n].msg_hdr.msg_controllen = CONTROL_SIZE
+        count = _recvmmsg(self.sock.fileno(), self.headers, self.batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.used = 0
+                return b"", []
+            raise OSError(error, "recvmmsg: " + errno.errorcode.get(error, str(error)))
+        self.used = count
+        now = None
+        times = []
+        for n in range(count):
+            t_us = self._timestamp(n)
+            if t_us is None:
+                if now is None:
+                    now = int(time.time() * 1000000)
+                t_us = now
+            times.append(t_us)
+        return ctypes.string_at(self.frames, count * CAN_FRAME_SIZE), times
+
+    def _receive_single(self):
+        frames = []
+        times = []
+        now = None
+        while len(frames) < self.batch_size:
+            try:
+                frame, ancillary, flags, address = self.sock.recvmsg(CAN_FRAME_SIZE, CONTROL_SIZE, MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            t_us = None
+            for level, kind, value in ancillary:
+                if level == socket.SOL_SOCKET and kind == SO_TIMESTAMP:
+                    sec, usec = TIMEVAL.unpack_from(value)
+                    t_us = sec * 1000000 + usec
+            if t_us is None:
+                if now is None:
+                    now = int(time.time() * 1000000)
+                t_us = now
+            frames.append(frame)
+            times.append(t_us)
+        return b"".join(frames), times
+
+
+class BatchSender:
+    # can_frame bytes -> socket, as many frames per sendmmsg call as possible
+    def __init__(self, sock, batch_size=500):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.iovecs = (_iovec * batch_size)()
+        self.headers = (_mmsghdr * batch_size)()
+        for n in range(batch_size):
+            self.iovecs[n].iov_len = CAN_FRAME_SIZE
+            self.headers[n].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[n])
+            self.headers[n].msg_hdr.msg_iovlen = 1
+
+    def send(self, data):
+        # frames sent from data (fewer if the tx queue of the interface is full)
+        count = len(data) // CAN_FRAME_SIZE
+        if _sendmmsg is None:
+            return self._send_single(data, count)
+        buffer = ctypes.create_string_buffer(data, len(data))
+        base = ctypes.addressof(buffer)
+        sent = 0
+        while sent < count:
+            n = min(count - sent, self.batch_size)
+            for k in range(n):
+                self.iovecs[k].iov_base = base + (sent + k) * CAN_FRAME_SIZE
+            result = _sendmmsg(self.sock.fileno(), self.headers, n, MSG_DONTWAIT, None)
+            if result <= 0:
+                break
+            sent += result
+        return sent
+
+    def _send_single(self, data, count):
+        for n in range(count):
+            try:
+                self.sock.send(data[n * CAN_FRAME_SIZE:(n + 1) * CAN_FRAME_SIZE], MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError, OSError):
+                return n
+        return count
+
+
+def open_socket(interface, receive_own=False, rcvbuf=None):
+    # raw can socket bound to the interface, kernel timestamps on
+    sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMP, 1)
+    if receive_own:
+        sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_RECV_OWN_MSGS, 1)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((interface,))
+    return sock
+
+
+class SocketCanChannel:
+    # rx of one socketcan interface, same start(sink) / close() as multi_channel.CanChannel
+    def __init__(self, interface, tag=0, batch_size=500, rcvbuf=1 << 21):
+        self.interface = interface
+        self.tag = tag
+        #no tiny-can device, the kernel timestamps are host time already
+        self.device_index = None
+        self.clock = clock_sync.ClockSync()
+        self.batch_size = batch_size
+        self.rcvbuf = rcvbuf
+        self.sock = None
+        self.receiver = None
+        self.frames_received = 0
+        self._running = False
+        self._thread = None
+
+    def open(self):
+        # 0 ok, < 0 the interface can't be opened (logged)
+        try:
+            self.sock = open_socket(self.interface, rcvbuf=self.rcvbuf)
+        except (OSError, AttributeError) as e:
+            fman.logFileManager.logEvent("socketcan {} can't be opened: {}".format(self.interface, e))
+            return -1
+        self.receiver = BatchReceiver(self.sock, self.batch_size)
+        return 0
+
+    def set_filters(self, ids):
+        # kernel filter (CAN_RAW_FILTER) for the ids, returns the software filter like
+        # can_filter.install_filters, but the kernel filter rejects frames: None if it is exact
+        ids = can_filter.normalize_ids(ids)
+        if not ids:
+            return None
+        if len(ids) > CAN_RAW_FILTER_MAX:
+            return ids
+        filters = []
+        for can_id, eff in sorted(ids):
+            if eff:
+                filters.append(struct.pack("=II", can_id | CAN_EFF_FLAG, CAN_EFF_MASK | CAN_EFF_FLAG))
+            else:
+                filters.append(struct.pack("=II", can_id, CAN_SFF_MASK | CAN_EFF_FLAG))
+        self.sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER, b"".join(filters))
+        return None
+
+    def read(self):
+        # TCanMsg array of the frames waiting in the socket ([] if none)
+        data, times = self.receiver.receive()
+        if not times:
+            return []
+        records = frames_to_records(data, times, self.tag)
+        count = len(records) // binary_log.RECORD_SIZE
+        if not count:
+            return []
+        return (TCanMsg * count).from_buffer_copy(records)
+
+    def start(self, sink):
+        # sink(frames) gets every received batch
+        self._running = True
+        sink = profiling.profiled("rx_{}".format(self.tag))(sink)
+        self._thread = threading.Thread(target=self._rx_worker, args=(sink,),
+                                        name="socketcan_rx_{}".format(self.tag), daemon=True)
+        self._thread.start()
+
+    def _rx_worker(self, sink):
+        timer = time.perf_counter
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        while self._running:
+            if not poller.poll(100):
+                continue
+            t0 = timer()
+            try:
+                raw_msgs = self.read()
+            except OSError:
+                metrics.rx_errors.inc()
+                continue
+            if len(raw_msgs):
+                self.clock.add_frame(raw_msgs[len(raw_msgs) - 1])
+            #keep reading while the socket still holds full batches
+            while len(raw_msgs):
+                num_msg = len(raw_msgs)
+                self.frames_received += num_msg
+                metrics.frames_received.inc(num_msg)
+                metrics.rx_batch_size.observe(num_msg)
+                sink(raw_msgs)
+                metrics.rx_callback_seconds.observe(timer() - t0)
+                t0 = timer()
+                if num_msg < self.batch_size:
+                    break
+                raw_msgs = self.read()
+
+    def close(self):
+        self._running = False
+        if self._thread:
+            self._thread.join(1.0)
+        if self.sock:
+            self.sock.close()
+
+
+class SocketCanSink:
+    # frames out to a socketcan interface: send() as router subscriber (mirror),
+    # the instance itself as replay sink (records)
+    def __init__(self, interface, batch_size=500, sock=None):
+        self.interface = interface
+        self.sock = sock if sock is not None else open_socket(interface)
+        self.sender = BatchSender(self.sock, batch_size)
+        self.frames_sent = 0
+        #frames the tx queue of the interface had no room for
+        self.dropped = 0
+        self._dropped = metrics.registry.counter("can_socketcan_tx_dropped_total",
+                                                 "frames not sent to the socketcan interface", {"interface": interface})
+
+    def send_frames(self, data):
+        # can_frame bytes
+        count = len(data) // CAN_FRAME_SIZE
+        sent = self.sender.send(data)
+        self.frames_sent += sent
+        if sent < count:
+            self.dropped += count - sent
+            self._dropped.inc(count - sent)
+        return sent
+
+    def send(self, raw_msgs):
+        # list of TCanMsg or TCanMsg array
+        if type(raw_msgs) == list:
+            data = b"".join([bytes(raw_msg) for raw_msg in raw_msgs])
+        else:
+            data = bytes(memoryview(raw_msgs).cast("B"))
+        return self.send_frames(records_to_frames(data))
+
+    def __call__(self, records):
+        # replay sink: (Id, Flags, Data, Sec, USec) records
+        self.send_frames(records_to_frames(b"".join([RECORD.pack(*record) for record in records])))
+
+    def close(self):
+        self.sock.close()
@@ -1,27 +1,45 @@
+import json
+import time
+
 from .. import TinyCan as tiny_can
 from .. import file_manager as fman
+from ..file_manager import binary_log
+from . import can_filter
+from . import can_router
+from . import multi_channel
+from . import socketcan
+from . import clock_sync
+from . import metrics
+from . import profiling
+from . import backpressure as bp
+from . import on_change as oc
 
 can_driver =None
 data_file_name ="dataFile.txt"
+#"txt" -> semicolon text file, "bin" -> binary segments (see binary_log)
+data_format = "txt"
+segment_writer = None
+#device time -> host time, the frames keep the device time, the mapping goes into the file header
+clock = clock_sync.ClockSync()
+clock_header_written = 0
+#ids of the host software filter (see can_filter), None -> keep every frame
+accepted_ids = None
 
-can_msg_nr = 0
-buffered_can_frames={}
-newdata=0
-
-def newData():
-    global newdata
-    print("read {}".format(can_msg_nr))
-    return newdata
+#several can buses: one CanChannel each, merged into one data file with a channel column
+channels = []
+merger = None
+write_channel = 0
 
-def read_buffered_can_frame_dicct_by_nr(nr):
-    if nr==can_msg_nr:
-        newdata=0
-
-    frame = buffered_can_frames.get(nr)
-    if frame:
-        print("popped {}".format(nr))
-        buffered_can_frames.pop(nr)
-    return frame
+can_msg_nr = 0
+#frames from the rx callback get handed to the subscribers of this router
+router = can_router.FrameRouter()
+#fifo monitoring, adaptive batch size and load shedding, set up in connect
+backpressure = None
+rx_batch_size = 500
+#default index of the driver as int for CanReceiveFast
+rx_index = 0
+#on-change logging (binary only): repeated frames are left out, None -> every frame is written
+on_change = None
 
 
 
@@ -35,7 +53,10 @@ def save_cached_msgs(nr,can_frame_data):
     #print(data_string)
     for part in s:
         data_string+=";"+str(can_frame_data.get(part))
+    if write_channel:
+        data_string+=";"+str(can_frame_data.get("channel"))
     fman.general_file_functions.safe_write(data_string,data_file_name,mirror_terminal=0)
+    metrics.bytes_written.inc(len(data_string)+1)
 
     with open(data_file_name ,"a") as loggingFile:
         loggingFile.write(data_string)
@@ -60,6 +81,8 @@ def PnPEventCallback(index, status):
 
 def StatusEventCallback(index,deviceStatusPointer):
     deviceStatus = deviceStatusPointer.contents
+    if backpressure:
+        backpressure.status_event(index, deviceStatus.FifoStatus, channel_tag(index))
     #log(can_driver.FormatCanDeviceStatus(deviceStatusPointer, deviceStatusPointer.CanStatus,deviceStatusPointer.FIfoStatus))
 
 
@@ -102,6 +125,7 @@ def can_msg_to_dicct(raw_msg):
      "format" :f_format,
      "direction":direction,
      "diff":0,
+     "channel":raw_msg.Flags.FlagBits.Source,
      "time":{
         "Sec":sec,
         "USec":usec}
@@ -109,37 +133,117 @@ def can_msg_to_dicct(raw_msg):
      return cached_msg 
 
 
-def RxEventCallback(index, DummyPointer, count):
+def write_clock_header():
+    #text files get the clock mapping as a comment line, readers skip lines starting with #
+    clocks = {}
+    if channels:
+        for channel in channels:
+            clocks[str(channel.tag)] = channel.clock.mapping()
+    else:
+        clocks["0"] = clock.mapping()
+    fman.general_file_functions.safe_write("#clock;"+json.dumps(clocks),data_file_name,mirror_terminal=0)
+
+
+@profiling.profiled("writer")
+@metrics.timed(metrics.writer_flush_seconds)
+def log_raw_frames(raw_msgs):
+    #router subscriber writing every frame to the data file
     global can_msg_nr
-    global buffered_can_frames
-    global newdata
-    newdata=1
-    print("-------------------------")
-    #log("RxEvent Index{0}".format(index))
+    global clock_header_written
+    if on_change:
+        raw_msgs = on_change.filter(raw_msgs)
+        #repetitions of ids that went quiet, written before the next segment or a crash
+        late = on_change.expired()
+        if len(late):
+            segment_writer.insert_frames(late)
+        if not len(raw_msgs):
+            return
+    if segment_writer:
+        segment_writer.write_frames(raw_msgs)
+        metrics.bytes_written.inc(len(raw_msgs)*binary_log.RECORD_SIZE)
+        can_msg_nr+=len(raw_msgs)
+        return
+    if not clock_header_written and (channels or clock.synced()):
+        write_clock_header()
+        clock_header_written = 1
+    for raw_msg in raw_msgs:
+        new_can_frame_data = can_msg_to_dicct(raw_msg)
+        save_cached_msgs(can_msg_nr, new_can_frame_data)
+        can_msg_nr+=1
+
+
+@profiling.profiled("rx")
+def RxEventCallback(index, DummyPointer, count):
     global can_driver
-    num_msg, raw_msgs = can_driver.CanReceive(count = 500)
-    cached_msgs={} 
-    if num_msg>0:       
-        msgs = can_driver.FormatMessages(raw_msgs)
-        dataArray=[]
-        
-        for raw_msg in raw_msgs:
-            #cached_msg=get_diff_time(Id, cached_msg)
-            
-            #append new data to dicct and save it 
-            new_can_frame_data = can_msg_to_dicct(raw_msg) 
-            buffered_can_frames.update({
-            can_msg_nr : new_can_frame_data 
-            })
-            #print(buffered_can_frames)
-            save_cached_msgs(can_msg_nr, new_can_frame_data)
-            can_msg_nr+=1
+    global rx_batch_size
+    t0 = time.perf_counter()
+    num_msg, raw_msgs = can_driver.CanReceiveFast(rx_index, rx_batch_size)
+    if backpressure:
+        rx_batch_size = backpressure.after_receive(num_msg, raw_msgs)
+    if num_msg>0:
+        clock.add_frame(raw_msgs[num_msg-1])
+        metrics.frames_unrouted.inc(router.dispatch(raw_msgs))
+        metrics.frames_received.inc(num_msg)
+        metrics.rx_batch_size.observe(num_msg)
+    elif num_msg<0:
+        metrics.rx_errors.inc()
+        fman.logFileManager.logEvent(can_driver.FormatError(num_msg, 'CanReceive'))
+    metrics.rx_callback_seconds.observe(time.perf_counter()-t0)
+
+
+def channel_tag(index):
+    #channel number of a device index, 0 without channels
+    device = index & tiny_can.mhsTinyCanDriver.INDEX_CAN_DEVICE_MASK
+    for channel in channels:
+        if channel.device_index is not None and channel.device_index & tiny_can.mhsTinyCanDriver.INDEX_CAN_DEVICE_MASK == device:
+            return channel.tag
+    return 0
+
+
+def log_lost_window(window):
+    #frames lost in an rx fifo overrun, marked in the data file (text: comment line, binary: segment header)
+    if segment_writer:
+        segment_writer.lost.append(window)
+    else:
+        fman.general_file_functions.safe_write("#lost;"+json.dumps(window),data_file_name,mirror_terminal=0)
+
+
+def setup_backpressure(fifo_size, policies, low_priority_ids):
+    global backpressure
+    backpressure = bp.BackPressure(router, can_driver, fifo_size=fifo_size, policies=policies,
+                                   low_priority_ids=low_priority_ids, batch_size=rx_batch_size)
+    backpressure.on_lost = log_lost_window
+    return backpressure
+
+
+def setup_on_change(heartbeat):
+    global on_change
+    if not segment_writer:
+        fman.logFileManager.logEvent("on-change logging needs the binary data format, every frame is written")
+        return None
+    on_change = oc.OnChangeFilter(heartbeat)
+    segment_writer.extra["on_change"] = {"heartbeat": heartbeat}
+    segment_writer.before_close = on_change.flush
+    return on_change
+
+
+def collect_device_status():
+    #metrics collector, polls the device status on a scrape / stats line instead of in the rx callback
+    if channels:
+        devices = [(channel.tag, channel.device_index) for channel in channels]
     else:
-        fman.logFileManager.logEvent(can_driver.FormatError(0, 'CanReceive'))
-            #return -1
-    #return 0
-    print(buffered_can_frames)
-    print("---------------------------------------")
+        devices = [(0, can_driver.DefaultIndex)]
+    for tag, index in devices:
+        err, drv_status, can_status, fifo_status = can_driver.CanGetDeviceStatus(index)
+        if err < 0:
+            continue
+        labels = {"channel": tag}
+        fifo_gauge = metrics.registry.gauge("can_fifo_status", "rx fifo status (0 ok, 1 overrun)", labels)
+        if fifo_status == tiny_can.mhsTinyCanDriver.FIFO_STATUS_OVERRUN and fifo_gauge.value != fifo_status:
+            metrics.registry.counter("can_fifo_overruns_total", "fifo overruns seen by the status poll", labels).inc()
+        fifo_gauge.set(fifo_status)
+        metrics.registry.gauge("can_status", "can status (0 ok, 1 error, 2 warning, 3 passive, 4 bus off)",
+                               labels).set(can_status)
 
 
 
@@ -160,12 +264,144 @@ def connect_api(can_driver,baudrate, snr=None, attempts=5):
             return 1
     return -1
 
-def connect_tiny_can(baudrate,reconnect_attemps):
+def connect_tiny_can(baudrate,reconnect_attemps,filter_ids=None,hw_filter_slots=4,dll=None,
+                     rx_fifo_size=16384,policies=bp.DEFAULT_POLICIES,low_priority_ids=None,
+                     on_change_heartbeat=None):
     #initalize CanDriver
     global can_driver
-    can_driver=tiny_can.mhsTinyCanDriver.MhsTinyCanDriver()
+    global accepted_ids
+    global segment_writer
+    global rx_index
+    #dll: path of the shared library or a virtualTinyCan.VirtualTinyCanLibrary
+    can_driver=tiny_can.mhsTinyCanDriver.MhsTinyCanDriver(dll=dll, rx_fifo_size=rx_fifo_size)
     status = connect_api(can_driver,baudrate,attempts=reconnect_attemps)
+    rx_index = can_driver.IndexValue()
+    setup_backpressure(rx_fifo_size, policies, low_priority_ids)
+    if data_format == "bin":
+        segment_writer = binary_log.SegmentWriter(data_file_name.rsplit(".",1)[0], clocks={0: clock})
+    if on_change_heartbeat:
+        setup_on_change(on_change_heartbeat)
+    #acceptance filters have to be set before the rx events start
+    if filter_ids:
+        accepted_ids = can_filter.install_filters(can_driver, filter_ids, hw_slots=hw_filter_slots)
+        fman.logFileManager.logEvent("software filter active for {} ids".format(len(accepted_ids)))
+    #the software filter is just the id list of the raw log subscription
+    router.subscribe(log_raw_frames, ids=accepted_ids, name="raw_log")
+    metrics.registry.add_collector(collect_device_status)
     can_driver.CanSetUpEvents(PnPEventCallbackfunc=PnPEventCallback,
                           StatusEventCallbackfunc=StatusEventCallback,
                           RxEventCallbackfunc=RxEventCallback)
 
+
+def connect_tiny_can_channels(baudrate,serials,reconnect_attemps,filter_ids=None,hw_filter_slots=4,dll=None,
+                              rx_fifo_size=16384,policies=bp.DEFAULT_POLICIES,low_priority_ids=None,
+                              on_change_heartbeat=None):
+    #one tiny can per serial number, every device gets its own rx thread
+    global can_driver
+    global accepted_ids
+    global merger
+    global write_channel
+    global segment_writer
+    #dll: path of the shared library or a virtualTinyCan.VirtualTinyCanLibrary
+    can_driver=tiny_can.mhsTinyCanDriver.MhsTinyCanDriver(dll=dll, rx_fifo_size=rx_fifo_size)
+    write_channel = 1
+    merger = multi_channel.FrameMerger(log_raw_frames)
+    setup_backpressure(rx_fifo_size, policies, low_priority_ids)
+
+    software_filters = []
+    for tag, snr in enumerate(serials):
+        #the device created by the driver itself is used for the first bus
+        device_index = can_driver.DefaultIndex if tag == 0 else None
+        channel = multi_channel.CanChannel(can_driver, snr, tag, baudrate=baudrate, fifo_size=rx_fifo_size,
+                                           batch_size=rx_batch_size, device_index=device_index,
+                                           backpressure=backpressure)
+        status = channel.open(attempts=reconnect_attemps)
+        if status < 0:
+            fman.logFileManager.logEvent("can channel {} (snr {}) failed: {}".format(tag, snr, status))
+            continue
+        if filter_ids:
+            software_filters.append(can_filter.install_filters(can_driver, filter_ids,
+                                                               hw_slots=hw_filter_slots, index=channel.device_index))
+        channels.append(channel)
+        fman.logFileManager.logEvent("can channel {} opened (snr {})".format(tag, snr))
+
+    if any(f is not None for f in software_filters):
+        accepted_ids = set()
+        for f in software_filters:
+            if f is not None:
+                accepted_ids.update(f)
+    merger.clocks = dict((channel.tag, channel.clock) for channel in channels)
+    if data_format == "bin":
+        segment_writer = binary_log.SegmentWriter(data_file_name.rsplit(".",1)[0], clocks=merger.clocks)
+    if on_change_heartbeat:
+        setup_on_change(on_change_heartbeat)
+    router.subscribe(merger.push, ids=accepted_ids, name="raw_log")
+    metrics.registry.add_collector(collect_device_status)
+    metrics.registry.add_collector(lambda: metrics.registry.gauge(
+        "can_merge_queue_frames", "frames waiting in the merger").set(merger.depth()))
+    merger.start()
+    for channel in channels:
+        channel.start(router.dispatch)
+    return len(channels)
+
+
+def connect_socketcan(interfaces,filter_ids=None,on_change_heartbeat=None):
+    #socketcan interfaces (can0, vcan0 ...) instead of tiny-can devices, one rx thread each
+    global accepted_ids
+    global merger
+    global write_channel
+    global segment_writer
+    if isinstance(interfaces, str):
+        interfaces = [interfaces]
+    software_filters = []
+    for tag, interface in enumerate(interfaces):
+        channel = socketcan.SocketCanChannel(interface, tag=tag, batch_size=rx_batch_size)
+        if channel.open() < 0:
+            continue
+        if filter_ids:
+            software_filters.append(channel.set_filters(filter_ids))
+        channels.append(channel)
+        fman.logFileManager.logEvent("socketcan channel {} opened ({})".format(tag, interface))
+    if any(f is not None for f in software_filters):
+        accepted_ids = set()
+        for f in software_filters:
+            if f is not None:
+                accepted_ids.update(f)
+    clocks = dict((channel.tag, channel.clock) for channel in channels)
+    if data_format == "bin":
+        segment_writer = binary_log.SegmentWriter(data_file_name.rsplit(".",1)[0], clocks=clocks)
+    if on_change_heartbeat:
+        setup_on_change(on_change_heartbeat)
+    if len(interfaces) > 1:
+        write_channel = 1
+        merger = multi_channel.FrameMerger(log_raw_frames, clocks=clocks)
+        router.subscribe(merger.push, ids=accepted_ids, name="raw_log")
+        merger.start()
+    else:
+        router.subscribe(log_raw_frames, ids=accepted_ids, name="raw_log")
+    for channel in channels:
+        channel.start(router.dispatch)
+    return len(channels)
+
+
+def mirror_socketcan(interface):
+    #every received frame also goes out to the socketcan interface (e.g. vcan0 for candump)
+    sink = socketcan.SocketCanSink(interface)
+    router.subscribe(sink.send, name="socketcan_mirror")
+    fman.logFileManager.logEvent("frames mirrored to {}".format(interface))
+    return sink
+
+
+def close_tiny_can_channels():
+    for channel in channels:
+        channel.close()
+    if merger:
+        merger.stop()
+
+
+def close_data_file():
+    #header of the last segment gets the final clock mapping
+    if segment_writer:
+        segment_writer.close()
+    elif clock_header_written:
+        write_clock_header()
@@ -0,0 +1,254 @@
+# trigger based capture: only the seconds around an event are written
+# every frame goes into a preallocated ring buffer (the last pre seconds at
+# max_rate frames/s, 24 bytes per frame, nothing allocated per frame). when a
+# trigger fires, the ring content of the last pre seconds and then the frames
+# of the next post seconds are written to LOGS/<name>_TRIGGER_<n>.bin
+# (binary_log segment, the header tells which trigger fired and when).
+# the triggers are compiled into a table id -> predicates, a batch without any
+# trigger id costs one set intersection, the predicates only see their ids.
+#   capture = TriggerCapture("dataFile", [id_trigger("fault", [0x7df]),
+#                                         byte_trigger("gear_r", 0x120, 2, 0x0a, mask=0x0f),
+#                                         expr_trigger("hv", "BMS_Voltage > 400", DBCReader.signal_codecs())])
+#   router.subscribe(capture.push, name="capture")
+# file writing runs in a thread, not in the rx callback.
+
+import bisect
+import queue
+import struct
+import threading
+
+from .. import file_manager as fman
+from ..file_manager import binary_log
+from . import frame_expr
+from . import metrics
+
+RECORD_SIZE = binary_log.RECORD_SIZE
+TIME = struct.Struct("<II")
+FLAGS = struct.Struct("<I")
+
+
+class Trigger:
+    # predicate(can_id, flags, data) -> True fires, None -> every frame of the ids fires
+    # ids None: the predicate sees every frame
+    def __init__(self, name, ids, predicate=None):
+        self.name = name
+        self.ids = set(ids) if ids is not None else None
+        self.predicate = predicate
+        self.fired = 0
+
+
+def id_trigger(name, ids):
+    # fires on the first frame of one of the ids
+    return Trigger(name, ids)
+
+
+def byte_trigger(name, can_id, index, value, mask=0xFF):
+    # fires when data[index] & mask == value
+    value &= mask
+    return Trigger(name, [can_id], lambda can_id, flags, data: data[index] & mask == value)
+
+
+def signal_trigger(name, can_id, decode, threshold, rising=True):
+    # fires when the decoded signal crosses threshold (rising or falling)
+    # decode(data as int, byte 0 lowest) -> physical value, e.g.
+    #   lambda data: DBCReader.map_data_to_signal(signal, data)
+    state = {"last": None}
+
+    def crossed(can_id, flags, data):
+        value = decode(int.from_bytes(data, "little"))
+        last = state["last"]
+        state["last"] = value
+        if last is None:
+            return False
+        if rising:
+            return last < threshold <= value
+        return last > threshold >= value
+    return Trigger(name, [can_id], crossed)
+
+
+def expr_trigger(name, expression, signals=None):
+    # fires when the frame_expr expression is true, e.g. "id == 0x628 and BMS_Voltage > 400"
+    # signals: DBCReader.signal_codecs() for expressions with signal names
+    # (time is not passed to trigger predicates, it reads as 0 here)
+    expression = frame_expr.compile_expression(expression, signals)
+    return Trigger(name, expression.ids, expression)
+
+
+class RingBuffer:
+    # the last capacity frames as TCanMsg records
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD_SIZE)
+        self.head = 0       # next frame slot
+        self.count = 0
+
+    def write(self, data):
+        # data: bytes of whole records
+        view = memoryview(data)
+        frames = len(view) // RECORD_SIZE
+        if frames >= self.capacity:
+            view = view[(frames - self.capacity) * RECORD_SIZE:]
+            frames = self.capacity
+        start = self.head * RECORD_SIZE
+        first = min(len(view), len(self.buffer) - start)
+        self.buffer[start:start + first] = view[:first]
+        if first < len(view):
+            self.buffer[:len(view) - first] = view[first:]
+        self.head = (self.head + frames) % self.capacity
+        self.count = min(self.capacity, self.count + frames)
+
+    def snapshot(self):
+        # the frames in the buffer, oldest first (a copy)
+        if self.count < self.capacity:
+            return bytes(self.buffer[:self.head * RECORD_SIZE])
+        start = self.head * RECORD_SIZE
+        return bytes(self.buffer[start:]) + bytes(self.buffer[:start])
+
+
+def _time(data, index):
+    sec, usec = TIME.unpack_from(data, index * RECORD_SIZE + 16)
+    return sec * 1000000 + usec
+
+
+class _Times:
+    # device times of a snapshot as a sequence for bisect
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // RECORD_SIZE
+
+    def __getitem__(self, index):
+        return _time(self.data, index)
+
+
+class TriggerCapture:
+    def __init__(self, name, triggers, pre_seconds=10.0, post_seconds=5.0, max_rate=20000, capacity=None,
+                 holdoff=0.0, folder="LOGS"):
+        # holdoff: seconds after a capture in which triggers are ignored
+        self.name = name
+        self.triggers = list(triggers)
+        self.pre_us = int(pre_seconds * 1000000)
+        self.post_us = int(post_seconds * 1000000)
+        self.holdoff_us = int(holdoff * 1000000)
+        #room for one more rx batch: the ring already holds the frames behind the trigger
+        self.ring = RingBuffer(capacity if capacity else int(pre_seconds * max_rate) + 4096)
+        self.writer = binary_log.SegmentWriter(name + "_TRIGGER", max_records=1 << 62, folder=folder)
+        self.captures = 0
+        self.active = None          # trigger info of the capture that is being written
+        self.end_us = None
+        self.holdoff_until = None
+        self.table = {}
+        self.compile()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, name="trigger_capture", daemon=True)
+        self._thread.start()
+        self._fired = metrics.registry.counter("can_trigger_captures_total", "trigger captures written")
+
+    def compile(self):
+        # id -> [trigger], the triggers without ids are checked for every id
+        table = {}
+        wildcards = [trigger for trigger in self.triggers if trigger.ids is None]
+        for trigger in self.triggers:
+            for can_id in trigger.ids or ():
+                table.setdefault(can_id, []).append(trigger)
+        for triggers in table.values():
+            triggers.extend(wildcards)
+        self.table = table
+        self.wildcards = wildcards
+        self.trigger_ids = frozenset(table)
+
+    # ---------------- rx path ----------------
+
+    def push(self, raw_msgs):
+        # router subscriber, gets every frame
+        if type(raw_msgs) == list:
+            data = b"".join([bytes(raw_msg) for raw_msg in raw_msgs])
+        else:
+            data = bytes(memoryview(raw_msgs).cast("B"))
+        if not data:
+            return
+        self.ring.write(data)
+        if self.active is not None:
+            self._post(data)
+            return
+        ids = memoryview(data).cast("I")[0::6]
+        if not self.wildcards and self.trigger_ids.isdisjoint(ids.tolist()):
+            return
+        self._check(data, ids)
+
+    def _check(self, data, ids):
+        table = self.table
+        wildcards = self.wildcards
+        for index, can_id in enumerate(ids):
+            triggers = table.get(can_id, wildcards)
+            if not triggers:
+                continue
+            position = index * RECORD_SIZE
+            flags = FLAGS.unpack_from(data, position + 4)[0]
+            payload = data[position + 8:position + 16]
+            for trigger in triggers:
+                if trigger.predicate is None or trigger.predicate(can_id, flags, payload):
+                    t_us = _time(data, index)
+                    if self.holdoff_until is not None and t_us < self.holdoff_until:
+                        continue
+                    self._fire(trigger, can_id, t_us, data[position + RECORD_SIZE:])
+                    return
+
+    def _fire(self, trigger, can_id, t_us, rest):
+        # pre window from the ring (it already holds the whole batch), then the post window
+        trigger.fired += 1
+        snapshot = self.ring.snapshot()
+        times = _Times(snapshot)
+        first = bisect.bisect_left(times, t_us - self.pre_us)
+        #frames of the batch behind the trigger are already in the snapshot
+        stop = len(times) - len(rest) // RECORD_SIZE
+        self.active = {"trigger": trigger.name, "id": can_id, "trigger_us": t_us,
+                       "pre_s": self.pre_us / 1e6, "post_s": self.post_us / 1e6}
+        self.end_us = t_us + self.post_us
+        self._queue.put(("open", dict(self.active)))
+        self._queue.put(("frames", snapshot[first * RECORD_SIZE:stop * RECORD_SIZE]))
+        self._fired.inc()
+        fman.logFileManager.logEvent("trigger {} fired on id {:#x} at device time {} us".format(
+            trigger.name, can_id, t_us))
+        if rest:
+            self._post(rest)
+
+    def _post(self, data):
+        # frames up to the end of the post window, then the capture is closed
+        times = _Times(data)
+        stop = bisect.bisect_right(times, self.end_us)
+        if stop:
+            self._queue.put(("frames", data[:stop * RECORD_SIZE]))
+        if stop < len(times):
+            self._queue.put(("close", None))
+            self.holdoff_until = self.end_us + self.holdoff_us
+            self.active = None
+            self.captures += 1
+
+    # ---------------- writer thread ----------------
+
+    def _write_loop(self):
+        writer = self.writer
+        while True:
+            action, value = self._queue.get()
+            if action == "open":
+                writer.extra = {"capture": value}
+                writer.open_segment()
+            elif action == "frames":
+                writer.file.write(value)
+                writer.record_count += len(value) // RECORD_SIZE
+            elif action == "close":
+                writer.close_segment()
+                fman.logFileManager.logEvent("trigger capture written to {}".format(writer.file_name))
+            elif action == "stop":
+                return
+
+    def close(self):
+        # a capture that is still running ends here
+        if self.active is not None:
+            self._queue.put(("close", None))
+            self.active = None
+            self.captures += 1
+        self._queue.put(("stop", None))
+        self._thread.join(5.0)
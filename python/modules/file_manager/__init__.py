@@ -1,3 +1,8 @@
 from . import logFileManager
 from . import general_file_functions
 
+from . import binary_log
+from . import text_log
+from . import text_convert
+from . import log_reader
+from . import log_formats
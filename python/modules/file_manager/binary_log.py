@@ -0,0 +1,255 @@
+# binary data files, written in segments
+# a segment is one file: a header and then the frames as fixed size records.
+# a record is the TCanMsg struct of the tiny can driver as it is in memory
+# (Id, Flags, Data[8], Sec, USec, 24 bytes little endian), so a received
+# batch can be written without converting every frame to a string.
+#
+# header: magic, version, record size, header size, record count and a json
+# block with the clock mapping of every channel (see clock_sync). the header
+# is written when the segment is opened and rewritten with the final count
+# and mapping when it is closed.
+# rx fifo overruns: the header only has a summary (number of windows, summed
+# gap, first and last window), the complete list goes into <segment>.lost.json
+# next to the segment, so a long overload can't overflow the header.
+
+import json
+import os
+import struct
+import time
+
+MAGIC = b"CANLOGB1"
+VERSION = 1
+HEADER = struct.Struct("<8sHHIQ")          # magic, version, record size, header size, record count
+HEADER_SIZE = 4096
+RECORD = struct.Struct("<II8sII")          # Id, Flags, Data, Sec, USec - same layout as TCanMsg
+RECORD_SIZE = RECORD.size
+FILE_ENDING = "bin"
+LOST_ENDING = "lost.json"
+
+# bits of the Flags field, same as TCANFlagBits
+FLAG_DLC = 0x0F
+FLAG_TXD = 0x10
+FLAG_RTR = 0x40
+FLAG_EFF = 0x80
+#on-change logging (can_logger.on_change): repetitions left out before this frame
+FLAG_REPEATS = 0xFFFF0000
+
+
+def record_channel(flags):
+    # multi channel logging keeps the channel number in the Source byte
+    return (flags >> 8) & 0xFF
+
+
+def record_repeats(flags):
+    return (flags >> 16) & 0xFFFF
+
+
+def lost_file_name(file_name):
+    # dataFile_0.bin -> dataFile_0.lost.json
+    return "{}.{}".format(os.path.splitext(file_name)[0], LOST_ENDING)
+
+
+def lost_summary(windows):
+    # bounded summary of the lost windows of a segment for the header, None without overruns
+    if not windows:
+        return None
+    return {"windows": len(windows), "gap_ms": sum(w.get("gap_ms") or 0 for w in windows),
+            "first": windows[0], "last": windows[-1]}
+
+
+def _header_bytes(record_count, info):
+    info_bytes = json.dumps(info).encode()
+    if HEADER.size + len(info_bytes) > HEADER_SIZE:
+        raise ValueError("segment header info too large ({} bytes)".format(len(info_bytes)))
+    header = HEADER.pack(MAGIC, VERSION, RECORD_SIZE, HEADER_SIZE, record_count) + info_bytes
+    return header + b" " * (HEADER_SIZE - len(header))
+
+
+def read_header(file_name):
+    with open(file_name, "rb") as f:
+        raw = f.read(HEADER_SIZE)
+    if len(raw) < HEADER.size:
+        raise ValueError("{} is no binary can log".format(file_name))
+    magic, version, record_size, header_size, record_count = HEADER.unpack_from(raw)
+    if magic != MAGIC:
+        raise ValueError("{} is no binary can log".format(file_name))
+    info = json.loads(raw[HEADER.size:header_size].decode().strip() or "{}")
+    if record_count == 0:
+        #segment was not closed cleanly, count what is there
+        record_count = (os.path.getsize(file_name) - header_size) // record_size
+    return {
+        "version": version,
+        "record_size": record_size,
+        "header_size": header_size,
+        "record_count": record_count,
+        "info": info,
+    }
+
+
+def iter_records(file_name, chunk_records=4096):
+    # yields (Id, Flags, Data, Sec, USec) tuples
+    header = read_header(file_name)
+    with open(file_name, "rb") as f:
+        f.seek(header["header_size"])
+        rest = b""
+        while True:
+            chunk = f.read(chunk_records * RECORD_SIZE)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            usable = len(chunk) - len(chunk) % RECORD_SIZE
+            rest = chunk[usable:]
+            yield from RECORD.iter_unpack(chunk[:usable])
+
+
+class SegmentWriter:
+    # writes frames into LOGS/<name>_<n>.bin, a new segment is started after
+    # max_records frames or max_seconds of host time
+    def __init__(self, name, clocks=None, max_records=1000000, max_seconds=None, folder="LOGS"):
+        self.name = name
+        self.folder = folder
+        self.clocks = clocks if clocks else {}
+        self.max_records = max_records
+        self.max_seconds = max_seconds
+        self.file_name = None
+        self.file = None
+        self.record_count = 0
+        self.segment_nr = 0
+        self.segment_start = None
+        #rx fifo overruns during the segment (see can_logger.backpressure)
+        self.lost = []
+        #more header info, e.g. the on-change settings
+        self.extra = {}
+        #returns frames that have to go into the segment before it is closed,
+        #they are inserted at their time position (the segment stays in time order)
+        self.before_close = None
+
+    def _info(self):
+        clocks = {}
+        for tag, clock in self.clocks.items():
+            clocks[str(tag)] = clock.mapping()
+        info = {"name": self.name, "segment": self.segment_nr, "clocks": clocks, "lost": lost_summary(self.lost)}
+        if self.lost:
+            info["lost_file"] = os.path.basename(lost_file_name(self.file_name))
+        info.update(self.extra)
+        return info
+
+    def open_segment(self):
+        if not os.path.isdir(self.folder):
+            os.mkdir(self.folder)
+        while True:
+            file_name = os.path.join(self.folder, "{}_{}.{}".format(self.name, self.segment_nr, FILE_ENDING))
+            if not os.path.exists(file_name):
+                break
+            self.segment_nr += 1
+        self.file_name = file_name
+        self.file = open(file_name, "w+b")
+        self.file.write(_header_bytes(0, self._info()))
+        self.record_count = 0
+        self.lost = []
+        self.segment_start = time.monotonic()
+
+    def close_segment(self):
+        if not self.file:
+            return
+        if self.before_close:
+            frames = self.before_close()
+            if len(frames):
+                self.insert_frames(frames)
+        if self.lost:
+            with open(lost_file_name(self.file_name), "w") as f:
+                json.dump(self.lost, f)
+        #final record count and the clock mapping with all samples of the segment,
+        #built before the seek so an error can't leave the file positioned over the header
+        header = _header_bytes(self.record_count, self._info())
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.close()
+        self.file = None
+        self.segment_nr += 1
+
+    def _host_time(self, flags, sec, usec):
+        # the order of the channel merger: host time of the channel's clock in us,
+        # device time while the clock is not synced (one channel: same order)
+        device_us = sec * 1000000 + usec
+        clock = self.clocks.get(record_channel(flags))
+        host = clock.to_monotonic(device_us) if clock is not None else None
+        return device_us if host is None else host * 1e6
+
+    def _time(self, position):
+        self.file.seek(HEADER_SIZE + position * RECORD_SIZE)
+        can_id, flags, data, sec, usec = RECORD.unpack(self.file.read(RECORD_SIZE))
+        return self._host_time(flags, sec, usec)
+
+    def _time_position(self, t_host):
+        # first written frame with a host time > t_host (binary search in the file)
+        lo, hi = 0, self.record_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time(mid) <= t_host:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def insert_frames(self, raw_msgs):
+        # frames older than the last written ones (TCanMsg array), they are put at their time position
+        if not self.file:
+            self.open_segment()
+        self._insert_in_order(bytes(memoryview(raw_msgs).cast("B")))
+
+    def _insert_in_order(self, data, chunk_bytes=1 << 20):
+        # inserts records into the written (time ordered) frames at their time position.
+        # from the last insertion point to the first, the frames behind it are moved up
+        # in chunks, so only the tail after the earliest inserted frame is rewritten
+        records = []
+        for position in range(0, len(data) - len(data) % RECORD_SIZE, RECORD_SIZE):
+            can_id, flags, payload, sec, usec = RECORD.unpack_from(data, position)
+            records.append((self._host_time(flags, sec, usec), data[position:position + RECORD_SIZE]))
+        records.sort()
+        positions = [self._time_position(t_host) for t_host, record in records]
+        f = self.file
+        upper = self.record_count
+        for n in range(len(records) - 1, -1, -1):
+            position = positions[n]
+            shift = (n + 1) * RECORD_SIZE
+            stop = HEADER_SIZE + upper * RECORD_SIZE
+            start = HEADER_SIZE + position * RECORD_SIZE
+            while stop > start:
+                size = min(chunk_bytes, stop - start)
+                stop -= size
+                f.seek(stop)
+                block = f.read(size)
+                f.seek(stop + shift)
+                f.write(block)
+            f.seek(HEADER_SIZE + (position + n) * RECORD_SIZE)
+            f.write(records[n][1])
+            upper = position
+        self.record_count += len(records)
+        f.seek(0, os.SEEK_END)
+
+    def write_frames(self, raw_msgs):
+        # raw_msgs: TCanMsg array from CanReceive or a list of TCanMsg
+        if not self.file:
+            self.open_segment()
+        if type(raw_msgs) == list:
+            self.file.write(b"".join([bytes(raw_msg) for raw_msg in raw_msgs]))
+        else:
+            self.file.write(memoryview(raw_msgs).cast("B"))
+        self.record_count += len(raw_msgs)
+        if self.record_count >= self.max_records or \
+                (self.max_seconds and time.monotonic() - self.segment_start >= self.max_seconds):
+            self.close_segment()
+
+    def write_records(self, records):
+        # records: (Id, Flags, Data, Sec, USec) tuples, for converters
+        if not self.file:
+            self.open_segment()
+        pack = RECORD.pack
+        self.file.write(b"".join([pack(*record) for record in records]))
+        self.record_count += len(records)
+        if self.record_count >= self.max_records:
+            self.close_segment()
+
+    def close(self):
+        self.close_segment()
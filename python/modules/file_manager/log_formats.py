@@ -0,0 +1,721 @@
+# export / import of the common can log formats, so a recording can be handed
+# to tools that don't read our text or binary files:
+#   "asc"  vector ascii log
+#   "log"  candump -l log (can-utils)
+#   "blf"  vector binary logging format (zlib compressed containers)
+#   "mf4"  asam mdf 4.1, can bus logging layout (CAN_DataFrame channels)
+# everything works on records (Id, Flags, Data, Sec, USec) like binary_log /
+# text_log, the writers take them in chunks and encode a whole chunk at once,
+# the readers are generators. memory stays constant whatever the file size.
+#   with open_writer("supplier.blf") as writer:
+#       writer.write(replay.iter_recording("LOGS/dataFile_0.bin"))
+#   for record in iter_file("trace.asc"): ...
+# the records keep the time base they have: time_offset_us is added to every
+# frame when writing (startExport.py converts every channel's device time to
+# utc before), the readers return what is in the file (absolute time where the
+# format has it).
+# channel: Source byte of the flags (0 based), asc / blf count from 1.
+# asc / blf store the times relative to the first frame, a frame from before
+# it (channels with their own clocks merged slightly out of order) is written
+# at the start time.
+# mf4: only the layout written here and other sorted / unsorted files with
+# fixed length records (DT, DL, DZ data blocks) can be read.
+
+import datetime
+import os
+import struct
+import zlib
+from itertools import islice
+
+from .binary_log import FLAG_DLC, FLAG_TXD, FLAG_RTR, FLAG_EFF
+
+CHUNK_RECORDS = 8192
+EFF_MASK = 0x1FFFFFFF
+
+
+def iter_chunks(records, size=CHUNK_RECORDS):
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _record_flags(dlc, channel, tx=False, rtr=False, eff=False):
+    return (dlc & FLAG_DLC) | channel << 8 | (FLAG_TXD if tx else 0) | (FLAG_RTR if rtr else 0) \
+        | (FLAG_EFF if eff else 0)
+
+
+def _record(can_id, flags, data, t_us):
+    return (can_id, flags, data.ljust(8, b"\0")[:8], t_us // 1000000, t_us % 1000000)
+
+
+class _Writer:
+    # write(records) takes any iterable, in chunks of CHUNK_RECORDS
+    def __init__(self, file_name, time_offset_us=0, mode="w"):
+        self.file_name = file_name
+        self.time_offset_us = time_offset_us
+        self.file = open(file_name, mode)
+        self.count = 0
+
+    def write(self, records):
+        for chunk in iter_chunks(records):
+            self.write_chunk(chunk)
+            self.count += len(chunk)
+        return self.count
+
+    def write_chunk(self, records):
+        raise NotImplementedError
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# ---------------- candump ----------------
+# (1436509052.249713) can0 123#DEADBEEF
+# (1436509052.249714) can0 1ABCDEF0#R       (8 hex digits: extended id, R: remote, R<dlc>)
+# the format has no direction, a trailing T / R (python-can writes one) is read
+
+class CandumpWriter(_Writer):
+    def __init__(self, file_name, time_offset_us=0, interface="can{}"):
+        # interface: name of the channel, {} is replaced by the channel number
+        _Writer.__init__(self, file_name, time_offset_us)
+        self.interface = interface
+
+    def write_chunk(self, records):
+        offset = self.time_offset_us
+        interfaces = {}
+        lines = []
+        for can_id, flags, data, sec, usec in records:
+            channel = (flags >> 8) & 0xFF
+            interface = interfaces.get(channel)
+            if interface is None:
+                interface = interfaces[channel] = self.interface.format(channel)
+            t_us = sec * 1000000 + usec + offset
+            dlc = flags & FLAG_DLC
+            if flags & FLAG_RTR:
+                payload = "R" + ("%X" % dlc if dlc else "")
+            else:
+                payload = data[:dlc].hex().upper()
+            lines.append("(%d.%06d) %s %s#%s\n" % (t_us // 1000000, t_us % 1000000, interface,
+                                                  "%08X" % can_id if flags & FLAG_EFF else "%03X" % can_id, payload))
+        self.file.write("".join(lines))
+
+
+def _interface_channel(interface):
+    # can0 -> 0, vcan12 -> 12
+    digits = len(interface) - len(interface.rstrip("0123456789"))
+    return int(interface[-digits:]) if digits else 0
+
+
+def iter_candump(file_name):
+    channels = {}
+    with open(file_name, "r", errors="ignore") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 3 or not parts[0].startswith("(") or "##" in parts[2]:
+                #comments and can fd frames
+                continue
+            can_id, _, payload = parts[2].partition("#")
+            channel = channels.get(parts[1])
+            if channel is None:
+                channel = channels[parts[1]] = _interface_channel(parts[1])
+            sec, _, usec = parts[0][1:-1].partition(".")
+            t_us = int(sec) * 1000000 + int(usec.ljust(6, "0")[:6])
+            if payload[:1] in ("R", "r"):
+                dlc = int(payload[1:], 16) if payload[1:] else 0
+                data = b""
+                rtr = True
+            else:
+                data = bytes.fromhex(payload.replace(".", ""))
+                dlc = len(data)
+                rtr = False
+            flags = _record_flags(dlc, channel, tx=len(parts) > 3 and parts[3] == "T", rtr=rtr, eff=len(can_id) > 3)
+            yield _record(int(can_id, 16), flags, data, t_us)
+
+
+# ---------------- vector asc ----------------
+# date Mon Oct 19 01:02:03.456 pm 2026
+# base hex  timestamps absolute
+#    0.001234 1  123             Rx   d 8 01 02 03 04 05 06 07 08
+#    0.001300 2  1ABCDEFx        Tx   r 8
+
+def _asc_date(t_us):
+    moment = datetime.datetime.fromtimestamp(t_us / 1e6)
+    return "{}.{:03d} {} {}".format(moment.strftime("%a %b %d %I:%M:%S"), moment.microsecond // 1000,
+                                   "am" if moment.hour < 12 else "pm", moment.year)
+
+
+class AscWriter(_Writer):
+    def __init__(self, file_name, time_offset_us=0):
+        _Writer.__init__(self, file_name, time_offset_us)
+        self.start_us = None
+
+    def _header(self, t_us):
+        #the date has ms resolution, the frame times are relative to it
+        self.start_us = t_us - t_us % 1000
+        date = _asc_date(self.start_us)
+        self.file.write("date {}\nbase hex  timestamps absolute\ninternal events logged\n// version 9.0.0\n"
+                        "Begin Triggerblock {}\n   0.000000 Start of measurement\n".format(date, date))
+
+    def write_chunk(self, records):
+        offset = self.time_offset_us
+        if self.start_us is None:
+            self._header(records[0][3] * 1000000 + records[0][4] + offset)
+        start = self.start_us - offset
+        lines = []
+        for can_id, flags, data, sec, usec in records:
+            t_us = sec * 1000000 + usec - start
+            if t_us < 0:
+                t_us = 0
+            dlc = flags & FLAG_DLC
+            frame_id = "%Xx" % can_id if flags & FLAG_EFF else "%X" % can_id
+            direction = "Tx" if flags & FLAG_TXD else "Rx"
+            if flags & FLAG_RTR:
+                lines.append("%4d.%06d %d  %-15s %s   r %X\n" % (t_us // 1000000, t_us % 1000000,
+                                                              ((flags >> 8) & 0xFF) + 1, frame_id, direction, dlc))
+            else:
+                lines.append("%4d.%06d %d  %-15s %s   d %X %s\n" % (t_us // 1000000, t_us % 1000000,
+                                                                 ((flags >> 8) & 0xFF) + 1, frame_id, direction,
+                                                                 dlc, data[:dlc].hex(" ").upper()))
+        self.file.write("".join(lines))
+
+    def close(self):
+        if self.file:
+            if self.start_us is None:
+                self._header(self.time_offset_us)
+            self.file.write("End TriggerBlock\n")
+        _Writer.close(self)
+
+
+def _parse_asc_date(text):
+    for pattern in ("%a %b %d %I:%M:%S.%f %p %Y", "%a %b %d %I:%M:%S %p %Y", "%a %b %d %H:%M:%S.%f %Y",
+                    "%a %b %d %H:%M:%S %Y"):
+        try:
+            return int(datetime.datetime.strptime(text.strip(), pattern).timestamp() * 1000000)
+        except ValueError:
+            continue
+    return 0
+
+
+def iter_asc(file_name):
+    start = 0
+    base = 16
+    relative = False
+    last = 0
+    with open(file_name, "r", errors="ignore") as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if not parts[0][0].isdigit():
+                if parts[0] == "date":
+                    start = _parse_asc_date(line[5:])
+                elif parts[0] == "base":
+                    base = 16 if parts[1] == "hex" else 10
+                    relative = "relative" in parts
+                continue
+            #time channel id dir d|r dlc data..., everything else (events, error and fd frames) is skipped
+            if len(parts) < 5 or not parts[1].isdigit() or parts[3] not in ("Rx", "Tx"):
+                continue
+            kind = parts[4].lower()
+            if kind not in ("d", "r"):
+                continue
+            t = float(parts[0])
+            if relative:
+                t += last
+                last = t
+            frame_id = parts[2]
+            eff = frame_id[-1] in "xX"
+            can_id = int(frame_id.rstrip("xX"), base)
+            dlc = int(parts[5], 16) if len(parts) > 5 else 0
+            if kind == "d":
+                data = bytes(int(value, base) for value in parts[6:6 + dlc])
+                rtr = False
+            else:
+                data = b""
+                rtr = True
+            flags = _record_flags(dlc, int(parts[1]) - 1, tx=parts[3] == "Tx", rtr=rtr, eff=eff or can_id > 0x7FF)
+            yield _record(can_id, flags, data, start + int(round(t * 1000000)))
+
+
+# ---------------- vector blf ----------------
+# file header (LOGG, 144 bytes), then LOBJ objects. the can messages are
+# collected into LOG_CONTAINER objects (zlib compressed, about 128 kB raw),
+# an object can continue in the next container.
+
+BLF_FILE_HEADER = struct.Struct("<4sLBBBBBBBBQQLL8H8H")
+BLF_FILE_HEADER_SIZE = 144
+BLF_OBJ_HEADER_BASE = struct.Struct("<4sHHLL")      # signature, header size, header version, object size, type
+BLF_OBJ_HEADER_V1 = struct.Struct("<LHHQ")          # flags, client index, object version, timestamp
+BLF_OBJ_HEADER_V2 = struct.Struct("<LBBHQ8x")
+BLF_LOG_CONTAINER = struct.Struct("<H6xL4x")        # compression method, uncompressed size
+BLF_CAN_MSG = struct.Struct("<HBBL8s")              # channel, flags, dlc, id, data
+BLF_CAN_MESSAGE = 1
+BLF_LOG_CONTAINER_TYPE = 10
+BLF_CAN_MESSAGE2 = 86
+BLF_NO_COMPRESSION = 0
+BLF_ZLIB = 2
+BLF_TIME_TEN_MICS = 1
+BLF_TIME_ONE_NANS = 2
+BLF_DIR = 0x01
+BLF_REMOTE = 0x80
+BLF_EXT = 0x80000000
+BLF_CONTAINER_SIZE = 128 * 1024
+_BLF_MESSAGE = struct.Struct("<4sHHLL" + "LHHQ" + "HBBL8s")     # one can message object, 48 bytes
+
+
+def _systemtime(t_us):
+    moment = datetime.datetime.fromtimestamp(t_us / 1e6)
+    return (moment.year, moment.month, moment.isoweekday() % 7, moment.day, moment.hour, moment.minute,
+            moment.second, moment.microsecond // 1000)
+
+
+def _systemtime_us(values):
+    year, month, weekday, day, hour, minute, second, ms = values
+    if not year:
+        return 0
+    return int(datetime.datetime(year, month, day, hour, minute, second, ms * 1000).timestamp() * 1000000)
+
+
+class BlfWriter(_Writer):
+    def __init__(self, file_name, time_offset_us=0, compression=6, container_size=BLF_CONTAINER_SIZE):
+        _Writer.__init__(self, file_name, time_offset_us, mode="wb")
+        self.compression = compression
+        self.container_size = container_size
+        self.buffer = []
+        self.buffered = 0
+        self.start_us = None
+        self.stop_us = None
+        self.uncompressed = BLF_FILE_HEADER_SIZE
+        self.file.write(bytes(BLF_FILE_HEADER_SIZE))
+
+    def write_chunk(self, records):
+        offset = self.time_offset_us
+        if self.start_us is None:
+            t_us = records[0][3] * 1000000 + records[0][4] + offset
+            #the start time in the header has ms resolution
+            self.start_us = t_us - t_us % 1000
+        start = self.start_us - offset
+        pack = _BLF_MESSAGE.pack
+        size = _BLF_MESSAGE.size
+        objects = [pack(b"LOBJ", 32, 1, size, BLF_CAN_MESSAGE,
+                        BLF_TIME_ONE_NANS, 0, 0, max(sec * 1000000 + usec - start, 0) * 1000,
+                        ((flags >> 8) & 0xFF) + 1, (BLF_DIR if flags & FLAG_TXD else 0) | (BLF_REMOTE if flags & FLAG_RTR else 0),
+                        flags & FLAG_DLC, can_id | BLF_EXT if flags & FLAG_EFF else can_id, data)
+                   for can_id, flags, data, sec, usec in records]
+        last = records[-1]
+        self.stop_us = last[3] * 1000000 + last[4] + offset
+        self.buffer.append(b"".join(objects))
+        self.buffered += len(objects) * size
+        if self.buffered >= self.container_size:
+            self._flush()
+
+    def _flush(self, final=False):
+        data = b"".join(self.buffer)
+        step = self.container_size
+        stop = len(data) if final else len(data) - len(data) % step
+        for position in range(0, stop, step):
+            self._write_container(data[position:position + step])
+        self.buffer = [data[stop:]] if stop < len(data) else []
+        self.buffered = len(data) - stop
+
+    def _write_container(self, data):
+        if self.compression:
+            method = BLF_ZLIB
+            packed = zlib.compress(data, self.compression)
+        else:
+            method = BLF_NO_COMPRESSION
+            packed = data
+        size = BLF_OBJ_HEADER_BASE.size + BLF_LOG_CONTAINER.size + len(packed)
+        self.file.write(BLF_OBJ_HEADER_BASE.pack(b"LOBJ", BLF_OBJ_HEADER_BASE.size, 1, size, BLF_LOG_CONTAINER_TYPE))
+        self.file.write(BLF_LOG_CONTAINER.pack(method, len(data)))
+        self.file.write(packed)
+        self.file.write(bytes(size % 4))
+        self.uncompressed += BLF_OBJ_HEADER_BASE.size + BLF_LOG_CONTAINER.size + len(data)
+
+    def close(self):
+        if not self.file:
+            return
+        self._flush(final=True)
+        size = self.file.tell()
+        start = _systemtime(self.start_us) if self.start_us is not None else (0,) * 8
+        stop = _systemtime(self.stop_us) if self.stop_us is not None else (0,) * 8
+        header = BLF_FILE_HEADER.pack(b"LOGG", BLF_FILE_HEADER_SIZE, 5, 0, 0, 0, 2, 6, 8, 1, size,
+                                      self.uncompressed, self.count, 0, *(start + stop))
+        self.file.seek(0)
+        self.file.write(header)
+        _Writer.close(self)
+
+
+def _blf_objects(data, start_us):
+    # can records of the complete objects in data, returns (records, position of the first incomplete one)
+    records = []
+    position = 0
+    end = len(data)
+    unpack_base = BLF_OBJ_HEADER_BASE.unpack_from
+    while position + BLF_OBJ_HEADER_BASE.size <= end:
+        signature, header_size, header_version, size, kind = unpack_base(data, position)
+        if signature != b"LOBJ":
+            raise ValueError("blf object without LOBJ signature")
+        following = position + size + size % 4
+        if position + size > end:
+            break
+        if kind in (BLF_CAN_MESSAGE, BLF_CAN_MESSAGE2):
+            header = position + BLF_OBJ_HEADER_BASE.size
+            if header_version == 1:
+                time_flags, client, version, timestamp = BLF_OBJ_HEADER_V1.unpack_from(data, header)
+            else:
+                time_flags, client, version, timestamp = BLF_OBJ_HEADER_V2.unpack_from(data, header)[:4]
+            t_us = start_us + (timestamp * 10 if time_flags == BLF_TIME_TEN_MICS else timestamp // 1000)
+            channel, msg_flags, dlc, can_id, payload = BLF_CAN_MSG.unpack_from(data, position + header_size)
+            flags = _record_flags(dlc, max(channel - 1, 0), tx=msg_flags & BLF_DIR, rtr=msg_flags & BLF_REMOTE,
+                                  eff=can_id & BLF_EXT)
+            records.append(_record(can_id & EFF_MASK, flags, payload, t_us))
+        position = following
+    return records, min(position, end)
+
+
+def iter_blf(file_name):
+    with open(file_name, "rb") as f:
+        header = f.read(BLF_FILE_HEADER_SIZE)
+        if header[:4] != b"LOGG":
+            raise ValueError("{} is no blf file".format(file_name))
+        values = BLF_FILE_HEADER.unpack_from(header)
+        header_size = values[1]
+        start_us = _systemtime_us(values[14:22])
+        f.seek(header_size)
+        rest = b""
+        while True:
+            base = f.read(BLF_OBJ_HEADER_BASE.size)
+            if len(base) < BLF_OBJ_HEADER_BASE.size:
+                break
+            signature, base_size, header_version, size, kind = BLF_OBJ_HEADER_BASE.unpack(base)
+            if signature != b"LOBJ":
+                break
+            body = f.read(size - BLF_OBJ_HEADER_BASE.size)
+            f.read(size % 4)
+            if kind == BLF_LOG_CONTAINER_TYPE:
+                method, raw_size = BLF_LOG_CONTAINER.unpack_from(body)
+                data = body[BLF_LOG_CONTAINER.size:]
+                if method == BLF_ZLIB:
+                    data = zlib.decompress(data)
+                data = rest + data
+            else:
+                #object outside of a container
+                data = rest + base + body + bytes(size % 4)
+            records, used = _blf_objects(data, start_us)
+            rest = data[used:]
+            yield from records
+
+
+# ---------------- asam mdf 4.1 ----------------
+# one data group / channel group with the asam can bus logging channels:
+#   Timestamp (s since the start time of the file), CAN_DataFrame.BusChannel,
+#   .ID (bit 31: .IDE), .DLC, .DataLength, .DataBytes, .Dir, and TCanMsg_Flags
+#   (the flags of the record, so nothing is lost in a round trip)
+# the records go into one DT block, its length and the cycle count are
+# written when the file is closed.
+
+MDF_BLOCK = struct.Struct("<4s4xQQ")       # id, length, link count
+MDF_RECORD = struct.Struct("<dBIBB8sBI")   # time, channel, id|ide<<31, dlc, data length, data, dir, flags
+MDF_CN = struct.Struct("<BBBBIIIIBBH6d")
+MDF_HD = struct.Struct("<QhhBBBBdd")
+MDF_CG = struct.Struct("<QQHH4xII")
+MDF_FH_COMMENT = ("<FHcomment><TX>can logger export</TX><tool_id>can_logger</tool_id><tool_vendor>-</tool_vendor>"
+                  "<tool_version>1</tool_version></FHcomment>")
+# name, byte offset, bit offset, bit count, data type (0 uint, 4 float, 10 bytes)
+MDF_CHANNELS = [
+    ("CAN_DataFrame.BusChannel", 8, 0, 8, 0),
+    ("CAN_DataFrame.ID", 9, 0, 29, 0),
+    ("CAN_DataFrame.IDE", 12, 7, 1, 0),
+    ("CAN_DataFrame.DLC", 13, 0, 4, 0),
+    ("CAN_DataFrame.DataLength", 14, 0, 8, 0),
+    ("CAN_DataFrame.DataBytes", 15, 0, 64, 10),
+    ("CAN_DataFrame.Dir", 23, 0, 1, 0),
+]
+
+
+class _MdfBlocks:
+    # blocks with symbolic links, laid out one after the other
+    def __init__(self, position):
+        self.position = position
+        self.blocks = []
+        self.address = {}
+
+    def add(self, name, kind, links, data):
+        data = data + bytes(-len(data) % 8)
+        self.address[name] = self.position
+        self.blocks.append((kind, links, data))
+        self.position += MDF_BLOCK.size + 8 * len(links) + len(data)
+        return name
+
+    def text(self, name, text, kind=b"##TX"):
+        return self.add(name, kind, [], text.encode() + b"\0")
+
+    def tobytes(self):
+        out = []
+        for kind, links, data in self.blocks:
+            addresses = [self.address[link] if link else 0 for link in links]
+            out.append(MDF_BLOCK.pack(kind, MDF_BLOCK.size + 8 * len(links) + len(data), len(links)))
+            out.append(struct.pack("<%dQ" % len(links), *addresses))
+            out.append(data)
+        return b"".join(out)
+
+
+def _mdf_cn(blocks, name, next_cn, kind, sync, data_type, byte_offset, bit_offset, bit_count,
+            composition=None, unit=None):
+    tx = blocks.text(name + ".tx", name)
+    data = MDF_CN.pack(kind, sync, data_type, bit_offset, byte_offset, bit_count, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    return blocks.add(name, b"##CN", [next_cn, composition, tx, None, None, None, unit, None], data)
+
+
+class Mf4Writer(_Writer):
+    def __init__(self, file_name, time_offset_us=0):
+        _Writer.__init__(self, file_name, time_offset_us, mode="wb")
+        self.start_us = None
+        self.cg_address = None
+        self.dt_address = None
+
+    def _header(self, start_us):
+        # ID block and every other block in front of the data
+        self.start_us = start_us
+        blocks = _MdfBlocks(64)
+        blocks.add("hd", b"##HD", ["dg", "fh", None, None, None, None],
+                   MDF_HD.pack(start_us * 1000, 0, 0, 0, 0, 0, 0, 0.0, 0.0))
+        blocks.add("fh_md", b"##MD", [], MDF_FH_COMMENT.encode() + b"\0")
+        blocks.add("fh", b"##FH", [None, "fh_md"], struct.pack("<QhhB3x", start_us * 1000, 0, 0, 0))
+        blocks.add("dg", b"##DG", [None, "cg", "dt", None], bytes(8))
+        blocks.text("cg_name", "CAN_DataFrame")
+        blocks.text("si_name", "CAN")
+        blocks.add("si", b"##SI", ["si_name", "si_name", None], struct.pack("<BBB5x", 2, 2, 0))
+        #bus event + plain bus event, "." as path separator
+        blocks.add("cg", b"##CG", [None, "Timestamp", "cg_name", "si", None, None],
+                   MDF_CG.pack(0, 0, 0x06, ord("."), MDF_RECORD.size, 0))
+        blocks.text("unit_s", "s")
+        _mdf_cn(blocks, "Timestamp", "CAN_DataFrame", 2, 1, 4, 0, 0, 64, unit="unit_s")
+        next_cn = None
+        for name, byte_offset, bit_offset, bit_count, data_type in reversed(MDF_CHANNELS):
+            next_cn = _mdf_cn(blocks, name, next_cn, 0, 0, data_type, byte_offset, bit_offset, bit_count)
+        _mdf_cn(blocks, "CAN_DataFrame", "TCanMsg_Flags", 0, 0, 10, 8, 0, 16 * 8, composition=next_cn)
+        _mdf_cn(blocks, "TCanMsg_Flags", None, 0, 0, 0, 24, 0, 32)
+        self.dt_address = blocks.position
+        blocks.address["dt"] = self.dt_address
+        self.cg_address = blocks.address["cg"]
+        identification = b"MDF     4.10    can_log " + bytes(4) + struct.pack("<H", 410) + bytes(34)
+        self.file.write(identification + blocks.tobytes())
+        self.file.write(MDF_BLOCK.pack(b"##DT", MDF_BLOCK.size, 0))
+
+    def write_chunk(self, records):
+        offset = self.time_offset_us
+        if self.start_us is None:
+            self._header(records[0][3] * 1000000 + records[0][4] + offset)
+        start = self.start_us - offset
+        pack = MDF_RECORD.pack
+        self.file.write(b"".join([pack((sec * 1000000 + usec - start) / 1e6, (flags >> 8) & 0xFF,
+                                       can_id | (1 << 31 if flags & FLAG_EFF else 0), flags & FLAG_DLC,
+                                       flags & FLAG_DLC, data, 1 if flags & FLAG_TXD else 0, flags)
+                                  for can_id, flags, data, sec, usec in records]))
+
+    def close(self):
+        if not self.file:
+            return
+        if self.start_us is None:
+            self._header(self.time_offset_us)
+        size = self.file.tell()
+        self.file.seek(self.dt_address + 8)
+        self.file.write(struct.pack("<Q", size - self.dt_address))
+        #cycle count, behind the 6 links and the record id of the CG block
+        self.file.seek(self.cg_address + MDF_BLOCK.size + 6 * 8 + 8)
+        self.file.write(struct.pack("<Q", self.count))
+        _Writer.close(self)
+
+
+def _mdf_block(f, address):
+    # (id, links, data) of the block at address
+    f.seek(address)
+    kind, length, link_count = MDF_BLOCK.unpack(f.read(MDF_BLOCK.size))
+    links = struct.unpack("<%dQ" % link_count, f.read(8 * link_count))
+    return kind, links, f.read(length - MDF_BLOCK.size - 8 * link_count)
+
+
+def _mdf_text(f, address):
+    if not address:
+        return ""
+    return _mdf_block(f, address)[2].split(b"\0", 1)[0].decode("utf-8", "replace")
+
+
+def _mdf_channels(f, address, prefix=""):
+    # name -> (byte offset, bit offset, bit count, data type, channel type) of a channel list
+    channels = {}
+    while address:
+        kind, links, data = _mdf_block(f, address)
+        cn_type, sync, data_type, bit_offset, byte_offset, bit_count = MDF_CN.unpack_from(data)[:6]
+        name = _mdf_text(f, links[2])
+        channels[name] = (byte_offset, bit_offset, bit_count, data_type, cn_type)
+        if links[1]:
+            #composition: the sub channels of a structure
+            channels.update(_mdf_channels(f, links[1]))
+        address = links[0]
+    return channels
+
+
+def _mdf_data(f, address, chunk_bytes=4 << 20):
+    # bytes of the data blocks (DT, DL list of them, DZ compressed) in pieces
+    if not address:
+        return
+    kind, links, data = _mdf_block(f, address)
+    if kind == b"##DT":
+        f.seek(address)
+        length = MDF_BLOCK.unpack(f.read(MDF_BLOCK.size))[1] - MDF_BLOCK.size
+        position = address + MDF_BLOCK.size
+        while length > 0:
+            f.seek(position)
+            piece = f.read(min(chunk_bytes, length))
+            if not piece:
+                break
+            position += len(piece)
+            length -= len(piece)
+            yield piece
+    elif kind == b"##DZ":
+        block_type, zip_type, parameter, original, packed = struct.unpack_from("<2sBxIQQ", data)
+        raw = zlib.decompress(data[24:24 + packed])
+        if zip_type == 1:
+            #transposed: columns of parameter bytes
+            rows = len(raw) // parameter if parameter else 0
+            head = bytes(raw[:rows * parameter])
+            raw = b"".join(head[n::rows] for n in range(rows)) + raw[rows * parameter:] if rows else raw
+        yield raw
+    elif kind == b"##DL":
+        while address:
+            kind, links, data = _mdf_block(f, address)
+            count = struct.unpack_from("<BxxxI", data)[1]
+            for link in links[1:1 + count]:
+                yield from _mdf_data(f, link, chunk_bytes)
+            address = links[0]
+    elif kind == b"##HL":
+        yield from _mdf_data(f, links[0], chunk_bytes)
+
+
+def _mdf_getter(channel):
+    byte_offset, bit_offset, bit_count, data_type, cn_type = channel
+    if data_type == 10:
+        return lambda record: record[byte_offset:byte_offset + bit_count // 8]
+    if data_type in (4, 5):
+        fmt = struct.Struct(("<" if data_type == 4 else ">") + ("d" if bit_count == 64 else "f"))
+        return lambda record: fmt.unpack_from(record, byte_offset)[0]
+    size = (bit_offset + bit_count + 7) // 8
+    mask = (1 << bit_count) - 1
+    order = "little" if data_type == 0 else "big"
+    return lambda record: (int.from_bytes(record[byte_offset:byte_offset + size], order) >> bit_offset) & mask
+
+
+def iter_mf4(file_name):
+    with open(file_name, "rb") as f:
+        identification = f.read(64)
+        if identification[:3] != b"MDF" or struct.unpack_from("<H", identification, 28)[0] < 400:
+            raise ValueError("{} is no mdf 4 file".format(file_name))
+        kind, links, data = _mdf_block(f, 64)
+        start_us = MDF_HD.unpack_from(data)[0] // 1000
+        dg_address = links[0]
+        groups = []
+        while dg_address:
+            kind, dg_links, dg_data = _mdf_block(f, dg_address)
+            groups.append((dg_links[2], dg_data[0], dg_links[1]))
+            dg_address = dg_links[0]
+        for data_address, record_id_size, cg_address in groups:
+            #record id -> (record size, channels), the can frames are in the group with CAN_DataFrame.ID
+            layouts = {}
+            while cg_address:
+                kind, cg_links, cg_data = _mdf_block(f, cg_address)
+                record_id, cycles, cg_flags, separator, data_bytes, inval_bytes = MDF_CG.unpack_from(cg_data)
+                if cg_flags & 0x01:
+                    raise ValueError("{}: variable length channel groups are not supported".format(file_name))
+                layouts[record_id] = (data_bytes + inval_bytes, _mdf_channels(f, cg_links[1]))
+                cg_address = cg_links[0]
+            yield from _mdf_records(_mdf_data(f, data_address), record_id_size, layouts, start_us)
+
+
+def _mdf_records(pieces, record_id_size, layouts, start_us):
+    getters = {}
+    for record_id, (size, channels) in layouts.items():
+        names = dict((name.rsplit(".", 1)[-1], channel) for name, channel in channels.items())
+        if "ID" not in names or "DataBytes" not in names:
+            continue
+        master = next((channel for channel in channels.values() if channel[4] == 2), None)
+        get = dict((name, _mdf_getter(names[name])) for name in
+                   ("ID", "IDE", "DLC", "DataLength", "DataBytes", "BusChannel", "Dir", "TCanMsg_Flags") if name in names)
+        getters[record_id] = (get, _mdf_getter(master) if master else None)
+    sizes = dict((record_id, size) for record_id, (size, channels) in layouts.items())
+    id_format = {0: None, 1: "<B", 2: "<H", 4: "<I", 8: "<Q"}[record_id_size]
+    rest = b""
+    for piece in pieces:
+        data = rest + piece
+        position = 0
+        end = len(data)
+        while True:
+            record_id = struct.unpack_from(id_format, data, position)[0] if id_format else 0
+            size = sizes[record_id]
+            if position + record_id_size + size > end:
+                break
+            record = data[position + record_id_size:position + record_id_size + size]
+            position += record_id_size + size
+            entry = getters.get(record_id)
+            if entry is None:
+                continue
+            get, master = entry
+            t_us = start_us + (int(round(master(record) * 1000000)) if master else 0)
+            can_id = get["ID"](record)
+            if "TCanMsg_Flags" in get:
+                flags = get["TCanMsg_Flags"](record)
+            else:
+                dlc = get["DLC"](record) if "DLC" in get else get["DataLength"](record)
+                flags = _record_flags(dlc, get["BusChannel"](record) if "BusChannel" in get else 0,
+                                      tx=get["Dir"](record) if "Dir" in get else 0,
+                                      eff=get["IDE"](record) if "IDE" in get else can_id > 0x7FF)
+            yield _record(can_id & EFF_MASK, flags, bytes(get["DataBytes"](record)), t_us)
+            if position >= end:
+                break
+        rest = data[position:]
+
+
+# ---------------- by file ending ----------------
+
+FORMATS = {
+    "asc": (AscWriter, iter_asc),
+    "log": (CandumpWriter, iter_candump),
+    "blf": (BlfWriter, iter_blf),
+    "mf4": (Mf4Writer, iter_mf4),
+}
+
+
+def _ending(file_name):
+    ending = os.path.splitext(file_name)[1].lstrip(".").lower()
+    if ending not in FORMATS:
+        raise ValueError("unknown log format .{} ({})".format(ending, ", ".join(sorted(FORMATS))))
+    return ending
+
+
+def open_writer(file_name, time_offset_us=0, **kwargs):
+    # writer for the format of the file ending
+    return FORMATS[_ending(file_name)][0](file_name, time_offset_us, **kwargs)
+
+
+def iter_file(file_name):
+    # records of a file in one of the FORMATS
+    return FORMATS[_ending(file_name)][1](file_name)
+
+
+def export_records(records, file_name, time_offset_us=0, **kwargs):
+    # writes the records into file_name (format from the ending), returns the frame count
+    with open_writer(file_name, time_offset_us, **kwargs) as writer:
+        return writer.write(records)
@@ -0,0 +1,413 @@
+# random access to recorded logs without reading them into memory
+# the binary segments are memory mapped, only the pages that are touched are
+# read from disk, so recordings much larger than the ram can be explored.
+#   log = log_reader.open_log("LOGS/can_0.bin")        (or a list / folder of segments)
+#   log = log_reader.open_log("LOGS", name="can")      (folder with more than one recording)
+#   log[1000]                       -> record (Id, Flags, Data, Sec, USec), decoded on access
+#   log[1000:2000]                  -> LogView, nothing is decoded yet
+#   log.time_slice(t0_us, t1_us)    -> LogView of the frames in the device time range
+#   log.time_slice(t0_us, t1_us, channel=1) -> same with the device time of channel 1
+#   log.select_ids([0x100, 0x200])  -> LogView of the frames with these ids
+#   log.query(expr)                 -> LogView of the frames a can_logger.frame_expr expression is true for
+#   view.array()                    -> numpy structured array, a view into the mapped file
+# the time slicing uses a binary search, so the frames have to be in time
+# order (as written by the logger / the channel merger). the merger orders
+# the frames of several channels by host time, every channel has its own
+# device clock: such a log is searched in host time (clock mappings of the
+# segment headers), the range is given in the device time of one channel.
+# on-change recordings (can_logger.on_change) only hold the changed frames,
+# the repetitions are counted in the upper Flags bits. indexing and iterating
+# give these written frames, time_slice / select_ids / query / array / times
+# refuse such a log (ValueError), the full stream comes from
+# can_logger.replay.iter_recording.
+# text logs are converted to a binary segment next to them once (see
+# convert_text / text_convert), later opens use the converted file.
+
+import bisect
+import mmap
+import os
+import struct
+
+from . import binary_log
+from . import text_log
+from . import text_convert
+from ..can_logger import clock_sync
+
+try:
+    import numpy as np
+except ImportError:
+    np = None   # array() is not available, everything else works without numpy
+
+if np is not None:
+    RECORD_DTYPE = np.dtype([("Id", "<u4"), ("Flags", "<u4"), ("Data", "u1", (8,)), ("Sec", "<u4"), ("USec", "<u4")])
+else:
+    RECORD_DTYPE = None
+
+RECORD = binary_log.RECORD
+RECORD_SIZE = binary_log.RECORD_SIZE
+TIME = struct.Struct("<II")      # Sec, USec at offset 16 of a record
+
+
+def record_time(record):
+    # device time of a record in us
+    return record[3] * 1000000 + record[4]
+
+
+class Segment:
+    # one memory mapped binary segment
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.header = binary_log.read_header(file_name)
+        if self.header["record_size"] != RECORD_SIZE:
+            raise ValueError("{}: record size {} not supported".format(file_name, self.header["record_size"]))
+        self.offset = self.header["header_size"]
+        self.file = open(file_name, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        #a segment that was not closed may end with half a record
+        self.count = min(self.header["record_count"], (size - self.offset) // RECORD_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.index = None
+        #device -> host clock mapping per channel
+        self.clocks = dict((int(tag), mapping) for tag, mapping in self.header["info"].get("clocks", {}).items()
+                           if mapping)
+
+    def __len__(self):
+        return self.count
+
+    def may_contain(self, ids):
+        # False if the sidecar index (text_convert) says none of the ids is in the segment
+        if self.index is None:
+            self.index = text_convert.read_index(self.file_name) or {}
+        if "ids" not in self.index:
+            return True
+        return any("{:x}".format(can_id) in self.index["ids"] for can_id in ids)
+
+    def record(self, index):
+        return RECORD.unpack_from(self.map, self.offset + index * RECORD_SIZE)
+
+    def time(self, index):
+        sec, usec = TIME.unpack_from(self.map, self.offset + index * RECORD_SIZE + 16)
+        return sec * 1000000 + usec
+
+    def host_time(self, index=None, channel=0, device_us=None):
+        # host (monotonic) time in us of a record or of device_us on channel, the key the merger
+        # orders by. a channel without a mapping uses the one of channel 0
+        if index is not None:
+            record = self.record(index)
+            channel = binary_log.record_channel(record[1])
+            device_us = record_time(record)
+        mapping = self.clocks.get(channel) or self.clocks.get(0)
+        if mapping is None:
+            return device_us
+        return clock_sync.device_to_monotonic(mapping, device_us) * 1e6
+
+    def records(self, start, stop):
+        unpack = RECORD.unpack_from
+        data = self.map
+        for position in range(self.offset + start * RECORD_SIZE, self.offset + stop * RECORD_SIZE, RECORD_SIZE):
+            yield unpack(data, position)
+
+    def array(self, start, stop):
+        if np is None:
+            raise RuntimeError("numpy is not installed")
+        return np.frombuffer(self.map, dtype=RECORD_DTYPE, count=stop - start,
+                             offset=self.offset + start * RECORD_SIZE)
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                #numpy views are still alive, the map goes with them
+                pass
+        self.file.close()
+
+
+class LogView:
+    # frames [start, stop) of a log, optionally only the positions in selection
+    def __init__(self, log, start, stop, selection=None):
+        self.log = log
+        self.start = start
+        self.stop = stop
+        self.selection = selection
+
+    def __len__(self):
+        if self.selection is not None:
+            return len(self.selection)
+        return self.stop - self.start
+
+    def positions(self):
+        if self.selection is not None:
+            return iter(self.selection)
+        return iter(range(self.start, self.stop))
+
+    def __iter__(self):
+        if self.selection is not None:
+            record = self.log.record
+            return (record(position) for position in self.selection)
+        return self.log.records(self.start, self.stop)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if self.selection is not None:
+                return LogView(self.log, self.start, self.stop, self.selection[item])
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                return LogView(self.log, self.start, self.stop, list(range(self.start + start, self.start + stop, step)))
+            return LogView(self.log, self.start + start, self.start + stop)
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("frame index out of range")
+        if self.selection is not None:
+            return self.log.record(self.selection[item])
+        return self.log.record(self.start + item)
+
+    def _full_stream(self, what):
+        if self.log.on_change:
+            raise ValueError("{} of an on-change recording (heartbeat {} s) would miss the left out repetitions, "
+                             "use can_logger.replay.iter_recording for the full stream".format(what, self.log.on_change))
+
+    def time_slice(self, t_from=None, t_to=None, channel=0):
+        # frames with t_from <= device time (us) < t_to, channel: whose device time
+        # the range is in, only matters for a log of several channels
+        self._full_stream("time_slice")
+        start = self.start if t_from is None else max(self.start, self.log.time_index(t_from, channel))
+        stop = self.stop if t_to is None else min(self.stop, self.log.time_index(t_to, channel))
+        stop = max(start, stop)
+        if self.selection is not None:
+            lo = _bisect(self.selection, start)
+            hi = _bisect(self.selection, stop)
+            return LogView(self.log, start, stop, self.selection[lo:hi])
+        return LogView(self.log, start, stop)
+
+    def select_ids(self, ids, channel=None):
+        # frames with one of the can ids (and the channel, if given)
+        self._full_stream("select_ids")
+        ids = set(ids)
+        if np is not None and self.selection is None:
+            parts = []
+            for segment, first, start, stop in self.log.parts(self.start, self.stop):
+                if not segment.may_contain(ids):
+                    continue
+                frames = segment.array(start, stop)
+                mask = np.isin(frames["Id"], list(ids))
+                if channel is not None:
+                    mask &= (frames["Flags"] >> 8) & 0xFF == channel
+                parts.append(np.flatnonzero(mask) + (first + start))
+            return LogView(self.log, self.start, self.stop, _positions(parts))
+        selection = []
+        for position in self.positions():
+            record = self.log.record(position)
+            if record[0] in ids and (channel is None or binary_log.record_channel(record[1]) == channel):
+                selection.append(position)
+        return LogView(self.log, self.start, self.stop, selection)
+
+    def query(self, expression):
+        # frames the expression (can_logger.frame_expr.Expression) is true for. only
+        # the ids it can match are looked at, with numpy the segments are evaluated as arrays
+        self._full_stream("query")
+        view = self.select_ids(expression.ids) if expression.ids is not None else self
+        if np is not None:
+            if view.selection is not None:
+                positions = np.asarray(view.selection, dtype=np.int64)
+                if not len(positions):
+                    return view
+                mask = expression.evaluate(view.array())
+                return LogView(self.log, self.start, self.stop, positions[mask])
+            parts = []
+            for segment, first, start, stop in self.log.parts(self.start, self.stop):
+                mask = expression.evaluate(segment.array(start, stop))
+                parts.append(np.flatnonzero(mask) + (first + start))
+            return LogView(self.log, self.start, self.stop, _positions(parts))
+        match = expression.match_record
+        record = self.log.record
+        selection = [position for position in view.positions() if match(record(position))]
+        return LogView(self.log, self.start, self.stop, selection)
+
+    def array(self):
+        # numpy structured array (RECORD_DTYPE), a view into the mapped file if the
+        # frames are in one segment, else a copy
+        self._full_stream("array")
+        if np is None:
+            raise RuntimeError("numpy is not installed")
+        if self.selection is not None:
+            return self.log.take(np.asarray(self.selection, dtype=np.int64))
+        return self.log.array(self.start, self.stop)
+
+    def times(self):
+        # device times in us
+        self._full_stream("times")
+        if np is not None:
+            frames = self.array()
+            return frames["Sec"].astype(np.int64) * 1000000 + frames["USec"]
+        return [record_time(record) for record in self]
+
+
+def _positions(parts):
+    # one index array of the per segment positions, no python list in between
+    if not parts:
+        return np.zeros(0, dtype=np.int64)
+    return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def _bisect(selection, position):
+    if np is not None and isinstance(selection, np.ndarray):
+        return int(np.searchsorted(selection, position))
+    return bisect.bisect_left(selection, position)
+
+
+class Log(LogView):
+    # the segments of one recording as one sequence of frames
+    def __init__(self, file_names):
+        self.segments = [Segment(file_name) for file_name in file_names]
+        #heartbeat of an on-change recording, None for a full one
+        self.on_change = None
+        for segment in self.segments:
+            on_change = segment.header["info"].get("on_change")
+            if on_change:
+                self.on_change = on_change.get("heartbeat")
+        #frames of several channels are merged in host time
+        self.multi_channel = any(len(segment.clocks) > 1 for segment in self.segments)
+        self.firsts = []
+        count = 0
+        for segment in self.segments:
+            self.firsts.append(count)
+            count += len(segment)
+        LogView.__init__(self, self, 0, count)
+
+    def _locate(self, position):
+        n = bisect.bisect_right(self.firsts, position) - 1
+        return self.segments[n], position - self.firsts[n]
+
+    def record(self, position):
+        segment, index = self._locate(position)
+        return segment.record(index)
+
+    def time(self, position):
+        segment, index = self._locate(position)
+        return segment.time(index)
+
+    def parts(self, start, stop):
+        # (segment, first position of the segment, start, stop inside the segment)
+        for segment, first in zip(self.segments, self.firsts):
+            lo = max(start - first, 0)
+            hi = min(stop - first, len(segment))
+            if lo < hi:
+                yield segment, first, lo, hi
+
+    def records(self, start, stop):
+        for segment, first, lo, hi in self.parts(start, stop):
+            yield from segment.records(lo, hi)
+
+    def array(self, start=0, stop=None):
+        self._full_stream("array")
+        if np is None:
+            raise RuntimeError("numpy is not installed")
+        if stop is None:
+            stop = self.stop
+        parts = [segment.array(lo, hi) for segment, first, lo, hi in self.parts(start, stop)]
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return np.concatenate(parts)
+
+    def take(self, positions):
+        # copy of the rows at the (ascending) positions, gathered per segment,
+        # only the selected rows are copied
+        if np is None:
+            raise RuntimeError("numpy is not installed")
+        parts = []
+        for segment, first in zip(self.segments, self.firsts):
+            lo, hi = np.searchsorted(positions, (first, first + len(segment)))
+            if lo < hi:
+                local = positions[lo:hi] - first
+                parts.append(segment.array(int(local[0]), int(local[-1]) + 1)[local - local[0]])
+        if not parts:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def time_index(self, t_us, channel=0):
+        # first position with a device time >= t_us (binary search). a log of several
+        # channels is searched per segment in host time, t_us is device time of channel
+        if not self.multi_channel:
+            return self._search(0, self.stop, t_us, self.time)
+        for segment, first in zip(self.segments, self.firsts):
+            if not len(segment):
+                continue
+            t_host = segment.host_time(channel=channel, device_us=t_us)
+            if segment.host_time(len(segment) - 1) >= t_host:
+                return first + self._search(0, len(segment), t_host, segment.host_time)
+        return self.stop
+
+    @staticmethod
+    def _search(lo, hi, t, time):
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if time(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def info(self):
+        return [segment.header["info"] for segment in self.segments]
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _segment_nr(name):
+    # ("<name>", n) of a "<name>_<n>.bin" file, (stem, -1) for other names
+    stem = os.path.splitext(os.path.basename(name))[0]
+    prefix, _, nr = stem.rpartition("_")
+    return (prefix, int(nr)) if nr.isdigit() else (stem, -1)
+
+
+def segment_files(path, name=None):
+    # the segments of a folder or a "<name>_<n>.bin" file in the order of n.
+    # a folder has to hold one recording (one <name>), else name selects it:
+    # different recordings, trigger captures and converted text logs together
+    # are not in time order
+    if not os.path.isdir(path):
+        return [path]
+    names = [os.path.join(path, file_name) for file_name in os.listdir(path)
+             if file_name.endswith("." + binary_log.FILE_ENDING)]
+    if name is not None:
+        names = [file_name for file_name in names if _segment_nr(file_name)[0] == name]
+    prefixes = sorted(set(_segment_nr(file_name)[0] for file_name in names))
+    if len(prefixes) > 1:
+        raise ValueError("{} has more than one recording ({}), select one with name=".format(
+            path, ", ".join(prefixes)))
+    return sorted(names, key=_segment_nr)
+
+
+def convert_text(file_name, out_name=None):
+    # one time conversion of a text log to a binary segment, returns the file name.
+    # the converted file is reused as long as it is newer than the text log
+    if out_name is None:
+        out_name = os.path.splitext(file_name)[0] + "." + binary_log.FILE_ENDING
+    if os.path.isfile(out_name) and os.path.getmtime(out_name) >= os.path.getmtime(file_name):
+        return out_name
+    return text_convert.convert_file(file_name, out_name)[0]
+
+
+def open_log(path, name=None):
+    # path: binary segment, folder of segments, text log or a list of them
+    # name: the recording ("<name>_<n>.bin") in a folder with several
+    if isinstance(path, (list, tuple)):
+        names = []
+        for item in path:
+            names.extend(segment_files(item, name))
+    else:
+        names = segment_files(path, name)
+    names = [convert_text(name) if name.endswith("." + text_log.FILE_ENDING) else name for name in names]
+    return Log(names)
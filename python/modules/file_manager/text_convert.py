@@ -0,0 +1,199 @@
+# bulk conversion of the semicolon text data files to binary segments
+# the files are parsed in chunks of lines and column by column instead of
+# line by line: the lines are split once, the columns are converted with one
+# map() each and the payloads of a whole chunk go through one bytes.fromhex
+# call (it skips the spaces between the bytes). the reversed byte order of
+# the save_cached_msgs layout is undone for the whole chunk at once.
+# a chunk the column parser can't handle (broken lines, mixed layouts) is
+# parsed line by line with text_log.parse_line, so the result is the same.
+#
+# every converted file gets a binary segment and a sidecar index
+# (<name>.idx, json): device time of every index_step-th frame and the
+# frame count per id, log_reader uses it to skip segments in id selections.
+# convert_files() runs one file per process.
+
+import json
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from operator import itemgetter
+
+from . import binary_log
+from . import text_log
+from .binary_log import FLAG_TXD, FLAG_RTR, FLAG_EFF
+
+INDEX_ENDING = "idx"
+CHUNK_BYTES = 4 << 20
+
+_FORMAT_FLAGS = {"STD": 0, "EFF": FLAG_EFF, "STD/RTR": FLAG_RTR, "EFF/RTR": FLAG_EFF | FLAG_RTR}
+
+
+def index_file_name(file_name):
+    return os.path.splitext(file_name)[0] + "." + INDEX_ENDING
+
+
+def read_index(file_name):
+    # sidecar index of a binary segment, None if there is none
+    try:
+        with open(index_file_name(file_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _payloads(column, dlcs, reverse):
+    # one bytes.fromhex for the whole column, split by the dlc
+    blob = bytes.fromhex(" ".join(column))
+    if len(blob) != sum(dlcs):
+        raise ValueError("payload length does not match the dlc")
+    if reverse:
+        #reversing the whole blob reverses every payload and the order of the frames
+        blob = blob[::-1]
+        dlcs = dlcs[::-1]
+    payloads = []
+    position = 0
+    for dlc in dlcs:
+        payloads.append(blob[position:position + dlc].ljust(8, b"\0"))
+        position += dlc
+    if reverse:
+        payloads.reverse()
+    return payloads
+
+
+def _flags(dlcs, directions, formats, channels, ids):
+    format_flags = _FORMAT_FLAGS
+    return [dlc | (FLAG_TXD if direction == "TX" else 0) | format_flags.get(f_format, 0)
+            | (FLAG_EFF if can_id > 0x7FF else 0) | channel << 8
+            for dlc, direction, f_format, channel, can_id in zip(dlcs, directions, formats, channels, ids)]
+
+
+def _wall_time(value):
+    h, m, sec, usec = value.split(":")
+    return ((int(h) * 60 + int(m)) * 60 + int(sec)) * 1000000 + int(usec)
+
+
+def parse_columns(text):
+    # frame lines of one layout -> records, ValueError if the chunk doesn't fit the column parser
+    #one split for the whole chunk, the columns are every width-th field
+    first = text[:text.index("\n")] if "\n" in text else text
+    width = first.count(";") + 1
+    if width < 6:
+        raise ValueError("no data lines")
+    fields = text.replace("\r", "").rstrip("\n").replace("\n", ";").split(";")
+    lines = len(fields) // width
+    if len(fields) != lines * width or text.count("\n") not in (lines, lines - 1):
+        raise ValueError("mixed columns")
+    columns = [fields[k::width] for k in range(width)]
+    dlcs = list(map(int, columns[4]))
+    if ":" in columns[0][0]:
+        #time;ID;direction;type;dlc;payload
+        times = list(map(_wall_time, columns[0]))
+        ids = list(map(int, columns[1], repeat(16)))
+        payloads = _payloads(columns[5], dlcs, reverse=False)
+        channels = repeat(0)
+    else:
+        #Id;tTime;direction;format;dlc;data;diff[;channel]
+        ids = list(map(int, columns[0], repeat(16)))
+        times = list(map(int, columns[1]))
+        payloads = _payloads(columns[5], dlcs, reverse=True)
+        channels = [int(c) if c.isdigit() else 0 for c in columns[7]] if width > 7 else repeat(0)
+    flags = _flags(dlcs, columns[2], columns[3], channels, ids)
+    return list(zip(ids, flags, payloads, [t // 1000000 for t in times], [t % 1000000 for t in times]))
+
+
+def parse_chunk(text, comments=None):
+    # a chunk of whole lines of a text data file -> records
+    # comments: list that gets the comment lines (#clock, #lost)
+    if text.startswith("#") or "\n#" in text or "\n\n" in text or text.startswith("\n"):
+        lines = text.splitlines()
+        if comments is not None:
+            comments.extend(line for line in lines if line.startswith("#"))
+        text = "\n".join(line for line in lines if line.strip() and line[0] != "#")
+    if not text.strip():
+        return []
+    try:
+        return parse_columns(text)
+    except (ValueError, IndexError):
+        records = []
+        for line in text.split("\n"):
+            record = text_log.parse_line(line)
+            if record:
+                records.append(record)
+        return records
+
+
+def iter_chunks(file_name, chunk_bytes=CHUNK_BYTES):
+    # text chunks that end at a line end
+    with open(file_name, "r", errors="ignore") as f:
+        while True:
+            text = f.read(chunk_bytes)
+            if not text:
+                break
+            if not text.endswith("\n"):
+                text += f.readline()
+            yield text
+
+
+def convert_file(file_name, out_name=None, index_step=4096):
+    # text data file -> binary segment + sidecar index, returns (out_name, frame count)
+    if out_name is None:
+        out_name = os.path.splitext(file_name)[0] + "." + binary_log.FILE_ENDING
+    info = {"name": os.path.basename(file_name), "converted_from": "text"}
+    temp_name = out_name + ".part"
+    pack = binary_log.RECORD.pack
+    count = 0
+    time_index = []
+    id_counts = Counter()
+    comments = []
+    with open(temp_name, "wb") as f:
+        f.write(binary_log._header_bytes(0, info))
+        for text in iter_chunks(file_name):
+            records = parse_chunk(text, comments)
+            if not records:
+                continue
+            f.write(b"".join([pack(*record) for record in records]))
+            for position in range(-count % index_step, len(records), index_step):
+                record = records[position]
+                time_index.append((count + position, record[3] * 1000000 + record[4]))
+            id_counts.update(map(itemgetter(0), records))
+            count += len(records)
+        clocks = [line for line in comments if line.startswith("#clock;")]
+        info["clock"] = json.loads(clocks[-1][len("#clock;"):]) if clocks else None
+        header = binary_log._header_bytes(count, info)
+        f.seek(0)
+        f.write(header)
+    os.replace(temp_name, out_name)
+    index = {
+        "records": count,
+        "index_step": index_step,
+        "time_index": time_index,
+        "ids": dict(("{:x}".format(can_id), n) for can_id, n in sorted(id_counts.items())),
+        "source": os.path.abspath(file_name),
+        "source_size": os.path.getsize(file_name),
+    }
+    with open(index_file_name(out_name), "w") as f:
+        json.dump(index, f)
+    return out_name, count
+
+
+def _convert(job):
+    file_name, out_name = job
+    return convert_file(file_name, out_name)
+
+
+def convert_files(file_names, out_folder=None, workers=None):
+    # converts the files in parallel (one process per file), returns [(out_name, frame count)]
+    jobs = []
+    for file_name in file_names:
+        out_name = None
+        if out_folder:
+            out_name = os.path.join(out_folder, os.path.splitext(os.path.basename(file_name))[0]
+                                    + "." + binary_log.FILE_ENDING)
+        jobs.append((file_name, out_name))
+    if out_folder and not os.path.isdir(out_folder):
+        os.makedirs(out_folder)
+    if workers == 1 or len(jobs) < 2:
+        return [_convert(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_convert, jobs))
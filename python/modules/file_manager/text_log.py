@@ -0,0 +1,76 @@
+# reading the semicolon text data files
+# two layouts exist:
+#   Id;tTime;direction;format;dlc;data;diff[;channel]   (save_cached_msgs)
+#     tTime is the device time in us, data is hex with the last byte first
+#   time;ID;direction;type;dlc;payload                  (CanLogger.formatMessage)
+#     time is the wall clock %H:%M:%S:%f, payload is hex in byte order
+# lines starting with # (clock header) and column header lines are skipped.
+# frames come out as the same (Id, Flags, Data, Sec, USec) records as binary_log
+
+import json
+
+from .binary_log import FLAG_TXD, FLAG_RTR, FLAG_EFF
+
+FILE_ENDING = "txt"
+
+
+def _flags(dlc, direction, f_format, channel=0):
+    flags = dlc & 0x0F
+    if direction == "TX":
+        flags |= FLAG_TXD
+    if "EFF" in f_format:
+        flags |= FLAG_EFF
+    if "RTR" in f_format:
+        flags |= FLAG_RTR
+    return flags | (channel & 0xFF) << 8
+
+
+def parse_line(line):
+    # returns a record or None for lines without a frame
+    line = line.strip()
+    if not line or line[0] == "#":
+        return None
+    fields = line.split(";")
+    if len(fields) < 6:
+        return None
+    try:
+        if ":" in fields[0]:
+            #time;ID;direction;type;dlc;payload
+            h, m, sec, usec = fields[0].split(":")
+            t_us = ((int(h) * 60 + int(m)) * 60 + int(sec)) * 1000000 + int(usec)
+            can_id = int(fields[1], 16)
+            dlc = int(fields[4])
+            data = bytes.fromhex(fields[5])
+            channel = 0
+        else:
+            #Id;tTime;direction;format;dlc;data;diff[;channel]
+            can_id = int(fields[0], 16)
+            t_us = int(fields[1])
+            dlc = int(fields[4])
+            data = bytes.fromhex(fields[5])[::-1]
+            channel = int(fields[7]) if len(fields) > 7 and fields[7] else 0
+    except ValueError:
+        #column header or broken line
+        return None
+    flags = _flags(dlc, fields[2], fields[3], channel)
+    if can_id > 0x7FF:
+        flags |= FLAG_EFF
+    return (can_id, flags, data.ljust(8, b"\0")[:8], t_us // 1000000, t_us % 1000000)
+
+
+def iter_records(file_name):
+    with open(file_name, "r", errors="ignore") as f:
+        for line in f:
+            record = parse_line(line)
+            if record:
+                yield record
+
+
+def read_clock_header(file_name):
+    # last #clock line of the file, None if there is none
+    mapping = None
+    with open(file_name, "r", errors="ignore") as f:
+        for line in f:
+            if line.startswith("#clock;"):
+                mapping = json.loads(line[len("#clock;"):])
+    return mapping
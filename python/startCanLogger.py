@@ -1,4 +1,5 @@
 import os
+import queue
 import modules
 import DBCReader
 
@@ -7,23 +8,163 @@ init_mhs = 1
 #settings for can
 baudrate = 1000
 snr = None
+#serial numbers of several tiny cans (one can bus each), None -> single device
+snr_list = None
 reconnect_attemps=10
+#acceptance filter, explicit list of can ids or None to use the ids of the dbc
+filter_ids = None
+hw_filter_slots = 4
+#"txt" or "bin"
+data_format = "txt"
+#"bin" only: write a frame only when its payload changed, at least every on_change_heartbeat s per id, None -> every frame
+on_change_heartbeat = None
+#decoded signals to LOGS/<name>_SIGNALS_<n>.txt, compressed ("swinging_door" or "deadband")
+#within signal_tolerances (signal name -> tolerance, default: scale factor of the signal)
+signal_log = 0
+signal_compression = "swinging_door"
+signal_tolerances = None
+signal_max_gap = 60
+#frames of these ids trigger a capture of capture_pre s before and capture_post s after them
+#into LOGS/<name>_TRIGGER_<n>.bin, None -> off. capture_rate: max frames/s for the ring buffer size
+capture_ids = None
+#or when this expression is true, e.g. "BMS_Voltage > 400 or byte[2] & 0x80" (see can_logger/frame_expr)
+capture_expr = None
+capture_pre = 10
+capture_post = 5
+capture_rate = 20000
+#raw frames for other local processes (decoder, uplink, dashboard) in this shared memory ring, None -> off
+#(see can_logger/frame_bus, the readers use FrameBusReader(frame_bus))
+frame_bus = None
+frame_bus_size = 1 << 16
+#read from socketcan interface(s) ("can0", "vcan0" or a list) instead of the tiny-can, None -> tiny-can
+socketcan_interface = None
+#every received frame also goes out to this socketcan interface (e.g. "vcan0" for candump), None -> off
+#(not one of socketcan_interface, the frames would come back in)
+socketcan_mirror = None
+#live frames over tcp on this port (clients: can_logger/frame_stream.FrameStreamClient), None -> off
+#stream_multicast: (group, port) for an udp multicast stream as well
+stream_port = None
+stream_multicast = None
+#rx fifo of the driver (frames) and what to give up when it fills up, in this order
+rx_fifo_size = 16384
+backpressure_policies = ("pause_decode", "raw_only", "drop_low_priority")
+#ids dropped by the drop_low_priority policy
+low_priority_ids = None
+#decoder queue length (batches) that counts as a full queue for the back-pressure
+decode_queue_limit = 200
+#run without hardware on a virtual bus carrying the dbc ids at the given bus load
+simulate = 0
+sim_bus_load = 0.5
+#prometheus text endpoint on localhost (e.g. 9108), None -> off
+metrics_port = None
+#seconds between the stats lines in the event log, 0 -> off
+stats_interval = 60
+#kill -USR1 <pid> profiles rx callback, decoder and writer for profile_seconds (result in LOGS/)
+profile_signal = 1
+profile_mode = "sample"
+profile_seconds = 30
+#control socket for the profiler on localhost (e.g. 9109), None -> off
+profile_port = None
 
-new_can_msg_rx =0
-current_frame_nr =0
 DBC_data={}
+signal_writer = None
+#batches of frames for the decoder, filled by the router in the rx callback
+decode_queue = queue.Queue()
+
+
+@modules.can_logger.profiling.profiled("decoder")
+def decode_frames(raw_msgs):
+    for raw_msg in raw_msgs:
+        dat = modules.can_logger.top_level_can_logger.can_msg_to_dicct(raw_msg)
+        signals = DBCReader.convert_can_frame_to_signals(dat)
+        if signal_writer:
+            signal_writer.add_frame(dat.get("tTime"), signals)
 
 
 def main():
-    global current_frame_nr
     global DBC_data
+    global signal_writer
     #check if the folder for log files exist
     if os.path.isdir("LOGS") ==0:
         os.mkdir("LOGS")
 
-    #check if there is can device here
-    modules.can_logger.top_level_can_logger.connect_tiny_can(baudrate,reconnect_attemps)
     DBC_data=DBCReader.read_dbc()
+    ids = filter_ids
+    if ids is None:
+        ids = modules.can_logger.can_filter.frame_ids_from_dbc(DBC_data)
+    if signal_log:
+        compression = modules.can_logger.signal_compression
+        signal_writer = compression.SignalLogWriter(
+            modules.can_logger.top_level_can_logger.data_file_name.rsplit(".",1)[0], DBC_data,
+            compression.SignalCompressor(DBC_data, tolerances=signal_tolerances, mode=signal_compression,
+                                         max_gap=signal_max_gap))
+    #decoding runs here in the main thread, not in the rx callback
+    dbc_ids = [can_id for can_id, eff in modules.can_logger.can_filter.frame_ids_from_dbc(DBC_data)]
+    modules.can_logger.top_level_can_logger.router.subscribe(decode_queue.put, ids=dbc_ids, name="decoder")
+
+    metrics = modules.can_logger.metrics
+    metrics.registry.add_collector(lambda: metrics.registry.gauge(
+        "can_decode_queue_batches", "batches waiting for the decoder").set(decode_queue.qsize()))
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+    reporter = metrics.start_stats_reporter(stats_interval) if stats_interval else None
+    profiling = modules.can_logger.profiling
+    if profile_signal:
+        profiling.install_signal_handler(mode=profile_mode, duration=profile_seconds)
+    if profile_port:
+        profiling.start_control_server(profile_port)
+
+    modules.can_logger.top_level_can_logger.data_format = data_format
+    dll = None
+    if simulate:
+        dll = modules.TinyCan.virtualTinyCan.VirtualTinyCanLibrary(
+            traffic=modules.TinyCan.virtualTinyCan.bus_load_traffic(dbc_ids, load=sim_bus_load, bitrate=baudrate))
+    #check if there is can device here
+    if socketcan_interface:
+        modules.can_logger.top_level_can_logger.connect_socketcan(socketcan_interface,filter_ids=ids,
+                                                                  on_change_heartbeat=on_change_heartbeat)
+    elif snr_list:
+        modules.can_logger.top_level_can_logger.connect_tiny_can_channels(baudrate,snr_list,reconnect_attemps,
+                                                                          filter_ids=ids,hw_filter_slots=hw_filter_slots,
+                                                                          dll=dll,rx_fifo_size=rx_fifo_size,
+                                                                          policies=backpressure_policies,
+                                                                          low_priority_ids=low_priority_ids,
+                                                                          on_change_heartbeat=on_change_heartbeat)
+    else:
+        modules.can_logger.top_level_can_logger.connect_tiny_can(baudrate,reconnect_attemps,
+                                                                 filter_ids=ids,hw_filter_slots=hw_filter_slots,
+                                                                 dll=dll,rx_fifo_size=rx_fifo_size,
+                                                                 policies=backpressure_policies,
+                                                                 low_priority_ids=low_priority_ids,
+                                                                 on_change_heartbeat=on_change_heartbeat)
+    capture = None
+    if capture_ids or capture_expr:
+        trigger_capture = modules.can_logger.trigger_capture
+        triggers = []
+        if capture_ids:
+            triggers.append(trigger_capture.id_trigger("ids", capture_ids))
+        if capture_expr:
+            triggers.append(trigger_capture.expr_trigger("expr", capture_expr, DBCReader.signal_codecs(DBC_data)))
+        capture = trigger_capture.TriggerCapture(
+            modules.can_logger.top_level_can_logger.data_file_name.rsplit(".",1)[0],
+            triggers,
+            pre_seconds=capture_pre, post_seconds=capture_post, max_rate=capture_rate)
+        modules.can_logger.top_level_can_logger.router.subscribe(capture.push, name="capture")
+    bus = None
+    if frame_bus:
+        bus = modules.can_logger.frame_bus.FrameBusWriter(frame_bus, capacity=frame_bus_size)
+        modules.can_logger.top_level_can_logger.router.subscribe(bus.publish, name="frame_bus")
+    stream = None
+    if stream_port:
+        stream = modules.can_logger.frame_stream.start_stream_server(
+            stream_port, signals=DBCReader.signal_codecs(DBC_data), multicast=stream_multicast)
+        modules.can_logger.top_level_can_logger.router.subscribe(stream.publish, name="stream")
+    if socketcan_mirror:
+        modules.can_logger.top_level_can_logger.mirror_socketcan(socketcan_mirror)
+    #a decoder falling behind is back-pressure too (tiny-can only, socketcan has no rx fifo to watch)
+    if modules.can_logger.top_level_can_logger.backpressure:
+        modules.can_logger.top_level_can_logger.backpressure.add_pressure_source(
+            lambda: decode_queue.qsize() / float(decode_queue_limit))
 
     #if init_mhs==1:
     #    can_driver=modules.tiny_can.MhsTinyCanDriver()
@@ -33,17 +174,28 @@ def main():
 
     try:
         while True:
-            while modules.can_logger.top_level_can_logger.newData()==1:
-                dat =  modules.can_logger.top_level_can_logger.read_buffered_can_frame_dicct_by_nr(current_frame_nr) 
-                if dat:
-                    #print(dat)
-                    # print()
-                    DBCReader.convert_can_frame_to_signals(dat)
-                    current_frame_nr+=1
-            if new_can_msg_rx:
-                pass
+            try:
+                raw_msgs = decode_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            decode_frames(raw_msgs)
     except KeyboardInterrupt:
         modules.logFileManager.logEvent("Keyboard")
+    if snr_list or socketcan_interface:
+        modules.can_logger.top_level_can_logger.close_tiny_can_channels()
+    modules.can_logger.top_level_can_logger.close_data_file()
+    if modules.can_logger.top_level_can_logger.backpressure:
+        modules.can_logger.top_level_can_logger.backpressure.close()
+    if signal_writer:
+        signal_writer.close()
+    if capture:
+        capture.close()
+    if bus:
+        bus.close()
+    if stream:
+        stream.close()
+    if reporter:
+        reporter.stop()
 
 
 
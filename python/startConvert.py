@@ -0,0 +1,32 @@
+import argparse
+import glob
+import os
+import time
+from modules.file_manager import text_convert
+
+
+def main():
+    parser = argparse.ArgumentParser(description="convert text data files (*_DATA_*.txt) to binary segments")
+    parser.add_argument("files", nargs="+", help="text data files or folders")
+    parser.add_argument("--out", default=None, help="folder for the binary files, default next to the text files")
+    parser.add_argument("--workers", type=int, default=None, help="parallel processes, default one per cpu")
+    args = parser.parse_args()
+
+    file_names = []
+    for name in args.files:
+        if os.path.isdir(name):
+            file_names.extend(sorted(glob.glob(os.path.join(name, "*_DATA_*.txt"))))
+        else:
+            file_names.append(name)
+    size = sum(os.path.getsize(name) for name in file_names)
+    t0 = time.perf_counter()
+    results = text_convert.convert_files(file_names, args.out, workers=args.workers)
+    seconds = time.perf_counter() - t0
+    for out_name, count in results:
+        print("{} ({} frames)".format(out_name, count))
+    print("{} files, {:.1f} MB in {:.1f} s ({:.0f} MB/min)".format(
+        len(results), size / 1e6, seconds, size / 1e6 / seconds * 60 if seconds else 0))
+
+
+if __name__ =="__main__":
+    main()
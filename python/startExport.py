@@ -0,0 +1,90 @@
+import argparse
+import os
+import time
+from modules.file_manager import binary_log
+from modules.file_manager import text_log
+from modules.file_manager import log_formats
+from modules.can_logger import clock_sync
+from modules.can_logger import replay
+
+FORMATS = ["asc", "log", "blf", "mf4", "bin"]
+
+
+def read_file(file_name):
+    # records of a recording (binary / text) or of one of the log_formats files
+    ending = os.path.splitext(file_name)[1].lstrip(".").lower()
+    if ending in log_formats.FORMATS:
+        return log_formats.iter_file(file_name)
+    return replay.iter_recording(file_name)
+
+
+def clock_mappings(file_name):
+    # device -> utc mapping of every channel ("0", "1" ...) stored with a recording, {} if there is none
+    try:
+        clocks = binary_log.read_header(file_name)["info"].get("clocks", {})
+    except (ValueError, UnicodeDecodeError):
+        if os.path.splitext(file_name)[1].lower() != ".txt":
+            return {}
+        clocks = text_log.read_clock_header(file_name) or {}
+    return dict((tag, mapping) for tag, mapping in clocks.items() if mapping)
+
+
+def to_utc(records, mappings):
+    # every channel has its own device clock, the offset of a channel is taken at its first frame.
+    # the drift over one file is far below the resolution of the formats
+    offsets = {}
+    for can_id, flags, data, sec, usec in records:
+        channel = binary_log.record_channel(flags)
+        device_us = sec * 1000000 + usec
+        offset = offsets.get(channel)
+        if offset is None:
+            #a channel without its own mapping uses the one of channel 0
+            mapping = mappings.get(str(channel)) or mappings.get("0")
+            offset = offsets[channel] = \
+                int(round(clock_sync.device_to_utc(mapping, device_us) * 1e6)) - device_us if mapping else 0
+        if offset:
+            device_us += offset
+            sec, usec = device_us // 1000000, device_us % 1000000
+        yield can_id, flags, data, sec, usec
+
+
+def export_file(file_name, out_name, utc=True):
+    records = read_file(file_name)
+    mappings = clock_mappings(file_name) if utc else {}
+    if mappings:
+        records = to_utc(records, mappings)
+    if out_name.endswith(".bin"):
+        #one segment, named <name>_0.bin like the logger's
+        writer = binary_log.SegmentWriter(os.path.splitext(os.path.basename(out_name))[0],
+                                          max_records=1 << 62, folder=os.path.dirname(out_name) or ".")
+        count = 0
+        for chunk in log_formats.iter_chunks(records):
+            writer.write_records(chunk)
+            count += len(chunk)
+        writer.close()
+        return writer.file_name or out_name, count
+    return out_name, log_formats.export_records(records, out_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="convert recordings to / from asc, candump, blf and mf4")
+    parser.add_argument("files", nargs="+", help="binary segments, text data files or .asc/.log/.blf/.mf4 files")
+    parser.add_argument("--format", choices=FORMATS, default="blf", help="format of the output files")
+    parser.add_argument("--out", default=None, help="folder for the output files, default next to the input")
+    parser.add_argument("--device-time", action="store_true",
+                        help="keep the device time of the channels instead of utc from their clock mappings")
+    args = parser.parse_args()
+
+    for file_name in args.files:
+        folder = args.out if args.out else os.path.dirname(file_name)
+        out_name = os.path.join(folder, os.path.splitext(os.path.basename(file_name))[0] + "." + args.format)
+        size = os.path.getsize(file_name)
+        t0 = time.perf_counter()
+        out_name, count = export_file(file_name, out_name, utc=not args.device_time)
+        seconds = time.perf_counter() - t0
+        print("{} ({} frames, {:.1f} MB in {:.1f} s, {:.0f} frames/s)".format(
+            out_name, count, size / 1e6, seconds, count / seconds if seconds else 0))
+
+
+if __name__ =="__main__":
+    main()
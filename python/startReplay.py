@@ -0,0 +1,58 @@
+import argparse
+import os
+import modules
+import DBCReader
+from modules.can_logger import replay
+from modules.can_logger import can_router
+from modules.can_logger import socketcan
+from modules.can_logger import top_level_can_logger
+
+#settings for can
+baudrate = 1000
+reconnect_attemps = 10
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a recorded data file")
+    parser.add_argument("file", help="binary segment or text data file")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = original timing, 0 = as fast as possible")
+    parser.add_argument("--target", choices=["pipeline", "bus", "socketcan"], default="pipeline")
+    parser.add_argument("--interface", default="vcan0", help="socketcan interface of --target socketcan")
+    parser.add_argument("--decode", action="store_true", help="run the dbc decoder on the replayed frames")
+    args = parser.parse_args()
+
+    records = replay.iter_recording(args.file)
+    if args.target == "bus":
+        can_driver = modules.tiny_can.MhsTinyCanDriver()
+        if top_level_can_logger.connect_api(can_driver, baudrate, attempts=reconnect_attemps) < 0:
+            print("Tiny Can not found")
+            return
+        sink = replay.DriverSink(can_driver)
+    elif args.target == "socketcan":
+        sink = socketcan.SocketCanSink(args.interface)
+    else:
+        #same router setup as the logger, raw log + decoder
+        if os.path.isdir("LOGS") ==0:
+            os.mkdir("LOGS")
+        router = can_router.FrameRouter()
+        router.subscribe(top_level_can_logger.log_raw_frames, name="raw_log")
+        if args.decode:
+            dbc = DBCReader.read_dbc()
+            dbc_ids = [can_id for can_id, eff in modules.can_logger.can_filter.frame_ids_from_dbc(dbc)]
+            router.subscribe(lambda raw_msgs: [DBCReader.convert_can_frame_to_signals(
+                top_level_can_logger.can_msg_to_dicct(raw_msg)) for raw_msg in raw_msgs],
+                ids=dbc_ids, name="decoder")
+        sink = replay.PipelineSink(router)
+
+    engine = replay.ReplayEngine(records, sink, speed=args.speed if args.speed > 0 else None)
+    try:
+        stats = engine.run()
+    except KeyboardInterrupt:
+        engine.stop()
+        stats = engine.stats()
+    top_level_can_logger.close_data_file()
+    print(stats)
+
+
+if __name__ =="__main__":
+    main()